@@ -0,0 +1,236 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Animaciones de los previews RGB año por año, en GIF, MP4 o WebM.
+
+Los frames se leen, anotan y codifican de a uno, así que el uso de memoria
+no depende de la cantidad de años:
+
+  * Todos los frames se remuestrean a una grilla común (la unión de las
+    extensiones de todos los años, con a lo sumo `max_size` píxeles por
+    lado), así que las imágenes quedan alineadas aunque sus extensiones
+    difieran.
+  * Para GIF se calcula una única paleta para toda la secuencia, a partir de
+    una muestra de tamaño fijo de cada frame, y cada frame se escribe apenas
+    se cuantiza.
+  * Para MP4 y WebM los frames se envían a ffmpeg a medida que se generan
+    (requiere `imageio-ffmpeg`).
+
+```
+script/animation.py processed_data/ --format mp4
+```
+
+"""
+import os
+from functools import lru_cache
+
+import numpy as np
+import rasterio
+from rasterio.enums import Resampling
+from rasterio.transform import from_bounds
+from rasterio.vrt import WarpedVRT
+from rasterio.warp import transform_bounds
+
+formats = ('gif', 'mp4', 'webm')
+
+# Máxima cantidad de píxeles por lado de los frames
+max_size = 1024
+
+# Fuente de las etiquetas; si no está instalada se usa la fuente de PIL
+font_path = '/usr/share/fonts/truetype/roboto/hinted/Roboto-Bold.ttf'
+font_size = 32
+label_margin = 20
+label_color = (255, 255, 255)
+
+# Cantidad de píxeles de muestra (en total) para calcular la paleta del GIF
+palette_pixels = 256 * 256
+
+def common_grid(paths, max_size=max_size):
+    """
+    Grilla que cubre la extensión de todas las imágenes de +paths+, en el
+    CRS de la primera, con la resolución más fina de todas pero a lo sumo
+    +max_size+ píxeles por lado.  Devuelve (crs, transform, ancho, alto).
+
+    """
+    crs, bounds, res = None, None, None
+    for path in paths:
+        with rasterio.open(path) as src:
+            crs = crs or src.crs
+            b = transform_bounds(src.crs, crs, *src.bounds)
+            bounds = b if bounds is None else (min(bounds[0], b[0]),
+                    min(bounds[1], b[1]), max(bounds[2], b[2]), max(bounds[3], b[3]))
+            res = min(src.res[0], res or src.res[0])
+
+    west, south, east, north = bounds
+    width, height = (east - west) / res, (north - south) / res
+    factor = max(width / max_size, height / max_size, 1)
+    # Dimensiones pares, como requieren los codecs de video
+    width = max(int(round(width / factor / 2)) * 2, 2)
+    height = max(int(round(height / factor / 2)) * 2, 2)
+    return crs, from_bounds(west, south, east, north, width, height), width, height
+
+def read_frame(path, grid, out_shape=None):
+    """
+    Lee el preview RGB de +path+ remuestreado a +grid+ (ver `common_grid`),
+    o a +out_shape+ (filas, columnas) si se pasa.  Devuelve un arreglo de
+    (filas, columnas, 3) con valores de 0 a 255.
+
+    """
+    from create_rgb_images import png_scale
+
+    crs, transform, width, height = grid
+    rows, cols = out_shape or (height, width)
+    with rasterio.open(path) as src, \
+            WarpedVRT(src, crs=crs, transform=transform, width=width,
+                    height=height, resampling=Resampling.bilinear) as vrt:
+        rgb = vrt.read([1, 2, 3], out_shape=(3, rows, cols),
+                resampling=Resampling.bilinear)
+    # Igual que en rgb_preview.png
+    return np.moveaxis(png_scale(rgb), 0, -1)
+
+def frame_label(path):
+    """Etiqueta de cada frame: el año del directorio de la escena"""
+    return path.split(os.path.sep)[-3]
+
+@lru_cache()
+def load_font(path=font_path, size=font_size):
+    from PIL import ImageFont
+    if os.path.exists(path):
+        return ImageFont.truetype(path, size, encoding='unic')
+    return ImageFont.load_default()
+
+def label_position(font, labels, width, height):
+    """
+    Posición (abajo a la derecha) de las etiquetas, calculada una sola vez
+    con la etiqueta más ancha, para que no se muevan entre frames
+
+    """
+    from PIL import Image, ImageDraw
+    draw = ImageDraw.Draw(Image.new('RGB', (1, 1)))
+    boxes = [draw.textbbox((0, 0), label, font=font) for label in labels]
+    text_width = max(b[2] for b in boxes)
+    text_height = max(b[3] for b in boxes)
+    return (width - text_width - label_margin,
+            height - text_height - label_margin)
+
+def annotate(frame, label, font, position):
+    """Devuelve el frame como imagen de PIL, con la etiqueta dibujada"""
+    from PIL import Image, ImageDraw
+    img = Image.fromarray(frame)
+    ImageDraw.Draw(img).text(position, label, label_color, font=font)
+    return img
+
+def sequence_palette(paths, grid):
+    """
+    Paleta de 256 colores para toda la secuencia.  Se calcula sobre una
+    muestra de `palette_pixels` píxeles repartidos entre los frames, leídos
+    en baja resolución, así que la memoria usada no depende de la cantidad de
+    frames.  El color de las etiquetas siempre está en la paleta.
+
+    """
+    from PIL import Image
+
+    _, _, width, height = grid
+    per_frame = max(palette_pixels // len(paths), 1)
+    scale = min(1., (per_frame / float(width * height)) ** 0.5)
+    out_shape = (max(int(height * scale), 1), max(int(width * scale), 1))
+
+    sample = np.zeros((len(paths), per_frame, 3), dtype=np.uint8)
+    rng = np.random.RandomState(0)
+    for i, path in enumerate(paths):
+        pixels = read_frame(path, grid, out_shape=out_shape).reshape(-1, 3)
+        sample[i] = pixels[rng.randint(0, len(pixels), per_frame)]
+
+    quantized = Image.fromarray(sample.reshape(-1, per_frame, 3)).quantize(colors=255)
+    colors = (quantized.getpalette() or [])[:255 * 3]
+    colors += [0] * (255 * 3 - len(colors)) + list(label_color)
+    palette = Image.new('P', (1, 1))
+    palette.putpalette(colors)
+    return palette
+
+class GIFWriter:
+    """Escribe un GIF animado con paleta global, frame por frame"""
+
+    def __init__(self, path, palette, duration=0.1, loop=0):
+        self.palette = palette
+        self.duration_ms = int(duration * 1000)
+        self.loop = loop
+        self._file = open(path, 'wb')
+        self._header_written = False
+
+    def write(self, img):
+        from PIL import GifImagePlugin
+        frame = img.quantize(palette=self.palette, dither=0)
+        if not self._header_written:
+            header, _ = GifImagePlugin.getheader(frame,
+                    info=dict(loop=self.loop, optimize=False))
+            for chunk in header:
+                self._file.write(chunk)
+            self._header_written = True
+        for chunk in GifImagePlugin.getdata(frame, duration=self.duration_ms):
+            self._file.write(chunk)
+
+    def close(self):
+        self._file.write(b';')
+        self._file.close()
+
+class VideoWriter:
+    """Escribe un video MP4 o WebM con ffmpeg, frame por frame"""
+
+    def __init__(self, path, duration=0.1):
+        import imageio
+        self._writer = imageio.get_writer(path, fps=1. / duration,
+                macro_block_size=2)
+
+    def write(self, img):
+        self._writer.append_data(np.asarray(img))
+
+    def close(self):
+        self._writer.close()
+
+def create_animation(paths, output_path, duration=0.1, fmt='gif',
+        max_size=max_size):
+    """
+    Crea una animación de los previews RGB de +paths+ (GeoTIFFs), con
+    +duration+ segundos por frame
+
+    """
+    grid = common_grid(paths, max_size=max_size)
+    _, _, width, height = grid
+    labels = [frame_label(p) for p in paths]
+    font = load_font()
+    position = label_position(font, labels, width, height)
+
+    if fmt == 'gif':
+        writer = GIFWriter(output_path, sequence_palette(paths, grid),
+                duration=duration)
+    else:
+        writer = VideoWriter(output_path, duration=duration)
+    try:
+        for path, label in zip(paths, labels):
+            writer.write(annotate(read_frame(path, grid), label, font, position))
+    finally:
+        writer.close()
+    return output_path
+
+
+if __name__ == '__main__':
+    import argparse
+    import create_rgb_images
+
+    parser = argparse.ArgumentParser(
+            description='Genera animaciones de los previews RGB, por satélite',
+            formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    parser.add_argument('input_dir', metavar='INPUT_DIR', nargs='?',
+            default='processed_data/',
+            help='Ruta donde están almacenadas las imágenes')
+    parser.add_argument('--format', choices=formats, default='gif',
+            help='Formato de la animación')
+    parser.add_argument('--duration', type=float, default=0.1,
+            help='Duración de cada frame (segundos)')
+    parser.add_argument('--max-size', type=int, default=max_size,
+            help='Máxima cantidad de píxeles por lado')
+    args = parser.parse_args()
+
+    create_rgb_images.create_animations_per_satsensor(args.input_dir,
+            duration=args.duration, fmt=args.format, max_size=args.max_size)
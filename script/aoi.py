@@ -0,0 +1,145 @@
+# -*- coding: utf-8 -*-
+"""
+Área de interés (AOI): las geometrías del Shapefile reproyectadas al CRS de
+cada escena, y la ventana de la escena que las cubre.
+
+Las escenas de Landsat cubren unos 185 km de lado, mucho más que el área que
+se analiza.  Todas las etapas leen sólo la ventana del AOI, extendida
+`margin` píxeles en cada dirección para que el relleno de gaps del
+post-procesamiento tenga contexto en los bordes del recorte.  Las geometrías
+se leen y reproyectan una sola vez por proceso para cada CRS.
+
+La máscara del recorte (`cutline_mask`) también se rasteriza una sola vez
+por proceso para cada grilla: las bandas de una escena, y las escenas de un
+mismo path/row, comparten la misma máscara.
+
+"""
+import functools
+
+import fiona
+import numpy as np
+import rasterio
+from rasterio.features import bounds, geometry_mask
+from rasterio.warp import transform_geom
+from rasterio.windows import Window
+from rasterio.windows import transform as window_transform
+
+# Margen (en píxeles) alrededor del AOI.  Es la distancia máxima de relleno
+# de gaps de `post_process_toar`.
+margin = 100
+
+# Cantidad de máscaras de recorte (una por grilla) que guarda cada proceso
+mask_cache_size = 32
+
+def read_shapes(shp_path, crs):
+    """Lee las geometrías del shapefile, reproyectadas a +crs+"""
+    return list(_read_shapes(shp_path, str(crs)))
+
+@functools.lru_cache(maxsize=None)
+def _read_shapes(shp_path, crs):
+    with fiona.open(shp_path, 'r') as source:
+        return tuple(transform_geom(source.crs_wkt, crs, f['geometry'])
+                for f in source)
+
+def shapes_bounds(shapes):
+    """Bounding box de una lista de geometrías GeoJSON"""
+    minxs, minys, maxxs, maxys = zip(*(bounds(s) for s in shapes))
+    return min(minxs), min(minys), max(maxxs), max(maxys)
+
+def cutline_window(src, shapes):
+    """Ventana de +src+ que cubre el bounding box de las geometrías"""
+    crop = grid_window(src.transform, src.width, src.height, shapes)
+    if crop is None:
+        raise ValueError('{} no intersecta el shapefile'.format(src.name))
+    return crop
+
+def grid_window(transform, width, height, shapes):
+    """
+    Ventana de la grilla (+transform+, +width+, +height+) que cubre el
+    bounding box de las geometrías, o None si no se intersectan
+
+    """
+    minx, miny, maxx, maxy = shapes_bounds(shapes)
+    rows, cols = rasterio.transform.rowcol(transform, [minx, maxx], [maxy, miny])
+    row_start, row_stop = max(min(rows), 0), min(max(rows) + 1, height)
+    col_start, col_stop = max(min(cols), 0), min(max(cols) + 1, width)
+    if row_start >= row_stop or col_start >= col_stop:
+        return None
+    return Window(col_start, row_start,
+            col_stop - col_start, row_stop - row_start)
+
+class CutlineMask:
+    """
+    Máscara del recorte de un Shapefile sobre una grilla: la ventana +crop+
+    que cubre el bounding box de las geometrías, y los píxeles de esa ventana
+    que caen dentro de ellas, empaquetados de a 8 por byte
+
+    """
+    def __init__(self, crop, packed):
+        self.crop = crop
+        self.packed = packed
+
+    def window(self, window):
+        """Máscara booleana (True dentro del Shapefile) de +window+, relativa a `crop`"""
+        rows = self.packed[window.row_off:window.row_off + window.height]
+        inside = np.unpackbits(rows, axis=1, count=self.crop.width)
+        return inside[:, window.col_off:window.col_off + window.width].view(bool)
+
+def cutline_mask(shp_path, src):
+    """
+    Máscara del recorte del Shapefile +shp_path+ sobre la grilla de +src+
+    (ver `CutlineMask`).  Se rasteriza una sola vez por proceso para cada
+    Shapefile, CRS, transformación y tamaño de imagen.
+
+    """
+    mask = _cutline_mask(shp_path, str(src.crs), src.transform,
+            src.width, src.height)
+    if mask is None:
+        raise ValueError('{} no intersecta el shapefile'.format(src.name))
+    return mask
+
+def aoi_grid(shp_path, crs, transform):
+    """
+    Grilla (ver `blocks.dataset_grid`) alineada a +transform+ que cubre el
+    bounding box del Shapefile +shp_path+, sin recortarla a ninguna imagen:
+    sirve para combinar escenas de distintos path/row
+
+    """
+    minx, miny, maxx, maxy = shapes_bounds(read_shapes(shp_path, crs))
+    rows, cols = rasterio.transform.rowcol(transform, [minx, maxx], [maxy, miny])
+    window = Window(min(cols), min(rows),
+            max(cols) - min(cols) + 1, max(rows) - min(rows) + 1)
+    return dict(crs=crs, transform=window_transform(window, transform),
+            width=window.width, height=window.height)
+
+def grid_mask(shp_path, grid):
+    """Máscara del recorte del Shapefile +shp_path+ sobre la grilla +grid+"""
+    return _cutline_mask(shp_path, str(grid['crs']), grid['transform'],
+            grid['width'], grid['height'])
+
+@functools.lru_cache(maxsize=mask_cache_size)
+def _cutline_mask(shp_path, crs, transform, width, height):
+    shapes = read_shapes(shp_path, crs)
+    crop = grid_window(transform, width, height, shapes)
+    if crop is None:
+        return None
+    inside = geometry_mask(shapes, out_shape=(crop.height, crop.width),
+            transform=window_transform(crop, transform), invert=True)
+    return CutlineMask(crop, np.packbits(inside, axis=1))
+
+def aoi_window(src, shp_path, margin=margin):
+    """
+    Ventana de +src+ que cubre el Shapefile +shp_path+, extendida +margin+
+    píxeles en cada dirección (sin salirse de la imagen).  Si +shp_path+ es
+    None, devuelve la imagen completa.
+
+    """
+    if shp_path is None:
+        return Window(0, 0, src.width, src.height)
+    crop = cutline_window(src, read_shapes(shp_path, src.crs))
+    row_start = max(crop.row_off - margin, 0)
+    col_start = max(crop.col_off - margin, 0)
+    row_stop = min(crop.row_off + crop.height + margin, src.height)
+    col_stop = min(crop.col_off + crop.width + margin, src.width)
+    return Window(col_start, row_start,
+            col_stop - col_start, row_stop - row_start)
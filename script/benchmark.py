@@ -0,0 +1,597 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Mide tiempo, memoria y bytes escritos de cada etapa del procesamiento, sobre
+productos Landsat sintéticos (ver `synthetic.py`), sin conexión.
+
+Para cada tamaño de escena se genera un producto y se preparan una sola vez
+las entradas de cada etapa (la conversión a ToA, el post procesamiento,
+etc.).  Cada medición corre en un proceso nuevo, para que el pico de memoria
+(RSS) corresponda sólo a esa etapa.  Las etapas que reparten archivos o tiles
+en un pool (`toar`, `post_process`, `post_process_gdal`, `composite` y
+`tiles`) se miden con cada cantidad de procesos de `--workers`, y las que
+reparten las ventanas de una imagen en threads (`toar`, `post_process`,
+`composite`, `rgb` y `preview`), con cada cantidad de threads de
+`--threads`:
+
+```
+script/benchmark.py --stages toar preview --sizes 4000 --threads 1 2 4 8
+```
+
+```
+script/benchmark.py --sizes 1000 2000 4000 --workers 1 2 4 -o results.json
+script/benchmark.py --stages rgb preview --sizes 2000 4000 8000 --max-memory 0
+```
+
+Por cada medición se informa el tiempo, el tiempo de CPU (propio y de los
+subprocesos), los megapíxeles procesados por segundo, el pico de RSS del
+proceso y el del mayor subproceso, y los bytes escritos.  Con `--baseline`
+los resultados se comparan con los de una corrida anterior guardada con
+`--output`, y el script termina con error si alguna etapa tarda más que la
+tolerancia:
+
+```
+script/benchmark.py --sizes 2000 --baseline results.json --tolerance 0.15
+```
+
+La etapa `storage` escribe y lee una banda ToA sintética con cada perfil de
+almacenamiento (ver `profiles.py`), e informa además la velocidad de
+escritura, lectura completa y lectura de ventanas al azar:
+
+```
+script/benchmark.py --stages storage --sizes 4000 --profiles legacy float32 uint16
+```
+
+La etapa `composite` combina `composite_scenes` escenas del mismo año (ver
+`composite.py`), convertidas a ToA en un directorio aparte.
+
+"""
+import contextlib
+import glob
+import json
+import multiprocessing
+import os
+import platform
+import resource
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+from datetime import datetime
+
+import numpy as np
+import rasterio
+from rasterio.transform import from_origin
+from rasterio.windows import Window
+
+import budget
+import profiles
+import synthetic
+
+stages = ('toar', 'post_process', 'post_process_gdal', 'composite', 'rgb',
+          'color', 'preview', 'animation', 'tiles', 'storage')
+
+# `post_process_gdal` usa gdal_translate, gdal_fillnodata.py y gdalwarp, que
+# no siempre están instalados, así que sólo se mide si se pide
+default_stages = tuple(s for s in stages if s != 'post_process_gdal')
+
+# Etapas que reparten archivos o tiles en un pool de procesos
+pool_stages = ('toar', 'post_process', 'post_process_gdal', 'composite', 'tiles')
+
+# Etapas que procesan las ventanas de cada imagen en threads
+thread_stages = ('toar', 'post_process', 'composite', 'rgb', 'preview')
+
+# Rutas dentro del directorio de cada tamaño de escena.  Son relativas, como
+# las usan los scripts (ver `post_process_toar.get_output_path`).
+data_dir = 'data'
+output_dir = 'processed_data'
+frames_dir = 'frames'
+composite_data_dir = 'composite_data'
+composite_output_dir = 'composite'
+shp_fname = 'aoi.shp'
+
+# Proporción del lado de la escena que ocupa el área de interés
+aoi_fraction = 0.5
+
+# Cantidad de años (frames) de la etapa `animation`
+animation_frames = 10
+
+# Cantidad de escenas del año que combina la etapa `composite`, y bandas de
+# cada una
+composite_scenes = 8
+composite_bands = ('2', '3', '4')
+
+# Cantidad y tamaño de las ventanas al azar que lee la etapa `storage`
+random_windows = 200
+random_window_size = 256
+
+@contextlib.contextmanager
+def working_dir(path):
+    """Cambia el directorio de trabajo mientras dura el bloque"""
+    cwd = os.getcwd()
+    os.chdir(path)
+    try:
+        yield path
+    finally:
+        os.chdir(cwd)
+
+def synthetic_reflectance(row_off, height, size):
+    """
+    Filas de una banda de reflectancia sintética: un campo suave más ruido,
+    para que la compresión se parezca a la de una imagen real
+
+    """
+    rows, cols = np.mgrid[row_off:row_off + height, 0:size].astype(np.float64)
+    rng = np.random.RandomState(row_off)
+    data = 0.2 + 0.1 * np.sin(rows / 97.) * np.cos(cols / 61.)
+    data += rng.normal(0, 0.01, data.shape)
+    # Un borde sin datos, como el de las escenas de Landsat
+    data[:, :size // 20] = np.nan
+    return data
+
+def raster_pixels(paths):
+    """Cantidad total de píxeles (por banda) de los rasters de +paths+"""
+    total = 0
+    for path in paths:
+        with rasterio.open(path) as src:
+            total += src.width * src.height
+    return total
+
+def tree_size(path):
+    return sum(os.path.getsize(os.path.join(root, f))
+               for root, _, files in os.walk(path) for f in files)
+
+def band_files():
+    return sorted(p for p in glob.glob(os.path.join(data_dir, '**', '*_B*.TIF'),
+                  recursive=True) if '_TOAR_' not in p)
+
+def toar_files(input_dir=data_dir):
+    return sorted(glob.glob(os.path.join(input_dir, '**', '*_TOAR_*.TIF'),
+            recursive=True))
+
+def scene_root(spacecraft):
+    """Directorio de la escena post-procesada de +spacecraft+"""
+    import create_rgb_images
+    return [r for r in create_rgb_images.all_scenes(output_dir + os.path.sep)
+            if spacecraft in r][0]
+
+def synthetic_year(spacecraft):
+    return 2017 if spacecraft == 'LANDSAT_8' else 2009
+
+# Preparación de las entradas de cada etapa, en el directorio de trabajo
+# actual.  Cada paso reutiliza lo que ya existe, así que se hace una sola vez
+# por tamaño de escena.
+
+def prepare_product(size, spacecraft):
+    if not band_files():
+        synthetic.create_product(data_dir, spacecraft,
+                synthetic_year(spacecraft), size, seed=size)
+        synthetic.write_aoi(shp_fname, size, fraction=aoi_fraction)
+
+def prepare_toar(size, spacecraft):
+    import dn2toar
+    prepare_product(size, spacecraft)
+    if not toar_files():
+        with budget.pool() as pool:
+            dn2toar.run_numpy(data_dir + os.path.sep, pool)
+
+def prepare_processed(size, spacecraft):
+    """Post-procesa sólo las bandas RGB, con el motor `fused`"""
+    import create_rgb_images
+    import post_process_toar
+    prepare_toar(size, spacecraft)
+    if glob.glob(os.path.join(output_dir, '*', '*', '*.TIF')):
+        return
+    satsensor = '{}-{}'.format(spacecraft, synthetic.sensors[spacecraft]['sensor_id'])
+    suffixes = ['_TOAR_B{}.TIF'.format(n)
+                for n in create_rgb_images.band_combinations[satsensor]]
+    for path in toar_files():
+        if any(path.endswith(s) for s in suffixes):
+            post_process_toar.process(output_dir, shp_fname, path)
+
+def prepare_composite(size, spacecraft):
+    """
+    Convierte a ToA `composite_scenes` escenas del mismo año (sólo las
+    bandas `composite_bands`), en un directorio aparte
+
+    """
+    import dn2toar
+    if toar_files(composite_data_dir):
+        return
+    for i in range(composite_scenes):
+        synthetic.create_product(composite_data_dir, spacecraft,
+                synthetic_year(spacecraft), size, bands=composite_bands,
+                seed=size + 10000 * i, doy=5 + synthetic.revisit_days * i)
+    synthetic.write_aoi(shp_fname, size, fraction=aoi_fraction)
+    with budget.pool() as pool:
+        dn2toar.run_numpy(composite_data_dir + os.path.sep, pool)
+
+def prepare_preview(size, spacecraft):
+    """
+    Genera el preview RGB de la escena, y guarda una copia intacta
+    (`rgb_base.tif`) para las etapas que lo modifican
+
+    """
+    import create_rgb_images
+    prepare_processed(size, spacecraft)
+    root = scene_root(spacecraft)
+    base_path = os.path.join(root, 'rgb_base.tif')
+    if not os.path.exists(base_path):
+        create_rgb_images.create_preview(root)
+        shutil.copyfile(os.path.join(root, 'rgb_preview.tif'), base_path)
+    shutil.copyfile(base_path, os.path.join(root, 'rgb_preview.tif'))
+    shutil.rmtree(os.path.join(root, 'tiles'), ignore_errors=True)
+    return root
+
+def prepare_frames(size, spacecraft):
+    """Un preview por año (enlaces al mismo archivo) para `animation`"""
+    root = prepare_preview(size, spacecraft)
+    satsensor = root.rstrip(os.path.sep).split(os.path.sep)[-1]
+    if os.path.exists(frames_dir):
+        return
+    base_path = os.path.abspath(os.path.join(root, 'rgb_base.tif'))
+    for i in range(animation_frames):
+        frame_dir = os.path.join(frames_dir, str(1990 + i), satsensor)
+        os.makedirs(frame_dir)
+        os.symlink(base_path, os.path.join(frame_dir, 'rgb_preview.tif'))
+
+def prepare(stage, size, spacecraft):
+    """Prepara las entradas de +stage+ en el directorio de trabajo actual"""
+    if stage == 'toar':
+        prepare_product(size, spacecraft)
+    elif stage in ('post_process', 'post_process_gdal'):
+        prepare_toar(size, spacecraft)
+    elif stage == 'composite':
+        prepare_composite(size, spacecraft)
+    elif stage in ('rgb', 'preview'):
+        prepare_processed(size, spacecraft)
+    elif stage in ('color', 'tiles'):
+        prepare_preview(size, spacecraft)
+    elif stage == 'animation':
+        prepare_frames(size, spacecraft)
+
+# Etapas.  Cada una devuelve las rutas escritas y otras mediciones propias,
+# al menos `pixels`, la cantidad de píxeles procesados.
+
+def storage_roundtrip(root, size, profile):
+    """
+    Escribe una banda ToA sintética de +size+ x +size+ píxeles con el perfil
+    +profile+ y la vuelve a leer.  Devuelve la ruta escrita y los tiempos de
+    escritura, lectura completa y lectura de ventanas al azar.
+
+    """
+    os.makedirs(root, exist_ok=True)
+    path = os.path.join(root, 'toar_{}.TIF'.format(profile))
+    dtype = profiles.float_dtype(profile)
+    scaled = np.dtype(dtype).kind != 'f'
+    dst_profile = dict(profiles.creation_options(profile, dtype), width=size,
+            height=size, count=1, dtype=dtype, nodata=0 if scaled else np.nan,
+            crs='EPSG:32720', transform=from_origin(300000, 6500000, 30, 30))
+
+    # Sólo se mide la escritura, no la generación de los datos
+    rows = 512
+    write_seconds = 0.
+    with rasterio.open(path, 'w', **dst_profile) as dst:
+        if scaled:
+            dst.scales = (profiles.reflectance_scale[0],)
+            dst.offsets = (profiles.reflectance_scale[1],)
+        for row_off in range(0, size, rows):
+            height = min(rows, size - row_off)
+            data = synthetic_reflectance(row_off, height, size)
+            start = time.time()
+            dst.write(profiles.encode(data, dtype, profiles.reflectance_scale),
+                    1, window=Window(0, row_off, size, height))
+            write_seconds += time.time() - start
+        start = time.time()
+    profiles.finalize(path, profile)
+    write_seconds += time.time() - start
+
+    start = time.time()
+    with rasterio.open(path) as src:
+        for _, window in src.block_windows(1):
+            profiles.read_float(src, window=window)
+    read_seconds = time.time() - start
+
+    rng = np.random.RandomState(0)
+    side = min(random_window_size, size)
+    start = time.time()
+    with rasterio.open(path) as src:
+        for _ in range(random_windows):
+            row, col = rng.randint(0, size - side + 1, 2)
+            profiles.read_float(src, window=Window(col, row, side, side))
+    window_seconds = time.time() - start
+
+    mpixels = size * size / 1e6
+    return [path], dict(pixels=size * size,
+            write_mpix_s=mpixels / write_seconds,
+            read_mpix_s=mpixels / read_seconds,
+            window_reads_s=random_windows / window_seconds)
+
+def run_toar(workers, profile, threads=1):
+    import dn2toar
+    with budget.pool(workers) as pool:
+        failed = dn2toar.run_numpy(data_dir + os.path.sep, pool, force=True,
+                profile=profile, threads=threads)
+    if failed:
+        raise RuntimeError('Falló la conversión a ToA')
+    return toar_files(), dict(pixels=raster_pixels(band_files()))
+
+def run_post_process(workers, engine, profile, threads=1):
+    from functools import partial
+    import post_process_toar
+    files = toar_files()
+    worker = partial(post_process_toar.process, output_dir, shp_fname,
+            engine=engine, profile=profile, threads=threads)
+    with budget.pool(workers) as pool:
+        paths = pool.map(worker, files)
+    return paths, dict(pixels=raster_pixels(files))
+
+def run_composite(workers, profile, max_memory, threads=1):
+    from functools import partial
+    import composite
+    groups = composite.annual_groups(composite_data_dir + os.path.sep)
+    units = composite.composite_units(groups, shp_fname, composite_output_dir, {})
+    worker = partial(composite.composite_band, shp_path=shp_fname,
+            profile=profile, threads=threads, max_memory=max_memory)
+    with budget.pool(workers) as pool:
+        paths = pool.starmap(worker, [u['args'] for u in units])
+    return paths, dict(pixels=raster_pixels(toar_files(composite_data_dir)))
+
+def run_stage(stage, max_memory, size=None, workers=1, profile=None,
+        spacecraft='LANDSAT_8', threads=1):
+    """
+    Ejecuta una etapa en el directorio de trabajo actual y devuelve las rutas
+    escritas y otras mediciones propias de la etapa
+
+    """
+    import create_rgb_images
+
+    profile = profile or profiles.default_profile
+    if stage == 'toar':
+        return run_toar(workers, profile, threads=threads)
+    if stage == 'post_process':
+        return run_post_process(workers, 'fused', profile, threads=threads)
+    if stage == 'post_process_gdal':
+        return run_post_process(workers, 'gdal', profile)
+    if stage == 'composite':
+        return run_composite(workers, profile, max_memory, threads=threads)
+    if stage == 'storage':
+        return storage_roundtrip('storage', size, profile)
+    if stage == 'animation':
+        import animation
+        paths = sorted(create_rgb_images.rgb_preview_files(frames_dir))
+        out_path = animation.create_animation(paths, 'animation.gif')
+        return [out_path], dict(pixels=raster_pixels(paths))
+
+    root = scene_root(spacecraft)
+    preview_path = os.path.join(root, 'rgb_preview.tif')
+    if stage == 'rgb':
+        out_path = create_rgb_images.create_rgb_image(root,
+                max_memory=max_memory, profile=profile, threads=threads)
+        return [out_path], dict(pixels=raster_pixels([out_path]))
+    if stage == 'preview':
+        out_path = create_rgb_images.create_preview(root,
+                max_memory=max_memory, profile=profile, threads=threads)
+        return [out_path, os.path.join(root, 'rgb_preview.png')], \
+                dict(pixels=raster_pixels([out_path]))
+    if stage == 'color':
+        create_rgb_images.correct_color(preview_path)
+        return [preview_path], dict(pixels=raster_pixels([preview_path]))
+    if stage == 'tiles':
+        import tiles
+        with budget.pool(workers) as pool:
+            count = tiles.create_tiles(pool, preview_path)
+        return [], dict(pixels=raster_pixels([preview_path]), tiles=count,
+                tile_bytes=tree_size(os.path.join(root, 'tiles')))
+    raise ValueError('Etapa desconocida: {}'.format(stage))
+
+def peak_rss_mb():
+    """
+    Pico de memoria residente del proceso actual.  En Linux se lee de
+    /proc, porque `ru_maxrss` conserva el pico del proceso padre anterior al
+    `exec`.
+
+    """
+    try:
+        with open('/proc/self/status') as f:
+            for line in f:
+                if line.startswith('VmHWM:'):
+                    return int(line.split()[1]) / 1024.
+    except IOError:
+        pass
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.
+
+def measure_child(stage, max_memory, size=None, workers=1, profile=None,
+        spacecraft='LANDSAT_8', threads=1):
+    """
+    Corre una etapa en el proceso actual e informa tiempo y memoria.  El
+    presupuesto de núcleos alcanza para +workers+ procesos de +threads+
+    threads, aunque sean más que los núcleos disponibles, para medir
+    exactamente esa configuración.
+
+    """
+    budget.configure(max(workers * threads, budget.available_cpus()))
+    start = time.time()
+    paths, extra = run_stage(stage, max_memory, size=size, workers=workers,
+            profile=profile, spacecraft=spacecraft, threads=threads)
+    elapsed = time.time() - start
+    usage = resource.getrusage(resource.RUSAGE_SELF)
+    children = resource.getrusage(resource.RUSAGE_CHILDREN)
+    result = dict(stage=stage,
+            seconds=elapsed,
+            cpu_seconds=usage.ru_utime + usage.ru_stime +
+                children.ru_utime + children.ru_stime,
+            peak_rss_mb=peak_rss_mb(),
+            cpu_budget=budget.cpus(),
+            children_peak_rss_mb=children.ru_maxrss / 1024.,
+            bytes_written=sum(os.path.getsize(p) for p in paths) +
+                extra.pop('tile_bytes', 0))
+    result.update(extra)
+    result['mpix_s'] = result['pixels'] / 1e6 / elapsed
+    return result
+
+def measure(stage, size, max_memory, work_dir, workers=1, profile=None,
+        spacecraft='LANDSAT_8', threads=1):
+    """
+    Prepara las entradas de la etapa para escenas de +size+ píxeles, y la
+    mide en un subproceso.  Si la etapa falla, el resultado incluye el error.
+
+    """
+    root = os.path.join(work_dir, str(size))
+    os.makedirs(root, exist_ok=True)
+    with working_dir(root):
+        prepare(stage, size, spacecraft)
+
+    cmd = [sys.executable, os.path.abspath(__file__), '--child',
+           '--stages', stage, '--sizes', str(size), '--workers', str(workers),
+           '--threads', str(threads), '--spacecraft', spacecraft,
+           '--max-memory', str(max_memory if max_memory is not None else 0)]
+    if profile:
+        cmd += ['--profiles', profile]
+    out = subprocess.run(cmd, cwd=root, stdout=subprocess.PIPE,
+            stderr=subprocess.PIPE)
+    if out.returncode == 0:
+        result = json.loads(out.stdout.decode().splitlines()[-1])
+    else:
+        lines = out.stderr.decode().strip().splitlines()
+        result = dict(stage=stage, error=lines[-1] if lines else 'failed')
+    result.update(size=size, max_memory=max_memory, workers=workers,
+            threads=threads, profile=profile, spacecraft=spacecraft)
+    return result
+
+def result_key(result):
+    return tuple(result.get(k) for k in
+            ('stage', 'size', 'workers', 'profile', 'max_memory', 'spacecraft')) + \
+            (result.get('threads', 1),)
+
+def compare(results, baseline, tolerance):
+    """
+    Compara +results+ con los de una corrida anterior (+baseline+).  Agrega a
+    cada resultado la proporción de tiempo respecto de la anterior, y
+    devuelve los que tardaron más que la anterior por más de +tolerance+.
+
+    """
+    previous = dict((result_key(r), r) for r in baseline if 'error' not in r)
+    regressions = []
+    for result in results:
+        old = previous.get(result_key(result))
+        if old is None or 'error' in result:
+            continue
+        result['baseline_ratio'] = result['seconds'] / old['seconds']
+        if result['baseline_ratio'] > 1 + tolerance:
+            regressions.append(result)
+    return regressions
+
+def describe(result):
+    if 'error' in result:
+        return '{stage} size={size} workers={workers} failed: {error}'.format(**result)
+    line = ('{stage} size={size} workers={workers} threads={threads} '
+            'time={seconds:.2f}s '
+            'cpu={cpu_seconds:.2f}s throughput={mpix_s:.1f}Mpx/s '
+            'peak_rss={peak_rss_mb:.1f}MB '
+            'children_peak_rss={children_peak_rss_mb:.1f}MB '
+            'written={bytes_written}').format(**result)
+    if result['stage'] == 'storage':
+        line += (' profile={profile} write={write_mpix_s:.1f}Mpx/s '
+                 'read={read_mpix_s:.1f}Mpx/s '
+                 'windows={window_reads_s:.0f}/s').format(**result)
+    if 'baseline_ratio' in result:
+        line += ' vs_baseline={:.2f}x'.format(result['baseline_ratio'])
+    return line
+
+def git_commit():
+    """Commit actual del repositorio, para identificar los resultados"""
+    out = subprocess.run(['git', 'rev-parse', 'HEAD'], stdout=subprocess.PIPE,
+            stderr=subprocess.DEVNULL, cwd=os.path.dirname(os.path.abspath(__file__)))
+    return out.stdout.decode().strip() or None
+
+
+if __name__ == '__main__':
+    import argparse
+
+    parser = argparse.ArgumentParser(
+            description='Mide tiempo y memoria de las etapas de procesamiento',
+            formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    parser.add_argument('--stages', '--stage', nargs='+', choices=stages,
+            default=list(default_stages),
+            help='Etapas a medir')
+    parser.add_argument('--sizes', type=int, nargs='+',
+            default=[1000, 2000, 4000],
+            help='Tamaños de escena (píxeles por lado)')
+    parser.add_argument('--workers', type=int, nargs='+', default=[1],
+            help='Cantidades de procesos de las etapas con pool')
+    parser.add_argument('--threads', type=int, nargs='+', default=[1],
+            help='Cantidades de threads por imagen de las etapas que ' \
+                 'procesan ventanas en paralelo')
+    parser.add_argument('--spacecraft', choices=sorted(synthetic.sensors),
+            default='LANDSAT_8',
+            help='Satélite de los productos sintéticos')
+    parser.add_argument('--max-memory', type=int, default=64,
+            help='Memoria máxima (MB) por ventana; 0 para leer bandas completas')
+    parser.add_argument('--profiles', nargs='+', choices=sorted(profiles.profiles),
+            help='Perfiles de almacenamiento a medir (por defecto, todos en ' \
+                 'la etapa "storage" y "{}" en las demás)'.format(
+                     profiles.default_profile))
+    parser.add_argument('--work-dir',
+            help='Directorio donde se generan los productos (por defecto, ' \
+                 'uno temporal); se reutiliza entre corridas')
+    parser.add_argument('--output', '-o',
+            help='Archivo JSON donde guardar los resultados')
+    parser.add_argument('--baseline',
+            help='Resultados de una corrida anterior (ver --output), para comparar')
+    parser.add_argument('--tolerance', type=float, default=0.1,
+            help='Proporción de tiempo extra respecto de --baseline que se ' \
+                 'considera una regresión')
+    parser.add_argument('--child', action='store_true', help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    max_memory = args.max_memory or None
+
+    if args.child:
+        print(json.dumps(measure_child(args.stages[0], max_memory,
+            size=args.sizes[0], workers=args.workers[0],
+            profile=args.profiles[0] if args.profiles else None,
+            spacecraft=args.spacecraft, threads=args.threads[0])))
+        raise SystemExit
+
+    def runs(stage):
+        """Combinaciones de procesos, threads y perfil a medir para +stage+"""
+        workers = args.workers if stage in pool_stages else [1]
+        threads = args.threads if stage in thread_stages else [1]
+        stage_profiles = args.profiles or [None]
+        if stage == 'storage' and not args.profiles:
+            stage_profiles = sorted(profiles.profiles)
+        return [(w, t, p) for w in workers for t in threads for p in stage_profiles]
+
+    baseline = []
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)['results']
+
+    results, regressions = [], []
+    with contextlib.ExitStack() as stack:
+        work_dir = args.work_dir or stack.enter_context(tempfile.TemporaryDirectory())
+        for size in args.sizes:
+            for stage in args.stages:
+                for workers, threads, profile in runs(stage):
+                    result = measure(stage, size, max_memory, work_dir,
+                            workers=workers, profile=profile,
+                            spacecraft=args.spacecraft, threads=threads)
+                    results.append(result)
+                    regressions += compare([result], baseline, args.tolerance)
+                    print(describe(result))
+
+    for result in regressions:
+        print('Regression: ' + describe(result))
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(dict(created=datetime.now().isoformat(),
+                commit=git_commit(),
+                host=platform.node(),
+                cpu_count=multiprocessing.cpu_count(),
+                results=results), f, indent=2)
+
+    if regressions or any('error' in r for r in results):
+        raise SystemExit(1)
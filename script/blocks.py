@@ -0,0 +1,196 @@
+# -*- coding: utf-8 -*-
+"""
+Utilidades para recorrer rasters por ventanas, de forma que el uso de memoria
+quede acotado sin importar el tamaño de la imagen.
+
+Las ventanas de una misma imagen se pueden procesar en paralelo con
+`map_windows`, para aprovechar todos los núcleos aunque se procese una sola
+escena.  Los threads salen del presupuesto de núcleos compartido con los
+demás procesos (ver `budget`).
+
+"""
+import threading
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+import rasterio
+from rasterio.enums import Resampling
+from rasterio.vrt import WarpedVRT
+from rasterio.windows import Window
+
+import budget
+
+def row_windows(width, height, rows):
+    """Divide un raster de +width+ x +height+ en franjas de +rows+ filas"""
+    for row_off in range(0, height, rows):
+        yield Window(0, row_off, width, min(rows, height - row_off))
+
+def rows_for_memory(src, count, max_memory):
+    """
+    Cantidad de filas por franja para que +count+ bandas del ancho de +src+
+    no ocupen más de +max_memory+ MB.  Si +max_memory+ es None, devuelve la
+    altura completa de la imagen.
+
+    La cantidad de filas se redondea a un múltiplo de la altura de bloque de
+    +src+, para que cada bloque se decodifique una sola vez.
+
+    """
+    if max_memory is None:
+        return src.height
+    block_rows, _ = src.block_shapes[0]
+    itemsize = max(np.dtype(dtype).itemsize for dtype in src.dtypes)
+    row_bytes = src.width * itemsize * count
+    rows = max(int(max_memory * 1024 * 1024 // row_bytes), 1)
+    if rows > block_rows:
+        rows -= rows % block_rows
+    return min(rows, src.height)
+
+def memory_windows(src, count, max_memory):
+    """Franjas de +src+ que respetan el límite de memoria +max_memory+ (MB)"""
+    rows = rows_for_memory(src, count, max_memory)
+    return row_windows(src.width, src.height, rows)
+
+def threads_per_task(tasks, cpus=None):
+    """
+    Cantidad de threads para procesar cada una de +tasks+ tareas en
+    paralelo, de forma de ocupar los +cpus+ núcleos (por defecto, el
+    presupuesto de `budget`) aunque haya menos tareas que núcleos
+
+    """
+    cpus = cpus or budget.cpus()
+    return max(cpus // max(tasks, 1), 1)
+
+def in_flight(threads):
+    """Cantidad máxima de ventanas en memoria a la vez con +threads+ threads"""
+    return 1 if threads <= 1 else 2 * threads
+
+def thread_memory(max_memory, threads):
+    """
+    Memoria (MB) por ventana para que las ventanas en proceso con +threads+
+    threads no ocupen más de +max_memory+ MB en total
+
+    """
+    if max_memory is None:
+        return None
+    return max_memory / in_flight(threads)
+
+def map_windows(func, windows, threads=1):
+    """
+    Aplica +func+ a cada ventana de +windows+ en un pool de +threads+
+    threads, y devuelve los resultados en el orden de las ventanas, a medida
+    que están listos, para escribirlos en orden.
+
+    La lectura y escritura de GDAL y la mayoría de las operaciones de NumPy
+    liberan el GIL, así que las ventanas se procesan realmente en paralelo.
+    +func+ no debe leer de un dataset compartido entre threads (ver
+    `ThreadDatasets`).  Nunca hay más de `in_flight(threads)` ventanas en
+    proceso o esperando ser escritas.
+
+    Los threads se reservan en el presupuesto de núcleos (ver
+    `budget.reserve`): si no hay núcleos libres, se usan menos threads.
+
+    """
+    with budget.reserve(threads) as threads:
+        for result in _map_windows(func, windows, threads):
+            yield result
+
+def _map_windows(func, windows, threads):
+    if threads <= 1:
+        for window in windows:
+            yield func(window)
+        return
+
+    with ThreadPoolExecutor(threads) as executor:
+        pending = deque()
+        for window in windows:
+            if len(pending) >= in_flight(threads):
+                yield pending.popleft().result()
+            pending.append(executor.submit(func, window))
+        while pending:
+            yield pending.popleft().result()
+
+class ThreadDatasets:
+    """
+    Abre los rasters de +paths+ una vez por thread, ya que un dataset de
+    rasterio no se puede leer desde varios threads a la vez.  Se usa como
+    context manager, que cierra todos los datasets abiertos.
+
+    """
+    def __init__(self, *paths):
+        self.paths = paths
+        self.local = threading.local()
+        self.lock = threading.Lock()
+        self.opened = []
+
+    def get(self):
+        """Datasets abiertos por el thread actual, en el orden de +paths+"""
+        datasets = getattr(self.local, 'datasets', None)
+        if datasets is None:
+            datasets = self.local.datasets = tuple(self.open(p)
+                    for p in self.paths)
+            with self.lock:
+                self.opened.extend(datasets)
+        return datasets
+
+    def open(self, path):
+        return rasterio.open(path)
+
+    def close_dataset(self, dataset):
+        dataset.close()
+
+    def close(self):
+        with self.lock:
+            for dataset in self.opened:
+                self.close_dataset(dataset)
+            self.opened = []
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+class WarpedDatasets(ThreadDatasets):
+    """
+    Como `ThreadDatasets`, pero cada raster se reproyecta (con vecino más
+    cercano) a la grilla +grid+ (ver `dataset_grid`).  `get` devuelve pares
+    (dataset, VRT en la grilla de destino).
+
+    """
+    def __init__(self, grid, *paths):
+        super().__init__(*paths)
+        self.grid = grid
+
+    def open(self, path):
+        src = rasterio.open(path)
+        return src, WarpedVRT(src, resampling=Resampling.nearest, **self.grid)
+
+    def close_dataset(self, dataset):
+        src, vrt = dataset
+        vrt.close()
+        src.close()
+
+def dataset_grid(src):
+    """Grilla de +src+: CRS, transformación y tamaño"""
+    return dict(crs=src.crs, transform=src.transform,
+            width=src.width, height=src.height)
+
+def read_warped(dataset, window):
+    """
+    Lee +window+ de un par (dataset, VRT) de `WarpedDatasets` como float64,
+    aplicando la escala y offset del dataset, con NaN en los píxeles nodata
+    (como `profiles.read_float`)
+
+    """
+    src, vrt = dataset
+    data = vrt.read(1, window=window, masked=True).astype(np.float64)
+    scale, offset = src.scales[0], src.offsets[0]
+    if (scale, offset) != (1, 0):
+        data = data * scale + offset
+    return data.filled(np.nan)
+
+def offset_window(window, base):
+    """Ventana +window+, relativa a la ventana +base+, en la imagen completa"""
+    return Window(base.col_off + window.col_off, base.row_off + window.row_off,
+            window.width, window.height)
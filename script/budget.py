@@ -0,0 +1,165 @@
+# -*- coding: utf-8 -*-
+"""
+Presupuesto de CPU compartido por todas las etapas.
+
+Los scripts reparten bandas o escenas en un pool de procesos, cada tarea
+reparte las ventanas de una imagen en threads (ver `blocks.map_windows`), y
+algunos pasos lanzan comandos externos que usan varios núcleos por su cuenta
+(`rio color -j`, las herramientas de GDAL con `GDAL_NUM_THREADS`).  Si cada
+nivel supone que tiene todos los núcleos para sí, hay muchos más threads que
+núcleos y el procesamiento se vuelve más lento.
+
+El presupuesto (`cpus`) es la cantidad de núcleos asignados al proceso, o la
+que se fija con `--cpus` en cada script (o la variable de entorno
+`CPU_BUDGET`).  Los núcleos se reservan y liberan en un contador compartido
+por el proceso principal y los procesos de sus pools (ver `pool`):
+
+  * Cada tarea reserva un núcleo mientras corre (`task`, ver
+    `manifest.call_unit`), y espera si no hay ninguno libre.
+  * Los threads extra de una tarea y los de los comandos externos se toman
+    de los núcleos libres con `reserve`, sin esperar: si no hay, la tarea
+    sigue con un solo thread.
+  * En los procesos de los pools, GDAL y BLAS/OpenMP se limitan a un thread
+    (ver `limit_threads`); los comandos externos reciben en el entorno la
+    cantidad de threads que reservaron (ver `thread_env`).
+
+El log de la corrida registra el presupuesto en cada paso, y el resumen
+informa qué parte de los núcleos se usó (ver `runlog`).
+
+"""
+import multiprocessing
+import os
+import threading
+import time
+from contextlib import contextmanager
+
+try:
+    from threadpoolctl import threadpool_limits
+except ImportError:
+    # Sin threadpoolctl sólo se limitan los threads de las bibliotecas que
+    # leen las variables de entorno al usarse (GDAL), y los de los comandos
+    # externos
+    threadpool_limits = None
+
+env_var = 'CPU_BUDGET'
+
+# Variables de entorno con la cantidad de threads de GDAL y de las
+# bibliotecas de álgebra lineal
+thread_env_vars = ('GDAL_NUM_THREADS', 'OMP_NUM_THREADS', 'OPENBLAS_NUM_THREADS',
+        'MKL_NUM_THREADS', 'NUMEXPR_NUM_THREADS')
+
+# Segundos entre intentos de reservar el núcleo de una tarea
+wait_interval = 0.05
+
+# Núcleos libres del presupuesto, compartido con los procesos de los pools
+_free = None
+_local = threading.local()
+
+def available_cpus():
+    """Núcleos en los que puede correr el proceso"""
+    try:
+        return len(os.sched_getaffinity(0))
+    except AttributeError:
+        return multiprocessing.cpu_count()
+
+def cpus():
+    """Presupuesto de núcleos"""
+    return int(os.environ.get(env_var) or 0) or available_cpus()
+
+def configure(count=None):
+    """
+    Fija el presupuesto en +count+ núcleos (por defecto, el de `CPU_BUDGET`
+    o todos los disponibles).  Se guarda en el entorno, así que lo heredan
+    los procesos hijos.  Se debe llamar antes de crear los pools.  Devuelve
+    el presupuesto.
+
+    """
+    global _free
+    if count:
+        os.environ[env_var] = str(count)
+    _free = multiprocessing.Value('i', cpus())
+    return cpus()
+
+def _shared():
+    if _free is None:
+        configure()
+    return _free
+
+def pool(processes=None):
+    """
+    Pool de +processes+ procesos (como mucho, el presupuesto) que comparten
+    el presupuesto del proceso actual
+
+    """
+    processes = min(processes or cpus(), cpus())
+    return multiprocessing.Pool(processes, initializer=_init_worker,
+            initargs=(_shared(),))
+
+def _init_worker(free):
+    global _free
+    _free = free
+    limit_threads(1)
+
+def limit_threads(count):
+    """
+    Limita a +count+ los threads propios de GDAL y de BLAS/OpenMP en este
+    proceso y en los comandos que lance
+
+    """
+    for var in thread_env_vars:
+        os.environ[var] = str(count)
+    if threadpool_limits is not None:
+        threadpool_limits(count)
+
+def thread_env(count):
+    """Entorno para un comando externo que puede usar +count+ threads"""
+    env = dict(os.environ)
+    env.update((var, str(count)) for var in thread_env_vars)
+    return env
+
+def held():
+    """Núcleos reservados por el thread actual"""
+    return getattr(_local, 'held', 0)
+
+def _take(count, wait):
+    free = _shared()
+    while True:
+        with free.get_lock():
+            taken = min(count, free.value)
+            if taken or not wait:
+                free.value -= taken
+                return taken
+        time.sleep(wait_interval)
+
+def _give(count):
+    free = _shared()
+    with free.get_lock():
+        free.value += count
+
+@contextmanager
+def reserve(count, wait=False):
+    """
+    Reserva hasta +count+ núcleos para el thread actual mientras dura el
+    bloque, contando los que ya tiene reservados (un paso anidado no reserva
+    dos veces).  Sin +wait+ toma sólo los núcleos libres; con +wait+, si el
+    thread no tiene ninguno, espera a que haya al menos uno.  Devuelve la
+    cantidad de núcleos que puede usar el bloque (al menos 1).
+
+    """
+    before = held()
+    taken = 0
+    if count > before:
+        taken = _take(count - before, wait and before == 0)
+    _local.held = before + taken
+    try:
+        yield max(before + taken, 1)
+    finally:
+        _local.held = before
+        if taken:
+            _give(taken)
+
+@contextmanager
+def task():
+    """Reserva el núcleo de una tarea mientras dura el bloque"""
+    with reserve(1, wait=True):
+        yield
@@ -0,0 +1,303 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Catálogo local de escenas de Landsat y Sentinel-2.
+
+Guarda una exportación de las tablas `landsat_index` y `sentinel_2_index` del
+dataset `cloud_storage_geo_index` de BigQuery en una base SQLite, con un índice
+espacial (R*Tree de SQLite) sobre el bounding box de cada escena.  Permite
+responder localmente, y sin conexión, las mismas consultas que
+`build_landsat_query` y `build_sentinel2_query` de `query.py`.
+
+Para crear o actualizar el catálogo, exportar la tabla a CSV (por ejemplo con
+`bq extract` o desde la consola de BigQuery) y ejecutar:
+
+```
+script/catalog.py ingest catalog.db landsat_index.csv.gz --dataset landsat
+```
+
+La ingesta es incremental: las escenas que ya estaban se actualizan, y un
+archivo que ya fue ingerido y no cambió se omite.  Para exportar sólo las
+escenas nuevas, `script/catalog.py refresh-query catalog.db` imprime la
+consulta con las escenas posteriores a la última del catálogo.
+
+"""
+import csv
+import gzip
+import io
+import os
+import sqlite3
+
+datasets = ('landsat', 'sentinel2')
+
+# Tabla de BigQuery de cada dataset
+index_tables = {
+    'landsat': 'bigquery-public-data.cloud_storage_geo_index.landsat_index',
+    'sentinel2': 'bigquery-public-data.cloud_storage_geo_index.sentinel_2_index',
+}
+
+# Columnas que se guardan de cada tabla, y la que identifica cada fila
+columns = {
+    'landsat': ('product_id', 'scene_id', 'spacecraft_id', 'sensor_id',
+                'sensing_time', 'collection_number', 'data_type', 'wrs_path',
+                'wrs_row', 'cloud_cover', 'total_size', 'base_url'),
+    'sentinel2': ('granule_id', 'product_id', 'mgrs_tile', 'sensing_time',
+                  'geometric_quality_flag', 'cloud_cover', 'total_size',
+                  'base_url'),
+}
+keys = {'landsat': 'product_id', 'sentinel2': 'granule_id'}
+
+# Cantidad de filas por transacción al ingerir
+batch_size = 10000
+
+def connect(path):
+    conn = sqlite3.connect(path)
+    conn.row_factory = sqlite3.Row
+    for dataset in datasets:
+        cols = ', '.join('{} {}'.format(c, column_type(c)) for c in columns[dataset])
+        conn.execute('CREATE TABLE IF NOT EXISTS {0} ('
+                'id INTEGER PRIMARY KEY, year INTEGER, {1}, '
+                'UNIQUE ({2}))'.format(dataset, cols, keys[dataset]))
+        conn.execute('CREATE VIRTUAL TABLE IF NOT EXISTS {}_rtree USING '
+                'rtree(id, west_lon, east_lon, south_lat, north_lat)'.format(dataset))
+    conn.execute('CREATE TABLE IF NOT EXISTS sources ('
+            'path TEXT PRIMARY KEY, dataset TEXT, size INTEGER, mtime REAL)')
+    return conn
+
+def column_type(name):
+    if name in ('cloud_cover',):
+        return 'REAL'
+    if name in ('total_size', 'wrs_path', 'wrs_row'):
+        return 'INTEGER'
+    return 'TEXT'
+
+def open_csv(path):
+    if path.endswith('.gz'):
+        return io.TextIOWrapper(gzip.open(path), encoding='utf-8')
+    return open(path, newline='')
+
+def ingest(db_path, csv_path, dataset, force=False):
+    """
+    Agrega o actualiza en el catálogo las escenas de una exportación CSV de la
+    tabla de +dataset+.  Devuelve la cantidad de filas leídas (0 si el archivo
+    ya había sido ingerido y no cambió).
+
+    """
+    conn = connect(db_path)
+    stat = os.stat(csv_path)
+    source = conn.execute('SELECT size, mtime FROM sources WHERE path = ?',
+            (os.path.abspath(csv_path),)).fetchone()
+    if not force and source and tuple(source) == (stat.st_size, stat.st_mtime):
+        return 0
+
+    cols = columns[dataset]
+    upsert = ('INSERT INTO {0} (year, {1}) VALUES (?, {2}) '
+              'ON CONFLICT ({3}) DO UPDATE SET {4}'.format(
+                  dataset, ', '.join(cols), ', '.join('?' for _ in cols),
+                  keys[dataset],
+                  ', '.join('{0} = excluded.{0}'.format(c) for c in ('year',) + cols)))
+    update_rtree = ('INSERT OR REPLACE INTO {}_rtree VALUES '
+                    '((SELECT id FROM {} WHERE {} = ?), ?, ?, ?, ?)'.format(
+                        dataset, dataset, keys[dataset]))
+
+    count = 0
+    with open_csv(csv_path) as f:
+        reader = csv.DictReader(f)
+        while True:
+            rows = [row for _, row in zip(range(batch_size), reader)]
+            if not rows:
+                break
+            with conn:
+                for row in rows:
+                    if not row.get(keys[dataset]) or not row.get('west_lon'):
+                        continue
+                    values = [row.get(c) or None for c in cols]
+                    conn.execute(upsert, [int(row['sensing_time'][:4])] + values)
+                    conn.execute(update_rtree, (row[keys[dataset]],
+                        float(row['west_lon']), float(row['east_lon']),
+                        float(row['south_lat']), float(row['north_lat'])))
+            count += len(rows)
+
+    with conn:
+        conn.execute('INSERT OR REPLACE INTO sources VALUES (?, ?, ?, ?)',
+                (os.path.abspath(csv_path), dataset, stat.st_size, stat.st_mtime))
+    conn.close()
+    return count
+
+def latest_sensing_time(db_path, dataset):
+    conn = connect(db_path)
+    row = conn.execute('SELECT MAX(sensing_time) FROM {}'.format(dataset)).fetchone()
+    conn.close()
+    return row[0]
+
+def refresh_query(db_path, dataset):
+    """Consulta (SQL estándar) para exportar las escenas que faltan"""
+    qs = 'SELECT * FROM `{}`'.format(index_tables[dataset])
+    latest = latest_sensing_time(db_path, dataset)
+    if latest:
+        qs += " WHERE sensing_time > '{}'".format(latest)
+    return qs
+
+def query_landsat(conn, bounding_box):
+    """Igual que `query.build_landsat_query`, sobre el catálogo local"""
+    qs = ('SELECT '
+          'scene_id AS id, '
+          'year, '
+          'MIN(sensing_time) AS sensing_time, '
+          'spacecraft_id, '
+          'sensor_id, '
+          'wrs_path, '
+          'wrs_row, '
+          'total_size, '
+          'base_url '
+        'FROM landsat JOIN landsat_rtree USING (id) '
+        'WHERE '
+          'landsat_rtree.west_lon < ? '
+          'AND landsat_rtree.south_lat < ? '
+          'AND landsat_rtree.east_lon > ? '
+          'AND landsat_rtree.north_lat > ? '
+          'AND cloud_cover < 1 '
+          "AND collection_number = '01' "
+          "AND data_type = 'L1TP' "
+          "AND sensor_id IN ('TM', 'ETM', 'OLI_TIRS') "
+        'GROUP BY '
+          'year, '
+          'spacecraft_id, '
+          'sensor_id, '
+          'wrs_path, '
+          'wrs_row '
+        'ORDER BY '
+          'year DESC, '
+          'spacecraft_id DESC')
+    return conn.execute(qs, bounding_box)
+
+def query_sentinel2(conn, bounding_box):
+    """Igual que `query.build_sentinel2_query`, sobre el catálogo local"""
+    qs = ('SELECT '
+          'product_id AS id, '
+          'year, '
+          'MIN(sensing_time) AS sensing_time, '
+          "'SENTINEL_2' AS spacecraft_id, "
+          "'MSI' AS sensor_id, "
+          'granule_id, '
+          'mgrs_tile, '
+          'total_size, '
+          'base_url '
+        'FROM sentinel2 JOIN sentinel2_rtree USING (id) '
+        'WHERE '
+          'sentinel2_rtree.west_lon < ? '
+          'AND sentinel2_rtree.south_lat < ? '
+          'AND sentinel2_rtree.east_lon > ? '
+          'AND sentinel2_rtree.north_lat > ? '
+          'AND cloud_cover < 1 '
+          "AND geometric_quality_flag = 'PASSED' "
+        'GROUP BY '
+          'year, '
+          'mgrs_tile '
+        'ORDER BY '
+          'year DESC')
+    return conn.execute(qs, bounding_box)
+
+def candidates_landsat(conn, bounding_box):
+    """Igual que `query.build_landsat_candidates_query`, sobre el catálogo local"""
+    qs = ('SELECT '
+          'scene_id AS id, year, sensing_time, spacecraft_id, sensor_id, '
+          'wrs_path, wrs_row, total_size, base_url, cloud_cover, '
+          'r.west_lon, r.south_lat, r.east_lon, r.north_lat '
+        'FROM landsat JOIN landsat_rtree AS r USING (id) '
+        'WHERE '
+          'r.west_lon < ? '
+          'AND r.south_lat < ? '
+          'AND r.east_lon > ? '
+          'AND r.north_lat > ? '
+          'AND cloud_cover < 1 '
+          "AND collection_number = '01' "
+          "AND data_type = 'L1TP' "
+          "AND sensor_id IN ('TM', 'ETM', 'OLI_TIRS')")
+    return conn.execute(qs, intersect_params(bounding_box))
+
+def candidates_sentinel2(conn, bounding_box):
+    """Igual que `query.build_sentinel2_candidates_query`, sobre el catálogo local"""
+    qs = ('SELECT '
+          "product_id AS id, year, sensing_time, 'SENTINEL_2' AS spacecraft_id, "
+          "'MSI' AS sensor_id, granule_id, mgrs_tile, total_size, base_url, "
+          'cloud_cover, r.west_lon, r.south_lat, r.east_lon, r.north_lat '
+        'FROM sentinel2 JOIN sentinel2_rtree AS r USING (id) '
+        'WHERE '
+          'r.west_lon < ? '
+          'AND r.south_lat < ? '
+          'AND r.east_lon > ? '
+          'AND r.north_lat > ? '
+          'AND cloud_cover < 1 '
+          "AND geometric_quality_flag = 'PASSED'")
+    return conn.execute(qs, intersect_params(bounding_box))
+
+def intersect_params(bounding_box):
+    """Parámetros para buscar escenas que intersectan +bounding_box+"""
+    west_lon, south_lat, east_lon, north_lat = bounding_box
+    return east_lon, north_lat, west_lon, south_lat
+
+def candidate_scenes(db_path, dataset, bounding_box):
+    """
+    Devuelve todas las escenas de +dataset+ que intersectan +bounding_box+,
+    con su nubosidad y bounding box, para elegir las que cubren el área (ver
+    `query.covering_scenes`).
+
+    """
+    conn = connect(db_path)
+    query_method = candidates_landsat if dataset == 'landsat' else candidates_sentinel2
+    cursor = query_method(conn, bounding_box)
+    fieldnames = [d[0] for d in cursor.description]
+    results = (dict(row) for row in cursor.fetchall())
+    conn.close()
+    return results, fieldnames
+
+def query_scenes(db_path, dataset, bounding_box):
+    """
+    Devuelve las escenas de +dataset+ que cubren +bounding_box+ (en WGS84),
+    como `query.query_images`: un generador de diccionarios y la lista de
+    columnas.
+
+    """
+    conn = connect(db_path)
+    query_method = query_landsat if dataset == 'landsat' else query_sentinel2
+    cursor = query_method(conn, bounding_box)
+    fieldnames = [d[0] for d in cursor.description]
+    results = (dict(row) for row in cursor.fetchall())
+    conn.close()
+    return results, fieldnames
+
+
+if __name__ == '__main__':
+    import argparse
+
+    parser = argparse.ArgumentParser(
+            description='Catálogo local de escenas de Landsat y Sentinel-2')
+    subparsers = parser.add_subparsers(dest='command')
+
+    ingest_parser = subparsers.add_parser('ingest',
+            help='Agrega al catálogo una exportación CSV de BigQuery')
+    ingest_parser.add_argument('db', metavar='DB')
+    ingest_parser.add_argument('csv_files', metavar='CSV_FILE', nargs='+')
+    ingest_parser.add_argument('--dataset', '-d', choices=datasets,
+            default='landsat', help='Dataset de la exportación')
+    ingest_parser.add_argument('--force', action='store_true',
+            help='Ingiere los archivos aunque ya hayan sido ingeridos')
+
+    refresh_parser = subparsers.add_parser('refresh-query',
+            help='Imprime la consulta para exportar las escenas nuevas')
+    refresh_parser.add_argument('db', metavar='DB')
+    refresh_parser.add_argument('--dataset', '-d', choices=datasets,
+            default='landsat', help='Dataset a actualizar')
+
+    args = parser.parse_args()
+
+    if args.command == 'ingest':
+        for csv_path in args.csv_files:
+            count = ingest(args.db, csv_path, args.dataset, force=args.force)
+            print('{}: {} rows'.format(csv_path, count) if count
+                    else '{}: up to date'.format(csv_path))
+    elif args.command == 'refresh-query':
+        print(refresh_query(args.db, args.dataset))
+    else:
+        parser.print_help()
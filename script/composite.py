@@ -0,0 +1,335 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Genera compuestos anuales de las bandas ToA: combina, píxel por píxel, todas
+las escenas de un mismo año y sensor en una sola imagen por banda.
+
+`query.py` elige una sola escena por año, sensor y path/row, porque
+`post_process_toar.py` escribe una imagen por directorio `año/satsensor`.
+Con `query.py --selection all` se descargan todas las escenas del año, y
+este script reemplaza al post-procesamiento: escribe las bandas en la misma
+estructura de directorios, así que `create_rgb_images.py` las usa sin
+cambios.
+
+```
+processed_data/
+    2009/
+        LANDSAT_7-ETM/
+            2009_LANDSAT_7-ETM_metadata.json
+            2009_LANDSAT_7-ETM_B1.TIF
+            ...
+```
+
+Métodos (`methods`):
+
+* `median`: la mediana de los valores válidos de cada píxel.  Descarta
+  nubes, sombras y valores atípicos, y rellena los gaps del SLC-off de
+  Landsat 7 con las otras fechas.
+* `best`: el valor de la mejor escena con datos en cada píxel, según
+  `scene_rank` (menor nubosidad y, con `--target-date`, fecha más cercana a
+  ese día del año).
+
+Las escenas se reproyectan (con vecino más cercano) a una grilla que cubre el
+Shapefile, alineada a la de la mejor escena (ver `aoi.aoi_grid`), así que
+también se combinan escenas de distintos path/row.  Como en
+`post_process_toar.py`, el resultado se reescala a UInt8 (UInt16 sin
+reescalar las bandas térmicas) y los píxeles fuera del Shapefile quedan en 0.
+
+Cada banda se procesa por franjas de filas, en threads.  Para la mediana se
+apila la franja de todas las escenas en un arreglo float32, con la cantidad
+de filas que entra en `--max-memory`, y se hace una selección parcial
+(`np.partition`) de los valores del medio en lugar de ordenar; el mejor
+píxel lee una escena por vez, y deja de leer cuando la franja está completa.
+Así la memoria no depende de la cantidad de escenas (sólo la altura de las
+franjas).
+
+"""
+import json
+import os
+from collections import OrderedDict
+from datetime import datetime
+from functools import partial
+
+import numpy as np
+import rasterio
+
+import budget
+import gapfill
+import post_process_toar
+import profiles
+import runlog
+from aoi import aoi_grid, grid_mask
+from blocks import (WarpedDatasets, map_windows, read_warped, row_windows,
+        thread_memory)
+from manifest import Manifest, run_units, unit
+
+methods = ('median', 'best')
+
+manifest_fname = '.composite.manifest.json'
+
+# Memoria máxima (MB) de las franjas en proceso de cada banda
+max_memory_mb = 256
+
+# Arreglos del tamaño de una franja, además de la pila de escenas: la lectura
+# de cada escena (float64, con su máscara) y el resultado
+window_overhead = 4
+
+def annual_groups(input_dir, pattern='*_TOAR_*.TIF', target_date=None):
+    """
+    Agrupa las bandas ToA de +input_dir+ por año, sensor y banda.  Devuelve
+    un diccionario ordenado {(año, satsensor): {banda: [rutas]}}, con las
+    rutas de cada banda en el orden de `scene_rank` (con +target_date+).
+
+    """
+    products = OrderedDict()
+    for path in sorted(post_process_toar.all_scene_files(input_dir, pattern)):
+        root = os.path.dirname(path)
+        satsensor, year = post_process_toar.product_satsensor_year(root)
+        products.setdefault((year, satsensor), {}).setdefault(root, []).append(path)
+
+    groups = OrderedDict()
+    for key, roots in sorted(products.items()):
+        bands = groups[key] = OrderedDict()
+        rank = lambda r: scene_rank(product_metadata(r), target_date)
+        for root in sorted(roots, key=rank):
+            for path in roots[root]:
+                bands.setdefault(band_name(path), []).append(path)
+    return groups
+
+def band_name(path):
+    """Nombre de la banda (p.ej. 'B61') de una banda ToA"""
+    return os.path.splitext(path.rsplit('_TOAR_', 1)[1])[0]
+
+def product_metadata(root):
+    product_id = os.path.basename(root)
+    return gapfill.parse_mtl(os.path.join(root, '{}_MTL.txt'.format(product_id)))
+
+def scene_rank(metadata, target_date=None):
+    """
+    Orden de preferencia entre escenas para el método `best`: si se pasa
+    +target_date+ (mes y día, 'MM-DD'), las más cercanas a ese día del año;
+    luego las de menor nubosidad, y luego las más antiguas
+
+    """
+    date = gapfill.acquisition_date(metadata)
+    days = 0
+    if target_date:
+        target = datetime.strptime('{}-{}'.format(date.year, target_date), '%Y-%m-%d')
+        days = abs((date - target).days)
+    return days, float(metadata.get('CLOUD_COVER', 0)), date
+
+def stack_rows(width, height, count, max_memory):
+    """
+    Cantidad de filas por franja para que +count+ escenas de +width+
+    columnas apiladas en float32 (más `window_overhead` arreglos float64) no
+    ocupen más de +max_memory+ MB.  Si +max_memory+ es None, devuelve
+    +height+.
+
+    """
+    if max_memory is None:
+        return height
+    row_bytes = width * (count * 4 + window_overhead * 8)
+    return min(max(int(max_memory * 1024 * 1024 // row_bytes), 1), height)
+
+def nan_median(stack):
+    """
+    Mediana de +stack+ a lo largo del primer eje, ignorando los NaN (NaN si
+    no hay ningún valor).  Reordena +stack+ in situ con una selección
+    parcial: sólo ubica en su lugar los valores del medio de cada píxel.
+
+    """
+    count = np.zeros(stack.shape[1:], dtype=np.intp)
+    for layer in stack:
+        count += ~np.isnan(layer)
+    # np.partition ubica los NaN al final, así que los valores válidos de
+    # cada píxel ocupan las primeras +count+ posiciones
+    low = np.maximum(count - 1, 0) // 2
+    high = count // 2
+    stack.partition(np.union1d(low, high), axis=0)
+    median = np.take_along_axis(stack, low[np.newaxis], axis=0)[0]
+    median += np.take_along_axis(stack, high[np.newaxis], axis=0)[0]
+    median /= 2
+    median[count == 0] = np.nan
+    return median
+
+def median_window(scenes, window):
+    """Mediana de +window+ de todas las escenas de +scenes+"""
+    stack = np.empty((len(scenes), window.height, window.width), dtype=np.float32)
+    for layer, scene in zip(stack, scenes):
+        layer[:] = read_warped(scene, window)
+    return nan_median(stack)
+
+def best_pixel_window(scenes, window):
+    """
+    Valor de +window+ de la primera escena de +scenes+ que tiene datos en
+    cada píxel
+
+    """
+    data = np.full((window.height, window.width), np.nan)
+    for scene in scenes:
+        missing = np.isnan(data)
+        if not missing.any():
+            break
+        values = read_warped(scene, window)
+        data[missing] = values[missing]
+    return data
+
+def composite_window(datasets, mask, method, thermal, window):
+    """
+    Compuesto de +window+ de las escenas abiertas en +datasets+, reescalado
+    y recortado con +mask+ (ver `post_process_toar.process_window`)
+
+    """
+    scenes = datasets.get()
+    if method == 'median':
+        data = median_window(scenes, window)
+    else:
+        data = best_pixel_window(scenes, window)
+    out = post_process_toar.rescale(data, np.isfinite(data), thermal)
+    out[~mask.window(window)] = 0
+    return window, out
+
+def composite_band(out_path, paths, shp_path, method='median',
+        profile=profiles.default_profile, threads=1, max_memory=max_memory_mb):
+    """
+    Escribe en +out_path+ el compuesto de las bandas ToA +paths+ (ordenadas
+    de mejor a peor escena) con el método +method+, sobre la grilla que
+    cubre el Shapefile +shp_path+.  Las franjas se reparten entre +threads+
+    threads, sin ocupar en total más de +max_memory+ MB.  La banda se guarda
+    con el perfil de almacenamiento +profile+ (ver `profiles`).
+
+    """
+    thermal = post_process_toar.is_thermal_band(paths[0])
+    with rasterio.open(paths[0]) as ref:
+        grid = aoi_grid(shp_path, ref.crs, ref.transform)
+        out_profile = profiles.raster_profile(ref.profile, profile,
+                'uint16' if thermal else 'uint8', nodata=0, **grid)
+    mask = grid_mask(shp_path, grid)
+    width, height = grid['width'], grid['height']
+
+    count = len(paths) if method == 'median' else 1
+    rows = stack_rows(width, height, count, thread_memory(max_memory, threads))
+    # Al menos una ventana por thread
+    rows = min(rows, -(-height // threads))
+
+    os.makedirs(os.path.dirname(out_path), exist_ok=True)
+    scene = os.path.basename(os.path.dirname(out_path))
+    with runlog.step('composite', scene=scene, band=os.path.basename(out_path),
+            method=method, scenes=len(paths)):
+        with WarpedDatasets(grid, *paths) as datasets, \
+                rasterio.open(out_path, 'w', **out_profile) as dst:
+            func = partial(composite_window, datasets, mask, method, thermal)
+            for window, out in map_windows(func,
+                    row_windows(width, height, rows), threads):
+                dst.write(out, 1, window=window)
+        profiles.finalize(out_path, profile)
+
+    print('{} written'.format(out_path))
+    return out_path
+
+def output_path(paths, out_dir, tag_name=None):
+    """Ruta del compuesto de +paths+ (ver `post_process_toar.get_output_path`)"""
+    return post_process_toar.get_output_path(paths[0], out_dir, tag_name=tag_name)
+
+def write_metadata(paths, out_dir, method, tag_name=None):
+    """
+    Escribe el `metadata.json` del compuesto, con el método y los metadatos
+    de cada escena usada (ver `download.write_metadata_file`)
+
+    """
+    scenes = []
+    for path in paths:
+        scene_dir = os.path.dirname(os.path.dirname(path))
+        md_path = os.path.join(scene_dir, post_process_toar.metadata_fname)
+        if os.path.exists(md_path):
+            with open(md_path) as f:
+                scenes.append(json.load(f))
+    dirname = os.path.dirname(output_path(paths, out_dir, tag_name=tag_name))
+    satsensor = os.path.basename(dirname)
+    year = os.path.basename(os.path.dirname(dirname))
+    fname = '{}_{}_{}'.format(year, satsensor, post_process_toar.metadata_fname)
+    if tag_name:
+        fname = '{}_{}'.format(tag_name, fname)
+    os.makedirs(dirname, exist_ok=True)
+    with open(os.path.join(dirname, fname), 'w') as f:
+        json.dump(dict(composite=method, scenes=scenes), f)
+
+def composite_units(groups, shp_path, out_dir, params, tag_name=None):
+    """Unidades de trabajo (ver `manifest.unit`) para cada banda de +groups+"""
+    units = []
+    for bands in groups.values():
+        for paths in bands.values():
+            units.append(unit(output_path(paths, out_dir, tag_name=tag_name),
+                paths + [shp_path], params,
+                output_path(paths, out_dir, tag_name=tag_name), paths))
+    return units
+
+
+if __name__ == '__main__':
+    import argparse
+    from blocks import threads_per_task
+
+    parser = argparse.ArgumentParser(
+            description='Genera compuestos anuales de imágenes ToA de Landsat',
+            formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+
+    parser.add_argument('shape_file', metavar='SHAPE_FILE')
+    parser.add_argument('--tag-name', '-t', nargs='?',
+            help='Nombre del conjunto de imágenes')
+    parser.add_argument('--input-dir', '-i', nargs='?', default='data/',
+            help='Ruta donde están almacenadas las imágenes (ToA)')
+    parser.add_argument('--output-dir', '-o', nargs='?', default='processed_data/',
+            help='Ruta donde se guardarán los compuestos')
+    parser.add_argument('--pattern', nargs='?', default='*_TOAR_*.TIF',
+            help='Patrón de los archivos a combinar')
+    parser.add_argument('--method', choices=methods, default='median',
+            help='"median": mediana de cada píxel; "best": píxel de la ' \
+                 'mejor escena con datos')
+    parser.add_argument('--target-date', metavar='MM-DD',
+            help='Con "best", prefiere las escenas más cercanas a este día del año')
+    parser.add_argument('--profile', choices=sorted(profiles.profiles),
+            default=profiles.default_profile,
+            help='Perfil de almacenamiento de las bandas (ver profiles.py)')
+    parser.add_argument('--max-memory', type=int, default=max_memory_mb,
+            help='Memoria máxima (MB) de las franjas en proceso de cada banda')
+    parser.add_argument('--threads', type=int,
+            help='Threads por banda (por defecto, según la cantidad de ' \
+                 'bandas y de núcleos)')
+    parser.add_argument('--force', action='store_true',
+            help='Recalcula todas las bandas, aunque ya estén al día')
+    parser.add_argument('--cpus', type=int,
+            help='Presupuesto de núcleos para procesos, threads y comandos ' \
+                 'externos (por defecto, todos los disponibles; ver budget.py)')
+    parser.add_argument('--run-log', metavar='RUN_LOG',
+            help='Registra cada paso en este log JSON-lines (ver runlog.py)')
+
+    args = parser.parse_args()
+    runlog.configure(args.run_log)
+    budget.configure(args.cpus)
+
+    if args.tag_name:
+        args.output_dir = os.path.join(args.output_dir, args.tag_name)
+
+    groups = annual_groups(args.input_dir, args.pattern,
+            target_date=args.target_date)
+
+    params = dict(method=args.method, target_date=args.target_date,
+            profile=args.profile)
+    units = composite_units(groups, args.shape_file, args.output_dir, params,
+            tag_name=args.tag_name)
+    worker = partial(composite_band, shp_path=args.shape_file,
+            method=args.method, profile=args.profile,
+            threads=args.threads or threads_per_task(len(units)),
+            max_memory=args.max_memory)
+    manifest = Manifest(os.path.join(args.output_dir, manifest_fname))
+    with budget.pool() as pool:
+        failed = run_units(worker, units, manifest, pool=pool,
+                force=args.force, name='composite')
+
+    for bands in groups.values():
+        paths = next(iter(bands.values()))
+        write_metadata(paths, args.output_dir, args.method, tag_name=args.tag_name)
+
+    runlog.print_summary()
+    if failed:
+        raise SystemExit(1)
@@ -10,14 +10,38 @@ Genera una serie de imágenes multibanda a partir de las bandas ya procesadas:
 
 """
 import glob
+import json
 import os
 import rasterio
 import shutil
-import subprocess
 import numpy as np
+from functools import partial
 from itertools import groupby
-import skimage.io
-import skimage.exposure
+from rio_color.operations import parse_operations
+from rio_color.utils import to_math_type, scale_dtype
+
+import budget
+import profiles
+import runlog
+import stats
+from blocks import ThreadDatasets, map_windows, memory_windows, thread_memory
+from inventory import open_inventory
+from manifest import Manifest, run_units, unit
+from pngstream import PNGWriter
+
+# Memoria máxima (MB) que usa create_rgb_image para cada ventana de las tres
+# bandas.  Con None lee y escribe las bandas completas.
+max_memory_mb = 64
+
+# Corrección de color que se aplica a todas las imágenes, en la sintaxis de
+# `rio color`
+color_operations = 'sigmoidal RGB 5 0.1 gamma R 1.06 gamma G 1.08 gamma B 1.02 saturation 1.2'
+
+# La corrección de color trabaja en float64 sobre las tres bandas y hace
+# copias intermedias: se reservan 4 copias de 8 bytes por banda y píxel
+color_bands = 3 * 8 * 4
+
+manifest_fname = '.create_rgb_images.manifest.json'
 
 band_combinations = {
     'LANDSAT_5-TM':       (3, 2, 1),
@@ -25,53 +49,319 @@ band_combinations = {
     'LANDSAT_8-OLI_TIRS': (4, 3, 2),
 }
 
-def process_reference_image(root):
-    out_path = create_rgb_image(root)
-    #rescale_intensity(out_path)
-    correct_color(out_path)
-    export_png(out_path)
-
-def process_image(ref_scene, root, match_histogram=False):
-    out_path = create_rgb_image(root)
-    ref_path = glob.glob(os.path.join(ref_scene, 'rgb_preview.tif'))[0]
-    #rescale_intensity(out_path)
-    correct_color(out_path)
-    if match_histogram:
-        apply_histogram_matching(out_path, ref_path)
-    export_png(out_path)
+def process_reference_image(root, engine='fused', max_memory=max_memory_mb,
+        profile=profiles.default_profile, threads=1):
+    with runlog.step('rgb', scene=scene_name(root), reference=True):
+        if engine == 'fused':
+            create_preview(root, max_memory=max_memory, profile=profile,
+                    threads=threads)
+            return
+        out_path = create_rgb_image(root, max_memory=max_memory, profile=profile,
+                threads=threads)
+        #rescale_intensity(out_path)
+        correct_color(out_path)
+        export_png(out_path)
+        profiles.finalize(out_path, profile)
+
+def process_image(ref_scene, root, match_histogram=False, ref_hist=None,
+        hist_decimation=1, engine='fused', max_memory=max_memory_mb,
+        profile=profiles.default_profile, threads=1):
+    with runlog.step('rgb', scene=scene_name(root)):
+        ref_path = glob.glob(os.path.join(ref_scene, 'rgb_preview.tif'))[0]
+        if engine == 'fused':
+            if not match_histogram:
+                ref_hist = None
+            elif ref_hist is None:
+                ref_hist = reference_histogram(ref_path, decimation=hist_decimation)
+            create_preview(root, ref_hist=ref_hist, hist_decimation=hist_decimation,
+                    max_memory=max_memory, profile=profile, threads=threads)
+            return
+        out_path = create_rgb_image(root, max_memory=max_memory, profile=profile,
+                threads=threads)
+        #rescale_intensity(out_path)
+        correct_color(out_path)
+        if match_histogram:
+            apply_histogram_matching(out_path, ref_path)
+        export_png(out_path)
+        profiles.finalize(out_path, profile)
+
+def scene_name(root):
+    """Nombre de la escena de +root+ para el log (año/satsensor)"""
+    return '/'.join(root.rstrip(os.path.sep).split(os.path.sep)[-2:])
 
 def get_band_filenames(root):
     satsensor = root.split(os.path.sep)[-1]
     bands = band_combinations[satsensor]
     return [glob.glob(os.path.join(root, '*_B{}.TIF'.format(n)))[0] for n in bands]
 
-def create_rgb_image(root):
-    """Crea una imagen GeoTIFF multibanda RGB usando las bandas RGB"""
-    r_fn, g_fn, b_fn = get_band_filenames(root)
-    out_path = os.path.join(root, 'rgb_preview.tif')
-    with rasterio.open(r_fn) as r, rasterio.open(g_fn) as g, rasterio.open(b_fn) as b:
-        profile = r.profile
-        profile.update(count=3, compress='lzw')
-        with rasterio.open(out_path, 'w', **profile) as dst:
-            dst.write(r.read(1), 1)
-            dst.write(g.read(1), 2)
-            dst.write(b.read(1), 3)
-    print('{} written'.format(out_path))
-    return out_path
+def create_rgb_image(root, max_memory=max_memory_mb,
+        profile=profiles.default_profile, threads=1):
+    """
+    Crea una imagen GeoTIFF multibanda RGB usando las bandas RGB
+
+    Lee y escribe por franjas de filas, de forma que nunca haya más de
+    +max_memory+ MB de las tres bandas en memoria.  Las franjas se leen en
+    +threads+ threads.  La imagen se guarda con el perfil de almacenamiento
+    +profile+ (ver `profiles`).
+
+    """
+    with runlog.step('create_rgb_image', scene=scene_name(root)):
+        r_fn, g_fn, b_fn = get_band_filenames(root)
+        out_path = os.path.join(root, 'rgb_preview.tif')
+        with gdal_cache_env(max_memory), rasterio.open(r_fn) as r, \
+                ThreadDatasets(r_fn, g_fn, b_fn) as datasets:
+            out_profile = profiles.raster_profile(r.profile, profile, r.dtypes[0],
+                    count=3)
+            windows = memory_windows(r, 3, thread_memory(max_memory, threads))
+            with rasterio.open(out_path, 'w', **out_profile) as dst:
+                for window, rgb in map_windows(partial(read_rgb, datasets),
+                        windows, threads):
+                    dst.write(rgb, window=window)
+        print('{} written'.format(out_path))
+        return out_path
+
+def create_preview(root, ref_hist=None, hist_decimation=1,
+        max_memory=max_memory_mb, profile=profiles.default_profile, threads=1):
+    """
+    Genera `rgb_preview.tif` y `rgb_preview.png` a partir de las bandas RGB,
+    en una sola pasada de lectura y escritura por ventanas.
+
+    Aplica la misma corrección de color que `correct_color`, y si se pasa el
+    histograma +ref_hist+ de una imagen de referencia (ver `image_histogram`),
+    la especificación de histograma de `apply_histogram_matching`.  En ese
+    caso hace antes una pasada de sólo lectura para calcular el histograma de
+    la imagen corregida, sobre una muestra de 1 de cada +hist_decimation+
+    píxeles por lado (ver `stats`).  Las ventanas se corrigen en +threads+
+    threads, sin superar +max_memory+ MB entre todas.  El GeoTIFF se guarda
+    con el perfil de almacenamiento +profile+ (ver `profiles`).
+
+    """
+    with runlog.step('create_preview', scene=scene_name(root)):
+        r_fn, g_fn, b_fn = get_band_filenames(root)
+        out_path = os.path.join(root, 'rgb_preview.tif')
+        png_path = os.path.join(root, 'rgb_preview.png')
+        with gdal_cache_env(max_memory), \
+                rasterio.open(r_fn) as r, rasterio.open(g_fn) as g, rasterio.open(b_fn) as b:
+            srcs = (r, g, b)
+            nodata = r.nodata
+
+            luts = None
+            if ref_hist is not None:
+                src_hist = np.zeros((3, 256), dtype=np.int64)
+                for rgb in color_corrected_samples(srcs, hist_decimation, max_memory):
+                    src_hist += rgb_histogram(rgb, nodata)
+                luts = matching_luts(src_hist, ref_hist)
+
+            out_profile = profiles.raster_profile(r.profile, profile, r.dtypes[0],
+                    count=3)
+            with rasterio.open(out_path, 'w', **out_profile) as dst, \
+                    PNGWriter(png_path, r.width, r.height,
+                            alpha=nodata is not None) as png:
+                # La transparencia sale de la máscara y no de un color, porque
+                # `png_scale` lleva el valor válido 1 a 0
+                for window, rgb in color_corrected_windows(srcs, max_memory,
+                        threads=threads, luts=luts):
+                    dst.write(rgb, window=window)
+                    mask = valid_pixels(rgb, nodata) if nodata is not None else None
+                    png.write(png_scale(rgb), mask=mask)
+        profiles.finalize(out_path, profile)
+
+        print('{} written'.format(out_path))
+        print('{} written'.format(png_path))
+        return out_path
+
+def read_rgb(datasets, window):
+    """Lee una ventana de las bandas RGB abiertas en +datasets+"""
+    srcs = datasets.get()
+    rgb = np.empty((3, window.height, window.width), dtype=srcs[0].dtypes[0])
+    for i, src in enumerate(srcs):
+        src.read(1, window=window, out=rgb[i])
+    return window, rgb
+
+def color_corrected_window(datasets, luts, nodata, window):
+    """
+    Lee una ventana de las bandas RGB abiertas en +datasets+, le corrige el
+    color y le aplica las tablas de `matching_luts`, si se pasan
+
+    """
+    window, rgb = read_rgb(datasets, window)
+    rgb = color_correct(rgb)
+    if luts is not None:
+        rgb = apply_luts(rgb, luts, nodata)
+    return window, rgb
+
+def color_corrected_windows(srcs, max_memory, threads=1, luts=None):
+    """
+    Lee las bandas RGB de +srcs+ por ventanas y les corrige el color (y les
+    aplica +luts+, ver `matching_luts`).  Las ventanas se procesan en
+    +threads+ threads y se devuelven en orden.
+
+    """
+    first = srcs[0]
+    windows = memory_windows(first, color_bands, thread_memory(max_memory, threads))
+    with ThreadDatasets(*(src.name for src in srcs)) as datasets:
+        func = partial(color_corrected_window, datasets, luts, first.nodata)
+        for window, rgb in map_windows(func, windows, threads):
+            yield window, rgb
+
+def color_corrected_samples(srcs, decimation, max_memory):
+    """
+    Como `color_corrected_windows`, pero toma 1 de cada +decimation+ píxeles
+    por lado, para calcular estadísticas.
+
+    """
+    band_memory = max_memory / 3 if max_memory is not None else None
+    samples = [stats.sampled_windows(src, [1], decimation, band_memory)
+            for src in srcs]
+    for bands in zip(*samples):
+        yield color_correct(np.concatenate(bands))
+
+def color_correct(rgb):
+    """Aplica `color_operations` a un bloque RGB, igual que `rio color`"""
+    arr = to_math_type(rgb)
+    for func in parse_operations(color_operations):
+        arr = func(arr)
+    return scale_dtype(arr, rgb.dtype)
+
+def valid_pixels(rgb, nodata):
+    """Píxeles válidos: los que no son nodata en todas las bandas"""
+    if nodata is None:
+        return np.ones(rgb.shape[1:], dtype=bool)
+    return (rgb != nodata).any(axis=0)
+
+def rgb_histogram(rgb, nodata):
+    """Histograma de 256 niveles de cada banda de un bloque RGB de 8 bits"""
+    valid = valid_pixels(rgb, nodata)
+    return np.stack([np.bincount(band[valid], minlength=256) for band in rgb])
 
-def rescale_intensity(path):
-    img = skimage.io.imread(path)
-    low, high = np.percentile(img, (3, 97))
-    img = skimage.exposure.rescale_intensity(img, in_range=(low, high))
-    skimage.io.imsave(path, img)
+def image_histogram(path, decimation=1, max_memory=max_memory_mb):
+    """Histograma de 256 niveles de cada banda de una imagen RGB de 8 bits"""
+    hist = stats.raster_histogram(path, bands=[1, 2, 3], decimation=decimation,
+            mask='dataset', max_memory=max_memory)
+    return hist.counts
+
+def histogram_sidecar_path(path):
+    fname, _ = os.path.splitext(path)
+    return '{}_hist.json'.format(fname)
+
+def reference_histogram(ref_path, decimation=1, max_memory=max_memory_mb):
+    """
+    Devuelve el histograma de la imagen de referencia +ref_path+.
+
+    El histograma se guarda en un archivo JSON junto a la imagen (ver
+    `histogram_sidecar_path`), y se reutiliza mientras la imagen no cambie.
+
+    """
+    sidecar_path = histogram_sidecar_path(ref_path)
+    stat = os.stat(ref_path)
+    if os.path.exists(sidecar_path):
+        hist = load_histogram(sidecar_path)
+        source = hist['source']
+        if source['size'] == stat.st_size and source['mtime'] == stat.st_mtime \
+                and source.get('decimation', 1) == decimation:
+            return hist['counts']
+
+    counts = image_histogram(ref_path, decimation=decimation, max_memory=max_memory)
+    save_histogram(sidecar_path, counts,
+            source=dict(path=os.path.basename(ref_path),
+                size=stat.st_size, mtime=stat.st_mtime, decimation=decimation))
+    print('{} written'.format(sidecar_path))
+    return counts
+
+def save_histogram(path, counts, source):
+    """Guarda el histograma por banda +counts+ en un archivo JSON"""
+    with open(path, 'w') as f:
+        json.dump(dict(color_space='RGB', bands=[1, 2, 3], source=source,
+            counts=counts.tolist()), f)
+
+def load_histogram(path):
+    """Lee un histograma guardado con `save_histogram`"""
+    with open(path) as f:
+        hist = json.load(f)
+    hist['counts'] = np.array(hist['counts'], dtype=np.int64)
+    return hist
+
+def matching_lut(src_counts, ref_counts):
+    """
+    Tabla de 256 valores que lleva el histograma +src_counts+ al histograma
+    +ref_counts+.  Hace el mismo cálculo que `rio hist -c RGB`: interpola, para
+    cada nivel de la imagen, el valor de la referencia con igual cuantil.
+
+    """
+    levels = np.arange(256)
+    src_present, ref_present = src_counts > 0, ref_counts > 0
+    src_quantiles = np.cumsum(src_counts[src_present]).astype(np.float64) / src_counts.sum()
+    ref_quantiles = np.cumsum(ref_counts[ref_present]).astype(np.float64) / ref_counts.sum()
+    ref_values = levels[ref_present].astype(np.float64) / 255
+
+    lut = levels.astype(np.uint8)
+    matched = np.interp(src_quantiles, ref_quantiles, ref_values)
+    lut[src_present] = (matched * 255).astype(np.uint8)
+    return lut
+
+def matching_luts(src_hist, ref_hist):
+    return np.stack([matching_lut(s, r) for s, r in zip(src_hist, ref_hist)])
+
+def apply_luts(rgb, luts, nodata):
+    """Aplica una tabla por banda, y deja en nodata los píxeles no válidos"""
+    out = np.stack([lut[band] for lut, band in zip(luts, rgb)])
+    if nodata is not None:
+        out[:, ~valid_pixels(rgb, nodata)] = nodata
+    return out
+
+def png_scale(rgb):
+    """Reescala de 1..255 a 0..255, como `gdal_translate -scale 1 255`"""
+    scaled = (rgb.astype(np.float64) - 1) * 255 / 254
+    return np.clip(np.rint(scaled), 0, 255).astype(np.uint8)
+
+def gdal_cache_env(max_memory):
+    """
+    Limita el caché de bloques de GDAL a +max_memory+ MB.  Sin este límite
+    GDAL puede retener en caché una fracción importante de la imagen.
+
+    """
+    if max_memory is None:
+        return rasterio.Env()
+    return rasterio.Env(GDAL_CACHEMAX=max_memory)
+
+def rescale_intensity(path, percentiles=(3, 97), decimation=1,
+        max_memory=max_memory_mb):
+    """
+    Estira el contraste de la imagen entre dos percentiles, calculados sobre
+    todas las bandas juntas.
+
+    Los percentiles salen del histograma de `stats`, que se guarda junto a la
+    imagen, así que probar otros percentiles no vuelve a leer los píxeles.
+
+    """
+    hist = stats.cached_histogram(path, decimation=decimation, mask='dataset',
+            max_memory=max_memory)
+    low, high = (hist.percentile(q).value for q in percentiles)
+
+    tmp_path = path + '.tmp'
+    with rasterio.open(path) as src:
+        profile = src.profile
+        max_value = np.iinfo(src.dtypes[0]).max
+        with rasterio.open(tmp_path, 'w', **profile) as dst:
+            for window in memory_windows(src, src.count * 8, max_memory):
+                img = src.read(window=window).astype(np.float64)
+                img = (np.clip(img, low, high) - low) / max(high - low, 1) * max_value
+                dst.write(img.astype(src.dtypes[0]), window=window)
+    shutil.move(tmp_path, path)
     print('{} rescaled intensity'.format(path))
 
 def correct_color(in_path):
-    """Aplica una corrección de gamma y saturación para mejorar el contraste"""
+    """
+    Aplica una corrección de gamma y saturación para mejorar el contraste.
+    `rio color` usa los núcleos libres del presupuesto (ver `budget`).
+
+    """
     tmp_path = in_path + '.tmp'
-    cmd = 'rio color -j -1 {src} {dst} ' \
-          'sigmoidal RGB 5 0.1 gamma R 1.06 gamma G 1.08 gamma B 1.02 saturation 1.2'.format(src=in_path, dst=tmp_path)
-    subprocess.run(cmd, shell=True)
+    with runlog.step('correct_color', scene=scene_name(os.path.dirname(in_path))), \
+            budget.reserve(budget.cpus()) as jobs:
+        cmd = 'rio color -j {jobs} {src} {dst} {ops}'.format(
+                jobs=jobs, src=in_path, dst=tmp_path, ops=color_operations)
+        runlog.run(cmd, env=budget.thread_env(jobs))
     shutil.move(tmp_path, in_path)
     print('{} color corrected'.format(in_path))
 
@@ -81,7 +371,8 @@ def apply_histogram_matching(in_path, ref_path):
     cmd = 'rio hist ' \
           '-c RGB -b 1,2,3 ' \
           '{src} {ref} {dst}'.format(src=in_path, ref=ref_path, dst=tmp_path)
-    subprocess.run(cmd, shell=True)
+    with runlog.step('apply_histogram_matching', scene=scene_name(os.path.dirname(in_path))):
+        runlog.run(cmd)
     shutil.move(tmp_path, in_path)
     print('{} applied histogram matching using {}'.format(in_path, ref_path))
 
@@ -94,60 +385,40 @@ def export_png(in_path):
           '-scale_1 1 255 ' \
           '-scale_2 1 255 ' \
           '-scale_3 1 255'.format(src=in_path, dst=out_path)
-    subprocess.run(cmd, shell=True)
+    with runlog.step('export_png', scene=scene_name(os.path.dirname(in_path))):
+        runlog.run(cmd)
     print('{} written'.format(out_path))
 
-def create_animations_per_satsensor(input_dir, **kwargs):
-    """Crea GIFs animados a partir de los previews RGB de cada satélite"""
+def create_animations_per_satsensor(input_dir, fmt='gif', **kwargs):
+    """
+    Crea animaciones a partir de los previews RGB de cada satélite (ver
+    `animation.create_animation`)
 
-    def sortkey(fname):
-        """Ordena por (satsensor, year)"""
-        ps = fname.split(os.path.sep)
-        return (ps[-2], ps[-3])
+    """
+    from animation import create_animation
 
-    files = sorted(rgb_preview_files(input_dir), key=sortkey)
-    for satsensor, files in groupby(files, lambda f: f.split(os.path.sep)[-2]):
-        gif_path = os.path.join(input_dir, 'rgb_{}.gif'.format(satsensor))
-        create_animation(files, gif_path, **kwargs)
-        print('{} written'.format(gif_path))
+    # Ordena por (satsensor, year)
+    files = sorted(open_inventory(input_dir).files('rgb_preview'),
+            key=lambda f: (f['satsensor'], f['year']))
+    for satsensor, files in groupby(files, lambda f: f['satsensor']):
+        out_path = os.path.join(input_dir, 'rgb_{}.{}'.format(satsensor, fmt))
+        with runlog.step('animation', scene=satsensor, format=fmt):
+            create_animation([f['path'] for f in files], out_path, fmt=fmt,
+                    **kwargs)
+        print('{} written'.format(out_path))
 
 def rgb_preview_files(input_dir):
-    for root, dirs, files in os.walk(input_dir):
-        if files:
-            for fname in glob.glob(os.path.join(root, 'rgb_preview.png')):
-                yield fname
-
-def create_animation(files, output_path, **kwargs):
-    import imageio
-
-    frames = []
-    for fname in files:
-        frame = imageio.imread(fname)
-        year = fname.split(os.path.sep)[-3]
-        annotated_frame = annotate_image(frame, year)
-        frames.append(annotated_frame)
-    imageio.mimsave(output_path, frames, format='GIF', **kwargs)
-
-def annotate_image(img_array, year):
-    from PIL import Image, ImageDraw, ImageFont
-
-    img = Image.fromarray(img_array)
-    draw = ImageDraw.Draw(img)
-    font = ImageFont.truetype("/usr/share/fonts/truetype/roboto/hinted/Roboto-Bold.ttf", 32, encoding="unic")
-    draw.text((img.width - 85, img.height - 55), year, (255, 255, 255), font=font)
-    new_img_array = np.array(img.getdata(), dtype=np.uint8).reshape(img_array.shape)
-    return new_img_array
+    """Previews RGB de +input_dir+ (ver `inventory`)"""
+    return open_inventory(input_dir).paths('rgb_preview')
 
 def all_scenes(input_dir):
-    for root, dirs, files in os.walk(input_dir):
-        if files and glob.glob(os.path.join(root, '*.TIF')):
-            yield root
+    """Directorios `año/satsensor` de +input_dir+ con bandas post-procesadas"""
+    return open_inventory(input_dir).dirs('band')
 
 
 if __name__ == '__main__':
     import argparse
-    import multiprocessing
-    from functools import partial
+    from blocks import threads_per_task
 
     parser = argparse.ArgumentParser(
             description='Genera imágenes RGB a partir de bandas procesadas de Landsat',
@@ -157,23 +428,100 @@ if __name__ == '__main__':
             help='Ruta donde están almacenadas las imágenes')
     parser.add_argument('--match-histogram', action='store_true', default=False,
             help='Aplica especificación de histograma a todas las imágenes')
+    parser.add_argument('--hist-decimation', type=int, default=1,
+            help='Calcula los histogramas sobre 1 de cada N píxeles por lado ' \
+                 '(o sobre los overviews, si existen)')
+    parser.add_argument('--reference-hist', metavar='HIST_JSON',
+            help='Histograma de referencia ya calculado (por ejemplo, ' \
+                 'rgb_preview_hist.json de una corrida anterior)')
     parser.add_argument('--create-gif', action='store_true', default=False,
-            help='Genera una animación gif de las imágenes año por año, para cada sensor')
+            help='Genera una animación de las imágenes año por año, para cada sensor')
+    parser.add_argument('--animation-format', choices=('gif', 'mp4', 'webm'),
+            default='gif', help='Formato de la animación (mp4 y webm requieren imageio-ffmpeg)')
+    parser.add_argument('--max-memory', type=int, default=max_memory_mb,
+            help='Memoria máxima (MB) por proceso para componer las imágenes RGB')
+    parser.add_argument('--engine', choices=('fused', 'cli'), default='fused',
+            help='Motor de corrección de color: "fused" compone, corrige y ' \
+                 'exporta en una sola pasada; "cli" usa rio color, rio hist ' \
+                 'y gdal_translate')
+    parser.add_argument('--profile', choices=sorted(profiles.profiles),
+            default=profiles.default_profile,
+            help='Perfil de almacenamiento de rgb_preview.tif (ver profiles.py)')
+    parser.add_argument('--force', action='store_true',
+            help='Regenera todas las imágenes, aunque ya estén al día')
+    parser.add_argument('--threads', type=int,
+            help='Threads por imagen (por defecto, según la cantidad de ' \
+                 'imágenes y de núcleos)')
+    parser.add_argument('--cpus', type=int,
+            help='Presupuesto de núcleos para procesos, threads y comandos ' \
+                 'externos (por defecto, todos los disponibles; ver budget.py)')
+    parser.add_argument('--run-log', metavar='RUN_LOG',
+            help='Registra cada paso en este log JSON-lines (ver runlog.py)')
 
     args = parser.parse_args()
+    runlog.configure(args.run_log)
+    budget.configure(args.cpus)
+
+    # Sólo se regeneran las imágenes cuyas bandas o parámetros cambiaron
+    manifest = Manifest(os.path.join(args.input_dir, manifest_fname))
+    params = dict(engine=args.engine, color_operations=color_operations,
+            profile=args.profile)
+
+    def scene_unit(root, params, extra_inputs=()):
+        out_path = os.path.join(root, 'rgb_preview.tif')
+        inputs = sorted(glob.glob(os.path.join(root, '*.TIF'))) + list(extra_inputs)
+        return unit(out_path, inputs, params, root)
 
     # Primero procesa la imagen de referencia para la especificación de histograma
     all_scenes = list(all_scenes(args.input_dir))
-    ref_scene, other_scenes = all_scenes[0], all_scenes[1:-1]
-    process_reference_image(ref_scene)
+    ref_scene, other_scenes = all_scenes[0], all_scenes[1:]
+    # La imagen de referencia se procesa sola, con todos los núcleos
+    ref_worker = partial(process_reference_image, engine=args.engine,
+            max_memory=args.max_memory, profile=args.profile,
+            threads=args.threads or threads_per_task(1))
+    if run_units(ref_worker, [scene_unit(ref_scene, params)], manifest,
+            force=args.force, name='reference image'):
+        runlog.print_summary()
+        raise SystemExit(1)
+
+    # El histograma de referencia se calcula una sola vez y se comparte con
+    # todos los procesos
+    ref_hist = None
+    if args.match_histogram and args.engine == 'fused':
+        if args.reference_hist:
+            ref_hist = load_histogram(args.reference_hist)['counts']
+        else:
+            ref_path = os.path.join(ref_scene, 'rgb_preview.tif')
+            ref_hist = reference_histogram(ref_path,
+                    decimation=args.hist_decimation, max_memory=args.max_memory)
+
+    # Si se especifica el histograma, las imágenes dependen de la referencia
+    extra_inputs = []
+    if args.match_histogram:
+        params = dict(params, match_histogram=True,
+                hist_decimation=args.hist_decimation)
+        extra_inputs = [args.reference_hist or
+                os.path.join(ref_scene, 'rgb_preview.tif')]
 
     # Luego procesa todas las imagenes
-    count = multiprocessing.cpu_count()
-    with multiprocessing.Pool(count) as pool:
+    with budget.pool() as pool:
         worker = partial(process_image, ref_scene,
-                match_histogram=args.match_histogram)
-        pool.map(worker, other_scenes)
+                match_histogram=args.match_histogram,
+                ref_hist=ref_hist,
+                hist_decimation=args.hist_decimation,
+                engine=args.engine,
+                max_memory=args.max_memory,
+                profile=args.profile,
+                threads=args.threads or threads_per_task(len(other_scenes)))
+        units = [scene_unit(root, params, extra_inputs) for root in other_scenes]
+        failed = run_units(worker, units, manifest, pool=pool,
+                force=args.force, name='create_rgb_images')
 
     # Crea gifs animados de los previews RGB, por satélite
     if args.create_gif:
-        create_animations_per_satsensor(args.input_dir, duration=0.1)
+        create_animations_per_satsensor(args.input_dir, duration=0.1,
+                fmt=args.animation_format)
+
+    runlog.print_summary()
+    if failed:
+        raise SystemExit(1)
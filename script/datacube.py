@@ -0,0 +1,384 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Exporta las bandas procesadas de todos los años a un cubo de datos
+(tiempo x banda x fila x columna) en un archivo `.npy`, que se lee con
+memory-mapping, para consultar series de tiempo de un píxel o de una ventana
+sin abrir ni decodificar un GeoTIFF por año y banda.
+
+```
+cube/
+    cube.json       índice: grilla, bandas, fechas y metadatos de cada año
+    cube.npy        bandas (UInt8, como en `post_process_toar.py`)
+    ndvi.npy        índices derivados (float32, NaN sin datos)
+    ndbi.npy
+```
+
+Cada año y sensor de `processed_data/` (ver `post_process_toar.py` y
+`composite.py`) es un paso de tiempo, ordenados por año y fecha, con los
+metadatos de su `metadata.json`.  Las bandas se identifican por su rango
+espectral (`bands`), así que se pueden comparar Landsat 5, 7 y 8.  Todos los
+años se reproyectan (con vecino más cercano) a una grilla común, alineada a
+la del primero, que cubre a todos.
+
+El cubo se guarda en bloques de `block_rows` filas: el arreglo tiene forma
+(bloque, tiempo, banda, fila, columna), así que la serie de tiempo de un
+píxel está dentro de un solo bloque, y una ventana que no cruza bloques es
+una vista del archivo mapeado en memoria, sin copias (ver `Datacube`).  Los
+índices (`indices`) se calculan para todo el cubo de a un bloque por vez,
+vectorizados sobre todos los años.
+
+"""
+import json
+import os
+from functools import partial
+
+import numpy as np
+import rasterio
+from rasterio.crs import CRS
+from rasterio.transform import Affine
+from rasterio.warp import transform_bounds
+from rasterio.windows import Window
+from rasterio.windows import transform as window_transform
+
+import budget
+import post_process_toar
+import runlog
+from blocks import WarpedDatasets, map_windows, threads_per_task
+from inventory import open_inventory
+from manifest import Manifest, run_units, unit
+
+index_fname = 'cube.json'
+cube_fname = 'cube.npy'
+manifest_fname = '.datacube.manifest.json'
+
+# Bandas del cubo, por rango espectral, y la banda de cada sensor
+bands = ('blue', 'green', 'red', 'nir', 'swir1', 'swir2')
+band_numbers = {
+    'LANDSAT_5-TM':       (1, 2, 3, 4, 5, 7),
+    'LANDSAT_7-ETM':      (1, 2, 3, 4, 5, 7),
+    'LANDSAT_8-OLI_TIRS': (2, 3, 4, 5, 6, 7),
+}
+
+# Índices de diferencia normalizada (a - b) / (a + b)
+indices = {
+    'ndvi': ('nir', 'red'),
+    'ndbi': ('swir1', 'nir'),
+}
+
+# Filas de cada bloque del cubo
+block_rows = 256
+
+def year_dirs(input_dir):
+    """
+    Directorios `año/satsensor` de +input_dir+, con su año, satsensor y
+    metadatos (el `metadata.json` copiado por `post_process_toar.py` o
+    escrito por `composite.py`), ordenados por año y fecha
+
+    """
+    steps = []
+    for root, files in open_inventory(input_dir).groups('band'):
+        satsensor, year = files[0]['satsensor'], files[0]['year']
+        if satsensor not in band_numbers:
+            continue
+        metadata = read_metadata(root)
+        steps.append(dict(root=root, year=year, satsensor=satsensor,
+            dates=sensing_dates(metadata), metadata=metadata))
+    return sorted(steps, key=lambda s: (s['year'], s['dates'], s['satsensor']))
+
+def read_metadata(root):
+    fnames = [f for f in os.listdir(root)
+              if f.endswith(post_process_toar.metadata_fname)]
+    if not fnames:
+        return {}
+    with open(os.path.join(root, sorted(fnames)[0])) as f:
+        return json.load(f)
+
+def sensing_dates(metadata):
+    """Fechas (AAAA-MM-DD) de las escenas de un `metadata.json`"""
+    scenes = metadata.get('scenes', [metadata])
+    return sorted(s['sensing_time'][:10] for s in scenes if 'sensing_time' in s)
+
+def band_path(root, satsensor, band):
+    """Ruta de la banda +band+ (p.ej. 'nir') en +root+, o None si no está"""
+    number = band_numbers[satsensor][bands.index(band)]
+    for fname in sorted(os.listdir(root)):
+        if fname.endswith('_B{}.TIF'.format(number)):
+            return os.path.join(root, fname)
+    return None
+
+def common_grid(paths):
+    """
+    Grilla (ver `blocks.dataset_grid`) alineada a la de la primera imagen de
+    +paths+, en su CRS y resolución, que cubre a todas
+
+    """
+    with rasterio.open(paths[0]) as ref:
+        crs, transform = ref.crs, ref.transform
+    xs, ys = [], []
+    for path in paths:
+        with rasterio.open(path) as src:
+            west, south, east, north = transform_bounds(src.crs, crs, *src.bounds)
+        xs += [west, east]
+        ys += [south, north]
+    # Los bordes de las imágenes caen sobre bordes de píxeles de la grilla
+    (left, right), (top, bottom) = ((int(round(a)), int(round(b))) for a, b in
+            zip(~transform * (min(xs), max(ys)), ~transform * (max(xs), min(ys))))
+    window = Window(left, top, right - left, bottom - top)
+    return dict(crs=crs, transform=window_transform(window, transform),
+            width=window.width, height=window.height)
+
+def reflectance(codes):
+    """
+    Reflectancia (float32, NaN sin datos) de los valores UInt8 del cubo,
+    invirtiendo `post_process_toar.rescale`
+
+    """
+    values = codes.astype(np.float32)
+    values -= 1
+    values /= 254
+    values[codes == 0] = np.nan
+    return values
+
+def normalized_difference(a, b):
+    """(a - b) / (a + b), con NaN donde falta alguno o la suma es 0"""
+    with np.errstate(divide='ignore', invalid='ignore'):
+        result = (a - b) / (a + b)
+    result[~np.isfinite(result)] = np.nan
+    return result
+
+def load_band(cube, grid, t, b, path):
+    """Reproyecta la banda +path+ a +grid+ y la escribe en cube[:, t, b]"""
+    with WarpedDatasets(grid, path) as datasets:
+        (_, vrt), = datasets.get()
+        height = grid['height']
+        for k in range(cube.shape[0]):
+            rows = min(cube.shape[3], height - k * cube.shape[3])
+            window = Window(0, k * cube.shape[3], grid['width'], rows)
+            # Se lee directo al archivo mapeado, sin copias intermedias
+            vrt.read(1, window=window, out=cube[k, t, b, :rows])
+    return path
+
+def compute_index(cube, out, name):
+    """Calcula el índice +name+ para todos los años, de a un bloque"""
+    a, b = (bands.index(band) for band in indices[name])
+    for k in range(cube.shape[0]):
+        out[k] = normalized_difference(reflectance(cube[k, :, a]),
+                reflectance(cube[k, :, b]))
+
+def export(input_dir, out_dir, threads=1, block_rows=block_rows):
+    """
+    Exporta todos los años de +input_dir+ al cubo de +out_dir+, y calcula
+    los índices.  Las bandas se cargan en +threads+ threads.
+
+    """
+    steps = year_dirs(input_dir)
+    if not steps:
+        raise ValueError('No hay bandas procesadas en {}'.format(input_dir))
+    tasks = [(t, b, band_path(s['root'], s['satsensor'], band))
+             for t, s in enumerate(steps) for b, band in enumerate(bands)]
+    tasks = [task for task in tasks if task[2]]
+    grid = common_grid([path for _, _, path in tasks])
+
+    os.makedirs(out_dir, exist_ok=True)
+    n_blocks = -(-grid['height'] // block_rows)
+    with runlog.step('datacube', steps=len(steps), width=grid['width'],
+            height=grid['height']):
+        # Los píxeles sin datos (o de bandas que no están) quedan en 0
+        cube = np.lib.format.open_memmap(os.path.join(out_dir, cube_fname),
+                mode='w+', dtype=np.uint8,
+                shape=(n_blocks, len(steps), len(bands), block_rows, grid['width']))
+        func = lambda task: load_band(cube, grid, *task)
+        for path in map_windows(func, tasks, threads):
+            print('{} loaded'.format(path))
+
+        for name in sorted(indices):
+            out = np.lib.format.open_memmap(os.path.join(out_dir, name + '.npy'),
+                    mode='w+', dtype=np.float32,
+                    shape=(n_blocks, len(steps), block_rows, grid['width']))
+            compute_index(cube, out, name)
+            out.flush()
+            del out
+        cube.flush()
+        del cube
+
+    info = dict(crs=grid['crs'].to_wkt(), transform=list(grid['transform'])[:6],
+            width=grid['width'], height=grid['height'], block_rows=block_rows,
+            bands=list(bands), indices=sorted(indices), nodata=0,
+            times=[dict((k, s[k]) for k in ('year', 'satsensor', 'dates', 'metadata'))
+                   for s in steps])
+    # El índice se escribe último: si existe, el cubo está completo
+    tmp_path = os.path.join(out_dir, index_fname + '.tmp')
+    with open(tmp_path, 'w') as f:
+        json.dump(info, f, indent=1)
+    os.replace(tmp_path, os.path.join(out_dir, index_fname))
+    print('{} written'.format(out_dir))
+    return out_dir
+
+class Datacube:
+    """
+    Cubo exportado en +path+, mapeado en memoria (sólo lectura).
+
+    `pixel` y `window` devuelven los valores UInt8 (ver `reflectance`) con
+    forma (tiempo, banda, ...), o (tiempo, ...) si se pide una banda o un
+    índice.  Son vistas del archivo, sin copias, salvo que la ventana cruce
+    bloques (ver `block_windows`).
+
+    """
+    def __init__(self, path):
+        self.path = path
+        with open(os.path.join(path, index_fname)) as f:
+            self.info = json.load(f)
+        self.data = np.load(os.path.join(path, cube_fname), mmap_mode='r')
+        self.crs = CRS.from_wkt(self.info['crs'])
+        self.transform = Affine(*self.info['transform'])
+        self.width, self.height = self.info['width'], self.info['height']
+        self.block_rows = self.info['block_rows']
+        self.bands = self.info['bands']
+        self.times = self.info['times']
+        self._indices = {}
+
+    def years(self):
+        return [t['year'] for t in self.times]
+
+    def index(self, xs, ys):
+        """Fila y columna de las coordenadas (en el CRS del cubo)"""
+        return rasterio.transform.rowcol(self.transform, xs, ys)
+
+    def layers(self, name=None):
+        """
+        Arreglo de la banda o índice +name+, o de todas las bandas si es
+        None, con el bloque como primer eje
+
+        """
+        if name is None:
+            return self.data
+        if name in self.bands:
+            return self.data[:, :, self.bands.index(name)]
+        if name not in self._indices:
+            self._indices[name] = np.load(os.path.join(self.path, name + '.npy'),
+                    mmap_mode='r')
+        return self._indices[name]
+
+    def pixel(self, row, col, name=None):
+        """Serie de tiempo del píxel (+row+, +col+)"""
+        if not (0 <= row < self.height and 0 <= col < self.width):
+            raise IndexError('({}, {}) fuera del cubo'.format(row, col))
+        block, row = divmod(row, self.block_rows)
+        return self.layers(name)[block, ..., row, col]
+
+    def window(self, window, name=None):
+        """
+        Series de tiempo de la ventana +window+, recortada a la extensión del
+        cubo.  Si la ventana queda fuera del cubo devuelve un arreglo vacío.
+
+        """
+        if min(window.row_off, window.col_off, window.height, window.width) < 0:
+            raise IndexError('{} fuera del cubo'.format(window))
+        row_stop = min(window.row_off + window.height, self.height)
+        col_stop = max(min(window.col_off + window.width, self.width),
+                window.col_off)
+        cols = slice(window.col_off, col_stop)
+        layers = self.layers(name)
+        if window.row_off >= row_stop:
+            return layers[0, ..., :0, cols]
+        parts = []
+        row = window.row_off
+        while row < row_stop:
+            block, start = divmod(row, self.block_rows)
+            stop = min(self.block_rows, start + row_stop - row)
+            parts.append(layers[block, ..., start:stop, cols])
+            row += stop - start
+        return parts[0] if len(parts) == 1 else np.concatenate(parts, axis=-2)
+
+    def block_windows(self, name=None):
+        """Pares (ventana, vista) de cada bloque del cubo, sin copias"""
+        for block in range(self.data.shape[0]):
+            row_off = block * self.block_rows
+            rows = min(self.block_rows, self.height - row_off)
+            yield Window(0, row_off, self.width, rows), \
+                    self.layers(name)[block, ..., :rows, :]
+
+def print_series(cube, row, col):
+    """Escribe a stdout un CSV con la serie de tiempo de un píxel"""
+    import csv
+    import sys
+
+    names = cube.bands + cube.info['indices']
+    writer = csv.writer(sys.stdout)
+    writer.writerow(['year', 'satsensor', 'dates'] + names)
+    values = reflectance(cube.pixel(row, col)).T.tolist()
+    values += [cube.pixel(row, col, name).tolist() for name in cube.info['indices']]
+    for t, step in enumerate(cube.times):
+        writer.writerow([step['year'], step['satsensor'], ' '.join(step['dates'])] +
+                ['' if np.isnan(v[t]) else round(v[t], 4) for v in values])
+
+
+if __name__ == '__main__':
+    import argparse
+
+    parser = argparse.ArgumentParser(
+            description='Cubo de datos multianual de las bandas procesadas',
+            formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    subparsers = parser.add_subparsers(dest='command')
+
+    export_parser = subparsers.add_parser('export',
+            help='Exporta las bandas procesadas a un cubo',
+            formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    export_parser.add_argument('--input-dir', '-i', default='processed_data/',
+            help='Ruta donde están las bandas procesadas')
+    export_parser.add_argument('--output-dir', '-o', default='cube/',
+            help='Directorio del cubo')
+    export_parser.add_argument('--block-rows', type=int, default=block_rows,
+            help='Filas de cada bloque del cubo')
+    export_parser.add_argument('--threads', type=int,
+            help='Threads para cargar las bandas (por defecto, el presupuesto ' \
+                 'de núcleos)')
+    export_parser.add_argument('--force', action='store_true',
+            help='Exporta el cubo aunque esté al día')
+    export_parser.add_argument('--cpus', type=int,
+            help='Presupuesto de núcleos (por defecto, todos los disponibles; ' \
+                 'ver budget.py)')
+    export_parser.add_argument('--run-log', metavar='RUN_LOG',
+            help='Registra cada paso en este log JSON-lines (ver runlog.py)')
+
+    series_parser = subparsers.add_parser('series',
+            help='Imprime la serie de tiempo de un píxel como CSV')
+    series_parser.add_argument('cube', metavar='CUBE_DIR')
+    series_parser.add_argument('--xy', nargs=2, type=float, metavar=('X', 'Y'),
+            help='Coordenadas del píxel, en el CRS del cubo')
+    series_parser.add_argument('--rowcol', nargs=2, type=int, metavar=('ROW', 'COL'),
+            help='Fila y columna del píxel')
+
+    args = parser.parse_args()
+
+    if args.command == 'export':
+        runlog.configure(args.run_log)
+        budget.configure(args.cpus)
+        steps = year_dirs(args.input_dir)
+        inputs = sorted(os.path.join(s['root'], f) for s in steps
+                        for f in os.listdir(s['root'])
+                        if f.endswith('.TIF') or f.endswith('.json'))
+        params = dict(block_rows=args.block_rows, bands=list(bands),
+                indices=sorted(indices))
+        worker = partial(export, threads=args.threads or threads_per_task(1),
+                block_rows=args.block_rows)
+        units = [unit(os.path.join(args.output_dir, index_fname), inputs,
+                params, args.input_dir, args.output_dir)]
+        manifest = Manifest(os.path.join(args.output_dir, manifest_fname))
+        failed = run_units(worker, units, manifest, force=args.force,
+                name='datacube')
+        runlog.print_summary()
+        if failed:
+            raise SystemExit(1)
+    elif args.command == 'series':
+        cube = Datacube(args.cube)
+        if args.xy:
+            row, col = cube.index(*args.xy)
+        elif args.rowcol:
+            row, col = args.rowcol
+        else:
+            parser.error('se debe indicar --xy o --rowcol')
+        print_series(cube, row, col)
+    else:
+        parser.print_help()
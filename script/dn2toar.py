@@ -1,16 +1,39 @@
 #!/usr/bin/env python
 # -*- coding: utf-8 -*-
 """
-Script para GRASS GIS que procesa imágenes de Landsat de DNs a Reflectancia ToA.
+Procesa imágenes de Landsat de DNs a Reflectancia ToA.
 Aplica una corrección atmosférica con el método DOS (Dark Object Substraction).
 
-Para que funcione correctamente, se debe ejecutar dentor de una sesión de GRASS.
+Por default usa el motor `numpy` (ver `toar.py`), que no necesita GRASS.  Con
+`--engine grass` usa `i.landsat.toar`, y en ese caso se debe ejecutar dentro
+de una sesión de GRASS.
+
+Con `--aoi` sólo se convierte (o con GRASS, se exporta) la ventana que cubre
+un Shapefile (ver `aoi.py`).
 
 """
 import sys
 import os
-import glob
-from grass import script as g
+from functools import partial
+
+import rasterio
+
+import budget
+import profiles
+import runlog
+import toar
+from aoi import aoi_window
+from blocks import threads_per_task
+from inventory import open_inventory
+from manifest import Manifest, run_units, unit
+
+try:
+    from grass import script as g
+except ImportError:
+    # Fuera de una sesión de GRASS sólo está disponible el motor `numpy`
+    g = None
+
+manifest_fname = '.dn2toar.manifest.json'
 
 def load_files(root, fname):
     path = os.path.join(root, fname)
@@ -24,23 +47,40 @@ def load_files(root, fname):
         raster_name = prefix + num
 
     g.message('Loading {}'.format(raster_name))
-    g.run_command('r.in.gdal', flags='e', input=path,
-            output=raster_name, quiet=True, overwrite=True)
+    with runlog.step('grass_load', scene=os.path.basename(root), raster=raster_name):
+        g.run_command('r.in.gdal', flags='e', input=path,
+                output=raster_name, quiet=True, overwrite=True)
 
-def convert_dn_to_toar(root, product_id):
+def convert_dn_to_toar(root, product_id, method='dos3'):
     g.message('Applying ToA reflectance conversion to {}'.format(root))
     metfile = os.path.join(root, '{}_MTL.txt'.format(product_id))
-    g.run_command('i.landsat.toar', input='{}_B'.format(product_id),
-            output='{}_TOAR_B'.format(product_id), metfile=metfile,
-            method='dos3')
+    with runlog.step('grass_toar', scene=product_id):
+        g.run_command('i.landsat.toar', input='{}_B'.format(product_id),
+                output='{}_TOAR_B'.format(product_id), metfile=metfile,
+                method=method)
 
-def export_toar_files(root, fname):
+def export_toar_files(root, fname, profile=profiles.default_profile):
     output_root = os.path.join(root, '{}.TIF'.format(fname))
+    dtype = profiles.float_dtype(profile)
+    createopt = ['profile=GeoTIFF'] + profiles.gdal_options(profile, dtype)
 
     g.message('Exporting {}'.format(fname))
-    g.run_command('r.out.gdal', flags='c', input=fname, output=output_root,
-            format='GTiff', type='Float64', overwrite=True,
-            createopt='profile=GeoTIFF,compress=lzw')
+    with runlog.step('grass_export', scene=os.path.basename(root), raster=fname):
+        g.run_command('r.out.gdal', flags='c', input=fname, output=output_root,
+                format='GTiff', type=dtype.capitalize(), overwrite=True,
+                createopt=','.join(createopt))
+        profiles.finalize(output_root, profile)
+
+def set_aoi_region(root, tif_files, shp_path):
+    """
+    Limita la región de GRASS a la ventana del AOI (ver `aoi`), para que sólo
+    se exporte esa parte de las bandas
+
+    """
+    with rasterio.open(os.path.join(root, tif_files[0])) as src:
+        west, south, east, north = src.window_bounds(aoi_window(src, shp_path))
+    g.message('Setting region to the area of interest')
+    g.run_command('g.region', flags='a', n=north, s=south, e=east, w=west)
 
 def remove_all_rasters():
     """Remove all loaded rasters"""
@@ -49,32 +89,75 @@ def remove_all_rasters():
                 name=fname)
 
 def all_scenes(input_dir):
-    landsat_dirs = glob.glob(os.path.join(input_dir, 'LANDSAT_*/'))
-
-    for ldir in landsat_dirs:
-        for root, _, files in os.walk(ldir):
-            tif_files = [f for f in files if f.lower().endswith('.tif')
-                    if '_TOAR_' not in f]
-            if tif_files:
-                yield root, tif_files
-
-
-if __name__ == '__main__':
-    import argparse
-    import multiprocessing
-    from functools import partial
-
-    parser = argparse.ArgumentParser(
-            description='Convierte DNs de imágenes Landsat a reflectancia ToA')
-    parser.add_argument('--input-dir', '-i', default='/data',
-            help='Ruta donde están almacenadas las imágenes')
-    args = parser.parse_args()
-
-    count = multiprocessing.cpu_count()
-    pool = multiprocessing.Pool(count)
-
-    for root, tif_files in all_scenes(args.input_dir):
-        product_id = root.split('/')[-1]
+    """
+    Directorios de los productos de +input_dir+ con bandas DN, y los nombres
+    de esas bandas (ver `inventory`)
+
+    """
+    for root, files in open_inventory(input_dir).groups('dn'):
+        yield root, [os.path.basename(f['path']) for f in files]
+
+
+def band_units(root, method='dos3', profile=profiles.default_profile,
+        shp_path=None):
+    """
+    Unidades del manifest (ver `manifest.unit`) para convertir las bandas
+    descargadas del producto +root+ con `toar.convert_band`.  Las usan
+    también las etapas de `pipeline`, así que ambos registran las bandas ToA
+    en el mismo manifest (ver `gapfill.donor_paths`).
+
+    """
+    params = dict(method=method, profile=profile)
+    if shp_path:
+        params['aoi'] = shp_path
+    product_id = os.path.basename(root)
+    mtl_path = os.path.join(root, '{}_MTL.txt'.format(product_id))
+    metadata = toar.parse_mtl(mtl_path)
+    units = []
+    for band in toar.mtl_bands(metadata):
+        # Puede que sólo se hayan descargado algunas bandas (ver
+        # `download.py --select`)
+        if not os.path.exists(toar.band_path(root, metadata, band)):
+            continue
+        inputs = [toar.band_path(root, metadata, band), mtl_path]
+        if shp_path:
+            inputs.append(shp_path)
+        units.append(unit(toar.output_path(root, product_id, band),
+            inputs, params, root, product_id, band))
+    return units
+
+def run_numpy(input_dir, pool, method='dos3', force=False,
+        profile=profiles.default_profile, threads=None, shp_path=None):
+    """
+    Convierte todas las bandas de todas las escenas, en paralelo.  Sólo
+    procesa las bandas que no están al día según el manifest.  Devuelve la
+    lista de bandas que fallaron.
+
+    Con el Shapefile +shp_path+ sólo se convierte la ventana del área de
+    interés de cada banda (ver `toar.convert_band`).
+
+    Cada banda se procesa por ventanas en +threads+ threads (por defecto,
+    los necesarios para ocupar todos los núcleos si hay menos bandas que
+    núcleos).
+
+    """
+    units = []
+    for root, _ in all_scenes(input_dir):
+        units.extend(band_units(root, method=method, profile=profile,
+            shp_path=shp_path))
+
+    manifest = Manifest(os.path.join(input_dir, manifest_fname))
+    if threads is None:
+        threads = threads_per_task(len(units))
+    worker = partial(toar.convert_band, method=method, profile=profile,
+            threads=threads, shp_path=shp_path)
+    return run_units(worker, units, manifest, pool=pool, force=force,
+            name='dn2toar')
+
+def run_grass(input_dir, pool, method='dos3', profile=profiles.default_profile,
+        shp_path=None):
+    for root, tif_files in all_scenes(input_dir):
+        product_id = os.path.basename(root)
         g.message('Working on {}'.format(product_id))
 
         try:
@@ -82,12 +165,66 @@ if __name__ == '__main__':
             load_worker = partial(load_files, root)
             pool.map(load_worker, tif_files)
             # Process
-            convert_dn_to_toar(root, product_id)
-            # Export
+            convert_dn_to_toar(root, product_id, method=method)
+            # Export (sólo el AOI, si se pasó el Shapefile)
+            if shp_path:
+                set_aoi_region(root, tif_files, shp_path)
             loaded_files = g.list_grouped(['raster'], pattern='*_TOAR_*')['PERMANENT']
-            export_worker = partial(export_toar_files, root)
+            export_worker = partial(export_toar_files, root, profile=profile)
             pool.map(export_worker, loaded_files)
         finally:
             remove_all_rasters()
 
+
+if __name__ == '__main__':
+    import argparse
+
+    parser = argparse.ArgumentParser(
+            description='Convierte DNs de imágenes Landsat a reflectancia ToA')
+    parser.add_argument('--input-dir', '-i', default='/data',
+            help='Ruta donde están almacenadas las imágenes')
+    parser.add_argument('--engine', choices=('numpy', 'grass'), default='numpy',
+            help='Motor de conversión: "numpy" no necesita GRASS; "grass" ' \
+                 'usa i.landsat.toar y debe correr dentro de una sesión de GRASS')
+    parser.add_argument('--method', choices=toar.methods, default='dos3',
+            help='Método de corrección atmosférica')
+    parser.add_argument('--profile', choices=sorted(profiles.profiles),
+            default=profiles.default_profile,
+            help='Perfil de almacenamiento de las bandas ToA (ver profiles.py)')
+    parser.add_argument('--force', action='store_true',
+            help='Reprocesa todas las bandas, aunque ya estén al día ' \
+                 '(sólo motor "numpy")')
+    parser.add_argument('--threads', type=int,
+            help='Threads por banda (por defecto, según la cantidad de ' \
+                 'bandas y de núcleos; sólo motor "numpy")')
+    parser.add_argument('--aoi', metavar='SHAPE_FILE',
+            help='Convierte sólo el área que cubre este Shapefile (con un ' \
+                 'margen para el relleno de gaps), en lugar de la escena completa')
+    parser.add_argument('--cpus', type=int,
+            help='Presupuesto de núcleos para procesos, threads y comandos ' \
+                 'externos (por defecto, todos los disponibles; ver budget.py)')
+    parser.add_argument('--run-log', metavar='RUN_LOG',
+            help='Registra cada paso en este log JSON-lines (ver runlog.py)')
+    args = parser.parse_args()
+    runlog.configure(args.run_log)
+    budget.configure(args.cpus)
+
+    if args.engine == 'grass' and g is None:
+        parser.error('el motor "grass" debe ejecutarse dentro de una sesión de GRASS')
+    if args.engine == 'grass' and profiles.float_dtype(args.profile) == 'uint16':
+        parser.error('el motor "grass" no soporta el perfil "{}"'.format(args.profile))
+
+    failed = []
+    with budget.pool() as pool:
+        if args.engine == 'numpy':
+            failed = run_numpy(args.input_dir, pool, method=args.method,
+                    force=args.force, profile=args.profile, threads=args.threads,
+                    shp_path=args.aoi)
+        else:
+            run_grass(args.input_dir, pool, method=args.method,
+                    profile=args.profile, shp_path=args.aoi)
+
+    runlog.print_summary()
+    if failed:
+        raise SystemExit(1)
     print('All done! You can exit now (Ctrl+D)')
@@ -4,32 +4,283 @@
 Dado un CSV pasado por entrada estandar (stdin), descarga los productos del
 dataset de Google.
 
+Descarga varios productos en paralelo (`--jobs`).  Cada archivo se descarga
+primero a un archivo `.part`; si la descarga se interrumpe, la siguiente
+ejecución la continúa desde donde quedó.  Los archivos ya descargados con el
+tamaño correcto no se vuelven a descargar.  Cada archivo se reintenta hasta
+`--retries` veces, esperando cada vez el doble que la anterior.
+
+La forma de listar y descargar archivos depende del *transporte*:
+
+  * `gcs`: API HTTP pública de Google Cloud Storage (default para `gs://`)
+  * `gsutil`: el comando `gsutil` del Google Cloud SDK
+  * `local`: un directorio local o una URL `file://`, útil para pruebas sin
+    conexión
+
+Con `--select` se descargan sólo los archivos que se van a usar (ver
+`selections`), en lugar del producto completo.  El archivo de metadatos
+`_MTL.txt` se descarga siempre.
+
 """
 import json
 import os
+import re
+import shutil
 import subprocess
+import sys
+import time
+import urllib.parse
+import urllib.request
+
+import runlog
+
+# Tamaño de los bloques que se leen y escriben al descargar
+chunk_size = 1024 * 1024
+
+class DownloadError(Exception):
+    pass
+
+class LocalTransport:
+    """Copia productos desde un directorio local o una URL file://"""
+
+    def _path(self, url):
+        parsed = urllib.parse.urlparse(url)
+        return parsed.path if parsed.scheme == 'file' else url
+
+    def list_files(self, url):
+        root = self._path(url)
+        if not os.path.isdir(root):
+            raise DownloadError('{} no existe'.format(url))
+        files = []
+        for dirpath, _, fnames in os.walk(root):
+            for fname in fnames:
+                path = os.path.join(dirpath, fname)
+                files.append((os.path.relpath(path, root), os.path.getsize(path)))
+        return sorted(files)
+
+    def fetch(self, url, relpath, dst_path, offset=0):
+        src_path = os.path.join(self._path(url), relpath)
+        with open(src_path, 'rb') as src, open(dst_path, 'ab') as dst:
+            dst.truncate(offset)
+            src.seek(offset)
+            shutil.copyfileobj(src, dst, chunk_size)
+
+class GCSTransport:
+    """Descarga productos públicos de Google Cloud Storage por HTTP"""
+
+    api_url = 'https://storage.googleapis.com/storage/v1/b/{bucket}/o'
+    media_url = 'https://storage.googleapis.com/{bucket}/{name}'
+
+    def __init__(self, timeout=60):
+        self.timeout = timeout
+
+    def _split(self, url):
+        parsed = urllib.parse.urlparse(url)
+        return parsed.netloc, parsed.path.strip('/')
+
+    def list_files(self, url):
+        bucket, prefix = self._split(url)
+        files, page_token = [], None
+        while True:
+            query = dict(prefix=prefix + '/',
+                    fields='items(name,size),nextPageToken')
+            if page_token:
+                query['pageToken'] = page_token
+            list_url = '{}?{}'.format(self.api_url.format(bucket=bucket),
+                    urllib.parse.urlencode(query))
+            with urllib.request.urlopen(list_url, timeout=self.timeout) as res:
+                page = json.loads(res.read().decode('utf-8'))
+            for item in page.get('items', []):
+                relpath = item['name'][len(prefix) + 1:]
+                if relpath and not relpath.endswith('/'):
+                    files.append((relpath, int(item['size'])))
+            page_token = page.get('nextPageToken')
+            if not page_token:
+                return sorted(files)
+
+    def fetch(self, url, relpath, dst_path, offset=0):
+        bucket, prefix = self._split(url)
+        name = urllib.parse.quote('{}/{}'.format(prefix, relpath))
+        req = urllib.request.Request(self.media_url.format(bucket=bucket, name=name))
+        if offset:
+            req.add_header('Range', 'bytes={}-'.format(offset))
+        with urllib.request.urlopen(req, timeout=self.timeout) as res, \
+                open(dst_path, 'ab') as dst:
+            # Si el servidor ignora el rango, empieza de nuevo
+            dst.truncate(offset if res.status == 206 else 0)
+            shutil.copyfileobj(res, dst, chunk_size)
+
+class GsutilTransport:
+    """
+    Descarga productos usando `gsutil` (requiere Google Cloud SDK).  `gsutil
+    cp` no puede continuar una descarga en un archivo `.part` existente, así
+    que cada archivo se descarga completo.
+
+    """
+    resumable = False
+
+    def list_files(self, url):
+        out = subprocess.run(['gsutil', 'ls', '-l', '-r', url.rstrip('/') + '/**'],
+                check=True, stdout=subprocess.PIPE).stdout.decode('utf-8')
+        files = []
+        for line in out.splitlines():
+            parts = line.split()
+            if len(parts) == 3 and parts[2].startswith('gs://'):
+                relpath = parts[2][len(url.rstrip('/')) + 1:]
+                files.append((relpath, int(parts[0])))
+        return sorted(files)
+
+    def fetch(self, url, relpath, dst_path, offset=0):
+        # Sobrescribe +dst_path+ (ver `download_file`)
+        src = '{}/{}'.format(url.rstrip('/'), relpath)
+        subprocess.run(['gsutil', '-q', 'cp', src, dst_path], check=True)
+
+# Conjuntos de bandas que se pueden pedir con --select:
+#
+#   * `all`: el producto completo, incluyendo bandas de calidad y ángulos
+#   * `rgb`: las bandas que usa `create_rgb_images.py`
+#   * `reflective`: todas las bandas reflectivas (las que no son térmicas)
+#   * `thermal`: las bandas térmicas
+#
+selections = ('all', 'rgb', 'reflective', 'thermal')
+
+# Nombre de banda en los archivos de Landsat: <product_id>_B<banda>.TIF
+band_file_re = re.compile(r'_B(\w+)\.TIF$', re.IGNORECASE)
+
+transports = {
+    'gcs': GCSTransport,
+    'gsutil': GsutilTransport,
+    'local': LocalTransport,
+}
+
+def get_transport(url, name=None):
+    """Devuelve el transporte +name+, o el que corresponde al esquema de +url+"""
+    if name is None:
+        name = 'gcs' if url.startswith('gs://') else 'local'
+    return transports[name]()
 
 def product_dir(product, output_dir):
     satsensor = '{}-{}'.format(product['spacecraft_id'], product['sensor_id'])
     path = os.path.join(output_dir, satsensor, product['year'], product['id'])
     return path
 
-def download_product(product, output_dir, dry_run=False):
+def selection_bands(product, selection):
+    """
+    Devuelve el conjunto de bandas de +product+ que corresponden a
+    +selection+, o None si se necesita el producto completo.
+
+    """
+    import toar
+    bands = toar.wavelengths_by_spacecraft.get(product['spacecraft_id'])
+    if selection == 'all' or bands is None:
+        return None
+    if selection == 'rgb':
+        from create_rgb_images import band_combinations
+        satsensor = '{}-{}'.format(product['spacecraft_id'], product['sensor_id'])
+        if satsensor not in band_combinations:
+            return None
+        return set(str(n) for n in band_combinations[satsensor])
+    thermal = set(b for b, (low, _) in bands.items() if low > 10.)
+    return thermal if selection == 'thermal' else set(bands) - thermal
+
+def plan_files(product, files, select=('all',), bands=()):
+    """
+    Devuelve los archivos de +files+ (lista de (ruta relativa, tamaño))
+    necesarios para las selecciones +select+ más las bandas +bands+ (por
+    ejemplo '5' o 'QA').  El `_MTL.txt` se incluye siempre.
+
+    """
+    wanted = set(bands)
+    for selection in select:
+        selected = selection_bands(product, selection)
+        if selected is None:
+            return list(files)
+        wanted |= selected
+
+    plan = []
+    for relpath, size in files:
+        match = band_file_re.search(relpath)
+        if relpath.endswith('_MTL.txt') or (match and match.group(1) in wanted):
+            plan.append((relpath, size))
+    return plan
+
+def download_file(transport, url, relpath, size, dst_path, retries=5,
+        backoff=2.):
+    """
+    Descarga un archivo, continuando una descarga parcial si la hay (y si el
+    transporte lo permite), y verifica su tamaño.  Devuelve la cantidad de
+    bytes descargados.
+
+    """
+    resumable = getattr(transport, 'resumable', True)
+    if os.path.exists(dst_path) and os.path.getsize(dst_path) == size:
+        return 0
+
+    os.makedirs(os.path.dirname(dst_path), exist_ok=True)
+    part_path = dst_path + '.part'
+    for attempt in range(retries + 1):
+        offset = os.path.getsize(part_path) if os.path.exists(part_path) else 0
+        if offset > size or not resumable:
+            offset = 0
+        try:
+            if offset < size:
+                transport.fetch(url, relpath, part_path, offset=offset)
+            downloaded = os.path.getsize(part_path) if os.path.exists(part_path) else 0
+            if downloaded != size:
+                raise DownloadError('{}: se esperaban {} bytes, hay {}'.format(
+                    relpath, size, downloaded))
+            os.replace(part_path, dst_path)
+            return size - offset
+        except Exception as err:
+            if attempt == retries:
+                raise DownloadError('{}: {}'.format(relpath, err)) from err
+            time.sleep(backoff * 2 ** attempt)
+
+def download_product(product, output_dir, transport=None, retries=5,
+        backoff=2., select=('all',), bands=(), dry_run=False):
+    """
+    Descarga los archivos de +product+ elegidos según +select+ y +bands+ (ver
+    `plan_files`).  Devuelve la cantidad de bytes descargados, el tamaño de
+    los archivos elegidos y el tamaño del producto completo.
+
+    """
     # Define ruta y crea directorio
-    path = product_id(product, output_dir)
-    if not dry_run:
-        os.makedirs(path, exist_ok=True)
+    path = product_dir(product, output_dir)
+    url = product['base_url'].rstrip('/')
+    # Igual que `gsutil cp -r`, copia el directorio del producto dentro de
+    # +path+
+    dst_root = os.path.join(path, os.path.basename(url))
+
+    # Listar el producto sólo pide metadatos, así que se hace también en
+    # modo dry-run, para mostrar el plan con los tamaños reales
+    transport = transport or get_transport(url)
+    files = transport.list_files(url)
+
+    # Compara el tamaño total del producto con el del índice.  Una diferencia
+    # no impide la descarga: el tamaño de cada archivo se verifica igual
+    listed_size = sum(size for _, size in files)
+    if product.get('total_size') and int(product['total_size']) != listed_size:
+        print('{}: warning: the index says {} bytes, listed {}'.format(
+            product['id'], product['total_size'], listed_size), file=sys.stderr)
 
-    # Arma cadena del comando
-    cmd = 'gsutil -m cp -r {src} {dst}'.format(src=product['base_url'], dst=path)
+    files = plan_files(product, files, select=select, bands=bands)
+    selected_size = sum(size for _, size in files)
 
-    # Si está en modo dry-run sólo imprime en pantalla el comando
+    # Si está en modo dry-run sólo imprime en pantalla los archivos
     if dry_run:
-        print(cmd)
-        return
+        for relpath, size in files:
+            print('{}/{} -> {} ({} bytes)'.format(url, relpath,
+                os.path.join(dst_root, relpath), size))
+        return 0, selected_size, listed_size
 
-    # Ejecuta el comando
-    subprocess.run(cmd, shell=True)
+    os.makedirs(path, exist_ok=True)
+    downloaded = 0
+    for relpath, size in files:
+        downloaded += download_file(transport, url, relpath, size,
+                os.path.join(dst_root, relpath), retries=retries,
+                backoff=backoff)
+    print('{} downloaded ({} bytes)'.format(path, downloaded))
+    return downloaded, selected_size, listed_size
 
 def write_metadata_file(product, output_dir, dry_run=False):
     if dry_run:
@@ -41,10 +292,19 @@ def write_metadata_file(product, output_dir, dry_run=False):
     with open(json_path, 'w') as f:
         f.write(json.dumps(product))
 
+def process_product(product, output_dir, transport_name=None, retries=5,
+        select=('all',), bands=(), dry_run=False):
+    with runlog.step('download', scene=product['id']):
+        transport = get_transport(product['base_url'], transport_name)
+        result = download_product(product, output_dir, transport=transport,
+                retries=retries, select=select, bands=bands, dry_run=dry_run)
+        write_metadata_file(product, output_dir, dry_run=dry_run)
+        return result
+
 if __name__ == '__main__':
     import argparse
     import csv
-    import sys
+    from concurrent.futures import ThreadPoolExecutor, as_completed
 
     parser = argparse.ArgumentParser(
             description='Descarga imágenes de Landsat o Sentinel-2 ' \
@@ -55,12 +315,48 @@ if __name__ == '__main__':
             type=argparse.FileType('r'), default=sys.stdin)
     parser.add_argument('--output-dir', '-o', nargs='?', default='data/',
             help='Ruta donde se almacenarán las imágenes descargadas')
+    parser.add_argument('--jobs', '-j', type=int, default=4,
+            help='Cantidad de productos a descargar en paralelo')
+    parser.add_argument('--retries', type=int, default=5,
+            help='Cantidad de reintentos por archivo')
+    parser.add_argument('--transport', choices=sorted(transports),
+            help='Forma de descarga (por default, según la URL de cada producto)')
+    parser.add_argument('--select', nargs='+', choices=selections,
+            default=['all'],
+            help='Conjuntos de bandas a descargar (el _MTL.txt se descarga siempre)')
+    parser.add_argument('--bands', nargs='+', default=[],
+            help='Bandas adicionales a descargar, p.ej. 5 QA 6_VCID_1')
     parser.add_argument('--dry-run', action='store_true',
-            help='Imprime en pantalla los comandos de gsutil, pero no los ejecuta')
+            help='Imprime en pantalla los archivos a descargar, pero no los descarga')
+    parser.add_argument('--run-log', metavar='RUN_LOG',
+            help='Registra cada paso en este log JSON-lines (ver runlog.py)')
 
     args = parser.parse_args()
+    runlog.configure(args.run_log)
 
     reader = csv.DictReader(args.csvfile)
-    for row in reader:
-        download_product(row, args.output_dir, dry_run=args.dry_run)
-        write_metadata_file(row, args.output_dir, dry_run=args.dry_run)
+    failed = []
+    selected_size, full_size = 0, 0
+    with ThreadPoolExecutor(max_workers=args.jobs) as executor:
+        futures = {executor.submit(process_product, row, args.output_dir,
+                        transport_name=args.transport, retries=args.retries,
+                        select=tuple(args.select), bands=tuple(args.bands),
+                        dry_run=args.dry_run): row
+                   for row in reader}
+        for future in as_completed(futures):
+            row = futures[future]
+            try:
+                _, selected, full = future.result()
+                selected_size += selected
+                full_size += full
+            except Exception as err:
+                failed.append(row)
+                print('{} FAILED: {}'.format(row['id'], err), file=sys.stderr)
+
+    print('Selected {} of {} bytes ({} bytes saved)'.format(selected_size,
+        full_size, full_size - selected_size))
+
+    runlog.print_summary()
+    if failed:
+        print('{} products failed'.format(len(failed)), file=sys.stderr)
+        raise SystemExit(1)
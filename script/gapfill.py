@@ -0,0 +1,288 @@
+# -*- coding: utf-8 -*-
+"""
+Relleno de los gaps del SLC-off de Landsat 7, por ventanas.
+
+Primero se rellenan los gaps con los píxeles de escenas del mismo path/row
+de otras fechas (Landsat 5, 7 u 8) ya convertidas a reflectancia ToA, de la
+más cercana en el tiempo a la más lejana (ver `donor_paths`).  Sólo se usan
+las bandas que el manifest de `dn2toar` registra como terminadas, así que
+`pipeline` puede convertir escenas mientras rellena los gaps de otras.  Cada escena
+donante se reproyecta a la grilla de la banda a rellenar, y se ajusta
+radiométricamente para que tenga la misma media y desvío que la banda en los
+píxeles válidos en ambas, dentro del área que se procesa.  El ajuste es uno
+solo para toda el área, así que el resultado no depende del tamaño de las
+ventanas ni de la cantidad de threads.
+
+Los píxeles que ninguna escena donante cubre se interpolan linealmente a lo
+largo de filas y columnas (ver `interpolate_gaps`), hasta una distancia
+máxima.
+
+Métodos (`methods`): `composite` usa escenas donantes e interpolación,
+`interpolate` sólo interpolación, y `fillnodata` el algoritmo de
+`gdal_fillnodata.py`, como en versiones anteriores.
+
+"""
+import functools
+import os
+from datetime import datetime
+
+import numpy as np
+
+import dn2toar
+import profiles
+import toar
+from blocks import (WarpedDatasets, dataset_grid, offset_window, read_warped,
+        row_windows)
+from inventory import open_inventory
+from manifest import Manifest
+
+methods = ('composite', 'interpolate', 'fillnodata')
+
+# Cantidad máxima de escenas donantes por banda
+max_donors = 3
+
+# Mínima cantidad de píxeles válidos en la banda y en la escena donante para
+# ajustar la radiometría; con menos, la donante no se usa
+min_common_pixels = 1000
+
+# Cantidad de filas que se leen por vez para ajustar la radiometría
+fit_rows = 512
+
+# Segundos entre revisiones del inventario de descargas (ver `archive_scenes`)
+archive_max_age = 10.
+
+# Escenas de cada directorio de descargas, con la revisión del inventario de
+# la que salieron
+_archive_scenes = {}
+
+def archive_dir(toar_path):
+    """
+    Directorio de descargas de una banda ToA
+    (`data/SAT-SENSOR/AÑO/escena/producto/banda.TIF`)
+
+    """
+    path = toar_path
+    for _ in range(5):
+        path = os.path.dirname(path)
+    return path
+
+def archive_scenes(data_dir):
+    """
+    Escenas del directorio de descargas +data_dir+: (directorio del producto,
+    product_id, metadatos del MTL).  Pueden aparecer escenas nuevas mientras
+    se procesa (ver `pipeline`), así que el inventario se revisa, pero como
+    mucho cada `archive_max_age` segundos; entre revisiones la lista de
+    escenas se reutiliza.  Cada MTL se lee una sola vez por proceso.
+
+    """
+    inventory = open_inventory(data_dir, max_age=archive_max_age)
+    cached = _archive_scenes.get(data_dir)
+    if cached is None or cached[0] != inventory.refreshed:
+        scenes = [(f['dir'], f['product_id'], parse_mtl(f['path']))
+                  for f in inventory.files('mtl')]
+        cached = _archive_scenes[data_dir] = (inventory.refreshed, scenes)
+    return cached[1]
+
+@functools.lru_cache(maxsize=None)
+def parse_mtl(path):
+    return toar.parse_mtl(path)
+
+def acquisition_date(metadata):
+    return datetime.strptime(metadata['DATE_ACQUIRED'], '%Y-%m-%d')
+
+def wrs(metadata):
+    return metadata.get('WRS_PATH'), metadata.get('WRS_ROW')
+
+def mtl_band(metadata, toar_band):
+    """Banda del MTL (p.ej. '6_VCID_1') del nombre de una banda ToA (p.ej. '61')"""
+    for band in toar.mtl_bands(metadata):
+        if toar.toar_band_name(band) == toar_band:
+            return band
+    raise ValueError('Banda {} desconocida'.format(toar_band))
+
+def matching_band(metadata, wavelengths):
+    """
+    Banda de la escena de +metadata+ cuyo rango espectral se superpone más
+    con +wavelengths+, o None si ninguna se superpone
+
+    """
+    low, high = wavelengths
+    ranges = toar.wavelengths_by_spacecraft[metadata['SPACECRAFT_ID']]
+    best, best_overlap = None, 0.
+    for band in toar.mtl_bands(metadata):
+        if band not in ranges:
+            continue
+        b_low, b_high = ranges[band]
+        overlap = min(high, b_high) - max(low, b_low)
+        if overlap > best_overlap:
+            best, best_overlap = band, overlap
+    return best
+
+def completed_bands(data_dir):
+    """
+    Rutas absolutas de las bandas ToA de +data_dir+ que el manifest de
+    `dn2toar` (que comparte `pipeline`) registra como terminadas.  Devuelve
+    None si no hay manifest, p.ej. si las bandas se convirtieron con GRASS.
+
+    """
+    path = os.path.join(data_dir, dn2toar.manifest_fname)
+    if not os.path.exists(path):
+        return None
+    return set(os.path.abspath(output)
+               for output, entry in Manifest(path).entries.items()
+               if entry['status'] == 'ok')
+
+def donor_paths(toar_path, limit=max_donors):
+    """
+    Bandas ToA que pueden rellenar los gaps de +toar_path+: la banda
+    equivalente de las escenas del mismo path/row y de otra fecha, ordenadas
+    por cercanía en el tiempo.  Si hay manifest, sólo las que terminaron de
+    convertirse (ver `completed_bands`).
+
+    """
+    root = os.path.dirname(toar_path)
+    product_id = os.path.basename(root)
+    metadata = parse_mtl(os.path.join(root, '{}_MTL.txt'.format(product_id)))
+    band = mtl_band(metadata, toar_path.rsplit('_TOAR_B', 1)[1].split('.')[0])
+    wavelengths = toar.wavelengths_by_spacecraft[metadata['SPACECRAFT_ID']][band]
+    date = acquisition_date(metadata)
+
+    data_dir = archive_dir(toar_path)
+    completed = completed_bands(data_dir)
+    donors = []
+    for d_root, d_product_id, d_metadata in archive_scenes(data_dir):
+        if d_product_id == product_id or wrs(d_metadata) != wrs(metadata):
+            continue
+        d_band = matching_band(d_metadata, wavelengths)
+        if d_band is None:
+            continue
+        path = toar.output_path(d_root, d_product_id, d_band)
+        if completed is not None and os.path.abspath(path) not in completed:
+            continue
+        if os.path.exists(path):
+            days = abs((acquisition_date(d_metadata) - date).days)
+            donors.append((days, path))
+    return [path for _, path in sorted(donors)][:limit]
+
+class Donors(WarpedDatasets):
+    """
+    Escenas donantes +paths+ reproyectadas a la grilla de +src+, abiertas una
+    vez por thread (ver `blocks.WarpedDatasets`).  Se usa como context
+    manager, que las cierra.
+
+    """
+    def __init__(self, src, paths):
+        super().__init__(dataset_grid(src), *paths)
+        self.adjustments = [None] * len(paths)
+
+    def read_raw(self, window):
+        """Ventana de cada escena donante, como float64 con NaN en nodata"""
+        for dataset in self.get():
+            yield read_warped(dataset, window)
+
+    def fit(self, src, window):
+        """
+        Calcula el ajuste radiométrico de cada escena donante respecto de la
+        banda +src+, en la ventana +window+ (ver `linear_fit`)
+
+        """
+        sums = np.zeros((len(self.paths), 5))
+        for w in row_windows(window.width, window.height, fit_rows):
+            w = offset_window(w, window)
+            data = profiles.read_float(src, window=w)
+            valid = np.isfinite(data)
+            for i, donor in enumerate(self.read_raw(w)):
+                common = valid & np.isfinite(donor)
+                d, t = donor[common], data[common]
+                sums[i] += (d.size, d.sum(), (d * d).sum(), t.sum(), (t * t).sum())
+        self.adjustments = [linear_fit(*s) for s in sums]
+
+    def read(self, window):
+        """
+        Ventana de cada escena donante ajustada radiométricamente (ver
+        `fit`), omitiendo las que no se pudieron ajustar
+
+        """
+        for data, adjustment in zip(self.read_raw(window), self.adjustments):
+            if adjustment is not None:
+                gain, offset = adjustment
+                yield data * gain + offset
+
+def linear_fit(count, sum_d, sum_d2, sum_t, sum_t2):
+    """
+    Ganancia y offset que llevan la media y desvío de una escena donante
+    (+sum_d+, +sum_d2+) a los de la banda (+sum_t+, +sum_t2+), a partir de
+    las sumas sobre +count+ píxeles válidos en ambas.  Devuelve None si hay
+    menos de `min_common_pixels` píxeles.
+
+    """
+    if count < min_common_pixels:
+        return None
+    mean_d, mean_t = sum_d / count, sum_t / count
+    std_d = np.sqrt(max(sum_d2 / count - mean_d * mean_d, 0.))
+    std_t = np.sqrt(max(sum_t2 / count - mean_t * mean_t, 0.))
+    gain = std_t / std_d if std_d > 0 else 1.
+    return gain, mean_t - gain * mean_d
+
+def composite(data, donors):
+    """
+    Rellena los píxeles NaN de +data+ con las ventanas de +donors+ (en orden
+    de preferencia, ya ajustadas radiométricamente).  Modifica +data+.
+
+    """
+    for donor in donors:
+        missing = np.isnan(data)
+        if not missing.any():
+            break
+        fill = missing & np.isfinite(donor)
+        data[fill] = donor[fill]
+    return data
+
+def axis_neighbors(valid, axis):
+    """
+    Para cada píxel, el índice a lo largo de +axis+ del píxel válido anterior
+    y del siguiente (-1 y n si no hay)
+
+    """
+    n = valid.shape[axis]
+    shape = [1, 1]
+    shape[axis] = n
+    index = np.arange(n).reshape(shape)
+    prev = np.maximum.accumulate(np.where(valid, index, -1), axis=axis)
+    flipped = np.flip(np.where(valid, index, n), axis=axis)
+    following = np.flip(np.minimum.accumulate(flipped, axis=axis), axis=axis)
+    return index, prev, following
+
+def interpolate_gaps(data, max_distance):
+    """
+    Interpola linealmente los píxeles NaN de +data+ entre el píxel válido
+    anterior y el siguiente, por filas y por columnas, si ambos están a no más
+    de +max_distance+ píxeles.  Cada píxel es el promedio de las dos
+    interpolaciones, pesado por la inversa del largo del gap.  Modifica
+    +data+.
+
+    """
+    missing = np.isnan(data)
+    if not missing.any():
+        return data
+    valid = ~missing
+    total = np.zeros(data.shape)
+    weight = np.zeros(data.shape)
+    for axis in (0, 1):
+        n = data.shape[axis]
+        index, prev, following = axis_neighbors(valid, axis)
+        before, after = index - prev, following - index
+        ok = missing & (prev >= 0) & (following < n) & \
+                (before <= max_distance) & (after <= max_distance)
+        if not ok.any():
+            continue
+        v_prev = np.take_along_axis(data, np.clip(prev, 0, n - 1), axis=axis)
+        v_next = np.take_along_axis(data, np.clip(following, 0, n - 1), axis=axis)
+        span = (before + after).astype(np.float64)
+        with np.errstate(invalid='ignore'):
+            value = (v_prev * after + v_next * before) / span
+        total[ok] += value[ok] / span[ok]
+        weight[ok] += 1. / span[ok]
+    filled = weight > 0
+    data[filled] = total[filled] / weight[filled]
+    return data
@@ -0,0 +1,445 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Inventario de los archivos de un árbol de datos: productos descargados y sus
+bandas DN y ToA (`data/`), y bandas post-procesadas, metadatos, previews RGB
+y animaciones (`processed_data/`), con su satélite y sensor, año, escena,
+producto, banda y etapa.
+
+El inventario se guarda en una base SQLite (`.inventory.db`) en la raíz de
+cada árbol, así que los scripts obtienen los archivos de una etapa con una
+consulta, sin recorrer todo el árbol ni ejecutar un glob en cada directorio.
+Se mantiene al día de forma incremental:
+
+  * Al abrirlo (`open_inventory`) sólo se revisa la fecha de modificación de
+    los directorios ya inventariados, y se vuelven a listar los que
+    cambiaron: agregar, borrar o renombrar un archivo cambia la fecha de su
+    directorio.  La primera vez se recorre el árbol completo.
+  * Un archivo reescrito en el lugar no cambia la fecha de su directorio; si
+    se necesitan el tamaño y la fecha actuales de cada archivo, se vuelven a
+    leer al consultarlo con `check=True` (ver `Inventory.files`).
+  * Quien consulta muchas veces seguidas (p.ej. una vez por banda, ver
+    `gapfill`) puede revisar los directorios como mucho cada tantos segundos
+    (`max_age`).
+  * Cada salida que escribe una etapa se registra al terminar (`register`,
+    ver `manifest.run_units`).
+
+Los archivos que no son de ninguna etapa también se inventarían, sin etapa,
+para las búsquedas por nombre (`Inventory.match`).
+
+Si no se puede escribir la base en el árbol (p.ej. un archivo de sólo
+lectura), o en modo dry-run si todavía no existe (`open_inventory(...,
+create=False)`), el inventario se arma en memoria, recorriendo el árbol.
+
+El satélite, el año y demás datos salen del nombre de cada archivo y de su
+posición relativa a la raíz del árbol (ver `classify`), así que la ruta del
+árbol puede ser absoluta o relativa y tener cualquier profundidad.
+
+Para inventariar un árbol desde cero, o consultar sus archivos:
+
+```
+script/inventory.py scan data/ --full
+script/inventory.py list processed_data/ --stage band --year 2017
+```
+
+"""
+import fnmatch
+import os
+import re
+import sqlite3
+import threading
+import time
+
+db_fname = '.inventory.db'
+
+# Versión del esquema; si la base es de una versión anterior se vuelve a
+# inventariar el árbol completo
+schema_version = 1
+
+# Etapa de cada archivo, según su nombre y su posición en el árbol:
+#
+#   data/SAT-SENSOR/AÑO/escena/metadata.json              product_metadata
+#   data/SAT-SENSOR/AÑO/escena/producto/producto_MTL.txt  mtl
+#   data/SAT-SENSOR/AÑO/escena/producto/producto_BN.TIF   dn
+#   data/SAT-SENSOR/AÑO/escena/producto/producto_TOAR_BN.TIF  toar
+#   processed_data/AÑO/SAT-SENSOR/[tag_]AÑO_SAT-SENSOR_BN.TIF  band
+#   processed_data/AÑO/SAT-SENSOR/[tag_]AÑO_SAT-SENSOR_metadata.json  metadata
+#   processed_data/AÑO/SAT-SENSOR/rgb_preview.tif         rgb_preview
+#   processed_data/AÑO/SAT-SENSOR/rgb_preview.png         rgb_png
+#   processed_data/rgb_SAT-SENSOR.FORMATO                 animation
+stages = ('product_metadata', 'mtl', 'dn', 'toar', 'band', 'metadata',
+          'rgb_preview', 'rgb_png', 'animation')
+
+# Profundidad máxima de los directorios que se inventarían (no se recorren,
+# por ejemplo, los tiles de cada escena)
+max_depth = 4
+
+columns = ('path', 'dir', 'stage', 'satsensor', 'year', 'scene_id',
+           'product_id', 'band', 'size', 'mtime')
+
+satsensor_re = re.compile(r'^[A-Z0-9_]+-[A-Z0-9_]+$')
+year_re = re.compile(r'^\d{4}$')
+animation_re = re.compile(r'^rgb_([A-Z0-9_]+-[A-Z0-9_]+)\.\w+$')
+
+def classify(relpath):
+    """
+    Etapa y demás datos del archivo +relpath+ (relativo a la raíz del
+    árbol), o None si no es un archivo de ninguna etapa
+
+    """
+    parts = relpath.split(os.sep)
+    fname, dirs = parts[-1], parts[:-1]
+    if len(dirs) >= 2 and satsensor_re.match(dirs[0]) and year_re.match(dirs[1]):
+        info = dict(satsensor=dirs[0], year=int(dirs[1]))
+        if len(dirs) == 3 and fname == 'metadata.json':
+            return dict(info, stage='product_metadata', scene_id=dirs[2])
+        if len(dirs) != 4:
+            return None
+        info.update(scene_id=dirs[2], product_id=dirs[3])
+        prefix = dirs[3] + '_'
+        if fname == prefix + 'MTL.txt':
+            return dict(info, stage='mtl')
+        if not fname.startswith(prefix) or not fname.endswith('.TIF'):
+            return None
+        band = fname[len(prefix):-len('.TIF')]
+        if band.startswith('TOAR_B'):
+            return dict(info, stage='toar', band=band[len('TOAR_B'):])
+        if band.startswith('B'):
+            return dict(info, stage='dn', band=band[1:])
+        return None
+    if len(dirs) == 2 and year_re.match(dirs[0]) and satsensor_re.match(dirs[1]):
+        info = dict(satsensor=dirs[1], year=int(dirs[0]))
+        if fname == 'rgb_preview.tif':
+            return dict(info, stage='rgb_preview')
+        if fname == 'rgb_preview.png':
+            return dict(info, stage='rgb_png')
+        name = '{}_{}_'.format(dirs[0], dirs[1])
+        if name not in fname:
+            return None
+        suffix = fname.split(name, 1)[1]
+        if suffix == 'metadata.json':
+            return dict(info, stage='metadata')
+        if suffix.startswith('B') and suffix.endswith('.TIF'):
+            return dict(info, stage='band', band=suffix[1:-len('.TIF')])
+        return None
+    match = animation_re.match(relpath)
+    if match:
+        return dict(stage='animation', satsensor=match.group(1))
+    return None
+
+def depth(reldir):
+    return 0 if not reldir else reldir.count(os.sep) + 1
+
+class Inventory:
+    """
+    Inventario del árbol +root+.  Las rutas se devuelven unidas a +root+, tal
+    como las devolvería `os.walk(root)`.  Se puede usar desde varios threads.
+
+    La base se guarda en `.inventory.db`, en +root+.  Sin +create+ sólo se usa
+    si ya existe; si no existe, o si no se puede escribir, el inventario se
+    guarda en memoria (`in_memory`).
+
+    """
+    def __init__(self, root, create=True):
+        self.root = root
+        self.lock = threading.Lock()
+        # Momento de la última revisión (ver `refresh`)
+        self.refreshed = None
+        path = os.path.join(root, db_fname)
+        self.in_memory = not (create or os.path.exists(path))
+        if not self.in_memory:
+            try:
+                self._connect(path)
+            except sqlite3.Error:
+                if self.conn is not None:
+                    self.conn.close()
+                self.in_memory = True
+        if self.in_memory:
+            self._connect(':memory:')
+
+    def _connect(self, path):
+        self.conn = None
+        self.conn = sqlite3.connect(path, timeout=60, check_same_thread=False)
+        self.conn.row_factory = sqlite3.Row
+        with self.conn:
+            if path != ':memory:':
+                self.conn.execute('PRAGMA journal_mode=WAL')
+            self.conn.execute('CREATE TABLE IF NOT EXISTS dirs ('
+                    'path TEXT PRIMARY KEY, mtime INTEGER)')
+            self.conn.execute('CREATE TABLE IF NOT EXISTS files ('
+                    'path TEXT PRIMARY KEY, dir TEXT, stage TEXT, '
+                    'satsensor TEXT, year INTEGER, scene_id TEXT, '
+                    'product_id TEXT, band TEXT, size INTEGER, mtime REAL)')
+            self.conn.execute('CREATE INDEX IF NOT EXISTS files_stage ON files '
+                    '(stage, satsensor, year)')
+            self.conn.execute('CREATE INDEX IF NOT EXISTS files_dir ON files (dir)')
+            version = self.conn.execute('PRAGMA user_version').fetchone()[0]
+            if version < schema_version:
+                self.conn.execute('DELETE FROM dirs')
+                self.conn.execute('DELETE FROM files')
+                self.conn.execute('PRAGMA user_version = {}'.format(schema_version))
+
+    def close(self):
+        self.conn.close()
+
+    def refresh(self, full=False, max_age=None):
+        """
+        Vuelve a listar los directorios que cambiaron desde la última vez (o
+        todos, si +full+).  Con +max_age+ no hace nada si la última revisión
+        fue hace menos de +max_age+ segundos.  Devuelve la cantidad de
+        directorios listados.
+
+        """
+        if not full and max_age is not None and self.refreshed is not None \
+                and time.time() - self.refreshed < max_age:
+            return 0
+        with self.lock, self.conn:
+            if full:
+                self.conn.execute('DELETE FROM dirs')
+                self.conn.execute('DELETE FROM files')
+            known = dict(self.conn.execute('SELECT path, mtime FROM dirs'))
+            pending = sorted(known) if known else ['']
+            scanned = 0
+            while pending:
+                reldir = pending.pop()
+                try:
+                    mtime = os.stat(os.path.join(self.root, reldir)).st_mtime_ns
+                except FileNotFoundError:
+                    self._forget(reldir)
+                    continue
+                if known.get(reldir) == mtime:
+                    continue
+                subdirs = self._scan(reldir, mtime)
+                pending.extend(d for d in subdirs if d not in known)
+                scanned += 1
+            self.refreshed = time.time()
+        return scanned
+
+    def _scan(self, reldir, mtime):
+        """Lista +reldir+ y devuelve sus subdirectorios a inventariar"""
+        rows, subdirs = [], []
+        with os.scandir(os.path.join(self.root, reldir)) as entries:
+            for entry in entries:
+                if entry.name.startswith('.'):
+                    continue
+                relpath = os.path.join(reldir, entry.name)
+                if entry.is_dir():
+                    if depth(relpath) <= max_depth:
+                        subdirs.append(relpath)
+                    continue
+                rows.append(self._row(relpath, classify(relpath) or {},
+                    entry.stat()))
+        self.conn.execute('DELETE FROM files WHERE dir = ?', (reldir,))
+        self._insert(rows)
+        self.conn.execute('INSERT OR REPLACE INTO dirs VALUES (?, ?)',
+                (reldir, mtime))
+        return subdirs
+
+    def _forget(self, reldir):
+        """Quita del inventario +reldir+ y todo lo que contiene"""
+        prefix = os.path.join(reldir, '')
+        for table in ('dirs', 'files'):
+            column = 'path' if table == 'dirs' else 'dir'
+            self.conn.execute('DELETE FROM {0} WHERE {1} = ? OR '
+                    'substr({1}, 1, ?) = ?'.format(table, column),
+                    (reldir, len(prefix), prefix))
+
+    def _row(self, relpath, info, stat):
+        row = dict(info, path=relpath, dir=os.path.dirname(relpath),
+                size=stat.st_size, mtime=stat.st_mtime)
+        return [row.get(c) for c in columns]
+
+    def _insert(self, rows):
+        self.conn.executemany('INSERT OR REPLACE INTO files ({}) VALUES ({})'.format(
+            ', '.join(columns), ', '.join('?' for _ in columns)), rows)
+
+    def add(self, path):
+        """Registra el archivo +path+, que está dentro del árbol"""
+        relpath = os.path.relpath(os.path.abspath(path), os.path.abspath(self.root))
+        if not os.path.isfile(path):
+            return
+        with self.lock, self.conn:
+            self._insert([self._row(relpath, classify(relpath) or {},
+                os.stat(path))])
+
+    def _select(self, filters):
+        where = ' AND '.join('{} = ?'.format(k) for k in sorted(filters))
+        qs = 'SELECT * FROM files{} ORDER BY path'.format(
+                ' WHERE ' + where if where else '')
+        with self.lock:
+            rows = self.conn.execute(qs, [filters[k] for k in sorted(filters)]).fetchall()
+        return [dict(row) for row in rows]
+
+    def _check(self, rows):
+        """
+        Vuelve a leer el tamaño y la fecha de modificación de los archivos de
+        +rows+, y quita los que ya no existen.  Devuelve las filas al día, con
+        las rutas unidas a la raíz.
+
+        """
+        result, changed, missing = [], [], []
+        for row in rows:
+            try:
+                stat = os.stat(os.path.join(self.root, row['path']))
+            except FileNotFoundError:
+                missing.append((row['path'],))
+                continue
+            if (stat.st_size, stat.st_mtime) != (row['size'], row['mtime']):
+                row = dict(row, size=stat.st_size, mtime=stat.st_mtime)
+                changed.append((row['size'], row['mtime'], row['path']))
+            result.append(row)
+        if changed or missing:
+            with self.lock, self.conn:
+                self.conn.executemany('UPDATE files SET size = ?, mtime = ? '
+                        'WHERE path = ?', changed)
+                self.conn.executemany('DELETE FROM files WHERE path = ?', missing)
+        return [dict(row, path=os.path.join(self.root, row['path']),
+                     dir=os.path.join(self.root, row['dir'])) for row in result]
+
+    def files(self, stage=None, check=False, **filters):
+        """
+        Archivos de la etapa +stage+ (o de todos, incluso los que no son de
+        ninguna etapa) que cumplen +filters+ (p.ej. `year=2017`), como
+        diccionarios con las columnas del inventario, ordenados por ruta.  Con
+        +check+, el tamaño y la fecha de cada archivo se leen de nuevo del
+        disco (ver `_check`).
+
+        """
+        if stage is not None:
+            filters['stage'] = stage
+        rows = self._select(filters)
+        if check:
+            return self._check(rows)
+        return [dict(row, path=os.path.join(self.root, row['path']),
+                     dir=os.path.join(self.root, row['dir'])) for row in rows]
+
+    def paths(self, stage=None, check=False, **filters):
+        """Rutas de los archivos de `files`"""
+        return [f['path'] for f in self.files(stage, check=check, **filters)]
+
+    def groups(self, stage=None, **filters):
+        """
+        Archivos de `files` agrupados por directorio: lista de (directorio,
+        [archivos]), ordenada por directorio
+
+        """
+        groups = {}
+        for f in self.files(stage, **filters):
+            groups.setdefault(f['dir'], []).append(f)
+        return sorted(groups.items())
+
+    def dirs(self, stage=None, **filters):
+        """Directorios con archivos de `files`, ordenados"""
+        return [d for d, _ in self.groups(stage, **filters)]
+
+    def match(self, pattern):
+        """
+        Rutas de los archivos cuyo nombre coincide con el patrón +pattern+.
+        Si ningún archivo inventariado coincide (p.ej. porque están más abajo
+        que `max_depth`), recorre el árbol completo.
+
+        """
+        rows = [r for r in self._select({})
+                if fnmatch.fnmatch(os.path.basename(r['path']), pattern)]
+        paths = [os.path.join(self.root, r['path']) for r in rows]
+        if paths:
+            return paths
+        return sorted(os.path.join(root, fname)
+                      for root, _, fnames in os.walk(self.root)
+                      for fname in fnmatch.filter(fnames, pattern)
+                      if not fname.startswith('.'))
+
+# Inventarios abiertos por este proceso, por raíz
+_inventories = {}
+
+def get_inventory(root, create=True):
+    key = (os.getpid(), os.path.abspath(root), root, create)
+    inventory = _inventories.get(key)
+    if inventory is None:
+        inventory = _inventories[key] = Inventory(root, create=create)
+    return inventory
+
+def open_inventory(root, create=True, max_age=None):
+    """
+    Inventario del árbol +root+, al día (o revisado hace menos de +max_age+
+    segundos, ver `Inventory.refresh`).  Sin +create+ (en modo dry-run) no se
+    crea `.inventory.db` si no existe.
+
+    """
+    inventory = get_inventory(root, create=create)
+    inventory.refresh(max_age=max_age)
+    return inventory
+
+def find_root(path):
+    """
+    Raíz del árbol inventariado que contiene +path+: el primer directorio con
+    un `.inventory.db`, empezando por el de +path+ y subiendo hasta
+    `max_depth` niveles.  None si no hay.
+
+    """
+    root = os.path.dirname(os.path.abspath(path))
+    for _ in range(max_depth + 1):
+        if os.path.exists(os.path.join(root, db_fname)):
+            return root
+        parent = os.path.dirname(root)
+        if parent == root:
+            break
+        root = parent
+    return None
+
+def register(path):
+    """
+    Registra +path+, recién escrito por una etapa, en el inventario del árbol
+    que lo contiene (si el árbol tiene uno)
+
+    """
+    root = find_root(path)
+    if root is not None:
+        get_inventory(root).add(path)
+
+
+if __name__ == '__main__':
+    import argparse
+    from collections import Counter
+
+    parser = argparse.ArgumentParser(
+            description='Inventario de los archivos de un árbol de datos',
+            formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    subparsers = parser.add_subparsers(dest='command')
+
+    scan_parser = subparsers.add_parser('scan',
+            help='Actualiza el inventario e imprime la cantidad de archivos por etapa')
+    scan_parser.add_argument('root', metavar='DIR')
+    scan_parser.add_argument('--full', action='store_true',
+            help='Recorre el árbol completo, aunque los directorios no hayan cambiado')
+
+    list_parser = subparsers.add_parser('list',
+            help='Imprime las rutas de los archivos inventariados')
+    list_parser.add_argument('root', metavar='DIR')
+    list_parser.add_argument('--stage', choices=stages)
+    list_parser.add_argument('--satsensor')
+    list_parser.add_argument('--year', type=int)
+    list_parser.add_argument('--band')
+    list_parser.add_argument('--check', action='store_true',
+            help='Vuelve a leer el tamaño y la fecha de cada archivo')
+
+    args = parser.parse_args()
+
+    if args.command == 'scan':
+        inventory = get_inventory(args.root)
+        scanned = inventory.refresh(full=args.full)
+        counts = Counter(f['stage'] for f in inventory.files())
+        print('{}: {} directories scanned'.format(args.root, scanned))
+        for stage in stages:
+            if counts[stage]:
+                print('  {}: {} files'.format(stage, counts[stage]))
+        if counts[None]:
+            print('  (no stage): {} files'.format(counts[None]))
+    elif args.command == 'list':
+        filters = dict((k, getattr(args, k)) for k in ('satsensor', 'year', 'band')
+                       if getattr(args, k) is not None)
+        for path in open_inventory(args.root).paths(args.stage,
+                check=args.check, **filters):
+            print(path)
+    else:
+        parser.print_help()
@@ -0,0 +1,147 @@
+# -*- coding: utf-8 -*-
+"""
+Registro (manifest) de las salidas de una etapa del procesamiento.
+
+Por cada archivo de salida se guarda qué entradas se usaron (ruta, tamaño y
+fecha de modificación), con qué parámetros, y si el proceso terminó bien o
+falló.  Al volver a ejecutar una etapa sólo se procesan las unidades cuya
+salida no existe, falló, o tiene entradas o parámetros distintos a los
+registrados.
+
+El manifest es un archivo JSON que escribe sólo el proceso principal, después
+de cada unidad terminada, así que una corrida interrumpida conserva lo hecho
+hasta ese momento.
+
+"""
+import json
+import os
+import traceback
+from functools import partial
+
+import budget
+import inventory
+
+class Manifest:
+
+    def __init__(self, path):
+        self.path = path
+        self.entries = {}
+        if os.path.exists(path):
+            with open(path) as f:
+                self.entries = json.load(f)
+
+    def is_fresh(self, output, inputs, params):
+        """Indica si +output+ ya fue generado con estas entradas y parámetros"""
+        entry = self.entries.get(output)
+        return entry is not None \
+                and entry['status'] == 'ok' \
+                and os.path.exists(output) \
+                and entry['inputs'] == fingerprint(inputs) \
+                and entry['params'] == normalize(params)
+
+    def record(self, output, inputs, params, error=None):
+        self.entries[output] = dict(
+                status='failed' if error else 'ok',
+                inputs=fingerprint(inputs),
+                params=normalize(params),
+                error=error)
+
+    def save(self):
+        dirname = os.path.dirname(self.path)
+        if dirname:
+            os.makedirs(dirname, exist_ok=True)
+        tmp_path = self.path + '.tmp'
+        with open(tmp_path, 'w') as f:
+            json.dump(self.entries, f, indent=1, sort_keys=True)
+        os.replace(tmp_path, self.path)
+
+def fingerprint(paths):
+    """Tamaño y fecha de modificación de cada archivo de +paths+"""
+    result = {}
+    for path in paths:
+        if os.path.exists(path):
+            stat = os.stat(path)
+            result[path] = [stat.st_size, stat.st_mtime]
+        else:
+            result[path] = None
+    return result
+
+def normalize(params):
+    """Normaliza los parámetros para poder compararlos con los del JSON"""
+    return json.loads(json.dumps(params, sort_keys=True))
+
+def unit(output, inputs, params, *args):
+    """Unidad de trabajo: genera +output+ llamando a la función con +args+"""
+    return dict(output=output, inputs=list(inputs), params=params, args=args)
+
+def check_outputs(units):
+    """
+    Verifica que no haya dos unidades con la misma salida: se ejecutarían a
+    la vez sobre el mismo archivo, y el manifest sólo registraría una.  Por
+    ejemplo, dos escenas del mismo año y sensor en `post_process_toar` (ver
+    `query.py --selection`).
+
+    """
+    by_output = {}
+    for u in units:
+        by_output.setdefault(u['output'], []).append(u)
+    conflicts = ['{} <- {}'.format(output, ', '.join(str(u['args'][0]) for u in us))
+                 for output, us in sorted(by_output.items()) if len(us) > 1]
+    if conflicts:
+        raise ValueError('Varias unidades generan el mismo archivo:\n  ' +
+                '\n  '.join(conflicts))
+
+def call_unit(func, unit):
+    """
+    Ejecuta una unidad, capturando el error para poder registrarlo.  La
+    unidad ocupa un núcleo del presupuesto mientras corre (ver `budget`).
+
+    """
+    try:
+        with budget.task():
+            func(*unit['args'])
+        return unit, None
+    except Exception:
+        return unit, traceback.format_exc()
+
+def run_units(func, units, manifest, pool=None, force=False, name=''):
+    """
+    Ejecuta +func+ para cada unidad de +units+ que no esté al día en el
+    +manifest+ (o todas, si +force+), en +pool+ si se pasa uno.  Un error en
+    una unidad no interrumpe las demás.  Las salidas se registran en el
+    inventario de su árbol (ver `inventory`).
+
+    Devuelve la lista de unidades que fallaron.  Si dos unidades generan el
+    mismo archivo no ejecuta ninguna (ver `check_outputs`).
+
+    """
+    check_outputs(units)
+    pending = [u for u in units if force or not manifest.is_fresh(
+        u['output'], u['inputs'], u['params'])]
+    up_to_date = len(units) - len(pending)
+
+    worker = partial(call_unit, func)
+    results = pool.imap_unordered(worker, pending) if pool else map(worker, pending)
+
+    failed = []
+    for unit, error in results:
+        manifest.record(unit['output'], unit['inputs'], unit['params'],
+                error=error)
+        manifest.save()
+        if error:
+            failed.append(unit)
+            print('{} FAILED'.format(unit['output']))
+        else:
+            inventory.register(unit['output'])
+
+    report(name, up_to_date, len(pending) - len(failed), failed, manifest)
+    return failed
+
+def report(name, up_to_date, processed, failed, manifest):
+    print('{}: {} up to date, {} processed, {} failed'.format(
+        name or os.path.basename(manifest.path), up_to_date, processed,
+        len(failed)))
+    for unit in failed:
+        error = manifest.entries[unit['output']]['error']
+        last_line = error.strip().splitlines()[-1]
+        print('  {}: {}'.format(unit['output'], last_line))
@@ -0,0 +1,382 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Ejecuta todo el procesamiento (descarga, conversión a reflectancia ToA,
+post-procesamiento y generación de previews RGB) escena por escena.
+
+En lugar de terminar cada etapa sobre todas las escenas antes de empezar la
+siguiente, cada escena del CSV (ver `query.py`) pasa por las etapas apenas la
+anterior termina con ella: mientras una escena se está descargando, otra ya
+puede estar convirtiéndose a reflectancia y otra generando su preview.
+
+Cada etapa tiene su propia cantidad de escenas en paralelo (`--*-jobs`), y
+entre etapas hay colas de tamaño limitado (`--queue-size`), así que si una
+etapa es más lenta que la anterior, la anterior espera en lugar de acumular
+escenas descargadas.  Las etapas de cálculo reparten las bandas de cada
+escena en un pool de procesos compartido.
+
+Las bandas y previews que ya están al día según el manifest de la corrida se
+omiten, igual que en cada script por separado.
+
+```
+script/query.py EjidoMunicipal.shp | script/pipeline.py EjidoMunicipal.shp
+```
+
+"""
+import glob
+import os
+import queue
+import threading
+import time
+import traceback
+from functools import partial
+
+import budget
+import create_rgb_images
+import dn2toar
+import download
+import gapfill
+import inventory
+import post_process_toar
+import profiles
+import runlog
+import toar
+from blocks import threads_per_task
+from manifest import Manifest, call_unit, check_outputs, unit
+
+manifest_fname = '.pipeline.manifest.json'
+
+class Stage:
+    """
+    Etapa del pipeline: aplica +func+ a cada elemento de su cola de entrada,
+    con +workers+ hilos, y pasa el resultado a la etapa siguiente.  Si
+    +pooled+, +func+ ejecuta su trabajo en el pool de procesos (ver
+    `runlog.step`).
+
+    """
+
+    def __init__(self, name, func, workers=1, queue_size=2, pooled=False):
+        self.name = name
+        self.func = func
+        self.workers = workers
+        self.pooled = pooled
+        self.queue = queue.Queue(maxsize=queue_size)
+
+# Marca de fin en las colas
+done = object()
+
+def run_pipeline(stages, items, on_done=None):
+    """
+    Pasa cada elemento de +items+ por todas las +stages+.  Si una etapa falla
+    con un elemento, ese elemento no sigue, pero los demás sí.  Llama a
+    +on_done+ con cada elemento que terminó todas las etapas.
+
+    Devuelve la lista de elementos que fallaron, como (elemento, etapa, error).
+
+    """
+    failed = []
+    lock = threading.Lock()
+    active = [stage.workers for stage in stages]
+
+    def worker(i):
+        stage = stages[i]
+        next_queue = stages[i + 1].queue if i + 1 < len(stages) else None
+        while True:
+            task = stage.queue.get()
+            if task is done:
+                break
+            item, value, queued = task
+            try:
+                # Cuánto esperó la escena en la cola es parte del reporte
+                with runlog.step('pipeline.' + stage.name, scene=str(item),
+                        pooled=stage.pooled, queue_seconds=time.time() - queued):
+                    value = stage.func(value)
+            except Exception:
+                with lock:
+                    failed.append((item, stage.name, traceback.format_exc()))
+                print('{} FAILED at {}'.format(item, stage.name))
+                continue
+            if next_queue is not None:
+                next_queue.put((item, value, time.time()))
+            elif on_done:
+                on_done(item)
+
+        # El último hilo de la etapa avisa a la siguiente que no hay más
+        with lock:
+            active[i] -= 1
+            last = active[i] == 0
+        if last and next_queue is not None:
+            for _ in range(stages[i + 1].workers):
+                next_queue.put(done)
+
+    threads = [threading.Thread(target=worker, args=(i,), daemon=True)
+               for i, stage in enumerate(stages) for _ in range(stage.workers)]
+    for thread in threads:
+        thread.start()
+    for item, value in items:
+        stages[0].queue.put((item, value, time.time()))
+    for _ in range(stages[0].workers):
+        stages[0].queue.put(done)
+    for thread in threads:
+        thread.join()
+    return failed
+
+class SceneRunner:
+    """
+    Tareas de cada etapa para una escena.  Las unidades de cómputo (bandas o
+    previews) se ejecutan en +pool+ y se registran en +manifest+, salvo las
+    bandas ToA, que se registran en el manifest de `dn2toar` en +data_dir+.
+
+    """
+
+    def __init__(self, pool, manifest, data_dir, output_dir, shp_path,
+            tag_name=None, transport=None, retries=5, select=('all',),
+            method='dos3', engine='fused', profile=profiles.default_profile,
+            ref_hist=None, ref_hist_path=None, hist_decimation=1,
+            max_memory=create_rgb_images.max_memory_mb, threads=None,
+            gap_fill='composite', force=False):
+        self.pool = pool
+        self.manifest = manifest
+        self.lock = threading.Lock()
+        self.data_dir = data_dir
+        self.toar_manifest = Manifest(os.path.join(data_dir,
+            dn2toar.manifest_fname))
+        self.output_dir = output_dir
+        self.shp_path = shp_path
+        self.tag_name = tag_name
+        self.transport = transport
+        self.retries = retries
+        self.select = select
+        self.method = method
+        self.engine = engine
+        self.profile = profile
+        self.ref_hist = ref_hist
+        self.ref_hist_path = ref_hist_path
+        self.hist_decimation = hist_decimation
+        self.max_memory = max_memory
+        self.threads = threads
+        self.gap_fill = gap_fill
+        self.force = force
+        # Unidad (primer argumento) que genera cada salida en esta corrida
+        self.owners = {}
+
+    def unit_threads(self, units):
+        """Threads por unidad, si no se fijó `threads` (ver `threads_per_task`)"""
+        return self.threads or threads_per_task(len(units))
+
+    def run_units(self, func, units, manifest=None):
+        """
+        Ejecuta en el pool las unidades que no están al día, y las registra
+        en +manifest+ (por defecto, el de la corrida)
+
+        """
+        manifest = manifest or self.manifest
+        with self.lock:
+            # Dos escenas del mismo año y sensor generarían las mismas bandas
+            # (ver `manifest.check_outputs`); la segunda falla
+            check_outputs(units)
+            for u in units:
+                owner = self.owners.setdefault(u['output'], u['args'][0])
+                if owner != u['args'][0]:
+                    raise ValueError('{} ya lo genera {}'.format(u['output'], owner))
+            pending = [u for u in units if self.force or not manifest.is_fresh(
+                u['output'], u['inputs'], u['params'])]
+        results = self.pool.map(partial(call_unit, func), pending) if pending else []
+
+        errors = []
+        with self.lock:
+            for u, error in results:
+                manifest.record(u['output'], u['inputs'], u['params'],
+                        error=error)
+                if error:
+                    errors.append('{}: {}'.format(u['output'],
+                        error.strip().splitlines()[-1]))
+                else:
+                    inventory.register(u['output'])
+            manifest.save()
+        if errors:
+            raise RuntimeError('\n'.join(errors))
+
+    def download(self, product):
+        """Descarga el producto y devuelve el directorio con sus archivos"""
+        download.process_product(product, self.data_dir,
+                transport_name=self.transport, retries=self.retries,
+                select=self.select)
+        scene_dir = download.product_dir(product, self.data_dir)
+        return os.path.join(scene_dir,
+                os.path.basename(product['base_url'].rstrip('/')))
+
+    def toar(self, root):
+        """Convierte las bandas descargadas a reflectancia ToA"""
+        units = dn2toar.band_units(root, method=self.method,
+                profile=self.profile, shp_path=self.shp_path)
+        # Sólo se convierte el área que cubre el Shapefile (ver `aoi`).  Las
+        # bandas se registran en el manifest de `dn2toar`, junto a las
+        # descargas, que es el que consulta el relleno de gaps
+        self.run_units(partial(toar.convert_band, method=self.method,
+            profile=self.profile, threads=self.unit_threads(units),
+            shp_path=self.shp_path), units, manifest=self.toar_manifest)
+        return root
+
+    def post_process(self, root):
+        """Recorta y reescala las bandas ToA, y devuelve el directorio de salida"""
+        files = sorted(glob.glob(os.path.join(root, '*_TOAR_*.TIF')))
+        if not files:
+            raise ValueError('{} no tiene bandas ToA'.format(root))
+        worker = partial(post_process_toar.process, self.output_dir,
+                self.shp_path, tag_name=self.tag_name, engine=self.engine,
+                profile=self.profile, threads=self.unit_threads(files),
+                gap_fill=self.gap_fill)
+        params = dict(engine=self.engine, profile=self.profile,
+                gap_fill=self.gap_fill)
+        # Los gaps de Landsat 7 se rellenan con las escenas ya convertidas
+        # a ToA (ver `gapfill`)
+        units = [unit(post_process_toar.get_output_path(f, self.output_dir,
+                          tag_name=self.tag_name),
+                      [f, self.shp_path] + post_process_toar.fill_inputs(f,
+                          self.engine, self.gap_fill),
+                      params, f)
+                 for f in files]
+        self.run_units(worker, units)
+        metadata_path = os.path.join(os.path.dirname(root),
+                post_process_toar.metadata_fname)
+        if os.path.exists(metadata_path):
+            satsensor, year = post_process_toar.product_satsensor_year(root)
+            post_process_toar.copy_metadata_file(metadata_path, self.output_dir,
+                    satsensor, year, tag_name=self.tag_name)
+        return os.path.dirname(post_process_toar.get_output_path(files[0],
+            self.output_dir, tag_name=self.tag_name))
+
+    def rgb(self, root):
+        """Genera el preview RGB de la escena post-procesada"""
+        params = dict(engine='fused',
+                color_operations=create_rgb_images.color_operations,
+                profile=self.profile)
+        inputs = sorted(glob.glob(os.path.join(root, '*.TIF')))
+        if self.ref_hist is not None:
+            params.update(match_histogram=True,
+                    hist_decimation=self.hist_decimation)
+            inputs.append(self.ref_hist_path)
+        worker = partial(create_rgb_images.create_preview,
+                ref_hist=self.ref_hist, hist_decimation=self.hist_decimation,
+                max_memory=self.max_memory, profile=self.profile,
+                threads=self.unit_threads([root]))
+        self.run_units(worker, [unit(os.path.join(root, 'rgb_preview.tif'),
+            inputs, params, root)])
+        return root
+
+
+if __name__ == '__main__':
+    import argparse
+    import csv
+    import sys
+
+    parser = argparse.ArgumentParser(
+            description='Descarga y procesa escenas de Landsat de a una, ' \
+                        'desde la descarga hasta el preview RGB',
+            formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+
+    parser.add_argument('shape_file', metavar='SHAPE_FILE')
+    parser.add_argument('csvfile', metavar='CSV_FILE', nargs='?',
+            type=argparse.FileType('r'), default=sys.stdin)
+    parser.add_argument('--tag-name', '-t', nargs='?',
+            help='Nombre del conjunto de imágenes')
+    parser.add_argument('--data-dir', default='data/',
+            help='Ruta donde se almacenarán las imágenes descargadas')
+    parser.add_argument('--output-dir', '-o', default='processed_data/',
+            help='Ruta donde se guardarán las imágenes procesadas')
+    parser.add_argument('--select', nargs='+', choices=download.selections,
+            default=['all'], help='Conjuntos de bandas a descargar')
+    parser.add_argument('--transport', choices=sorted(download.transports),
+            help='Forma de descarga (por default, según la URL de cada producto)')
+    parser.add_argument('--retries', type=int, default=5,
+            help='Cantidad de reintentos por archivo descargado')
+    parser.add_argument('--method', choices=toar.methods, default='dos3',
+            help='Método de corrección atmosférica')
+    parser.add_argument('--engine', choices=('fused', 'gdal'), default='fused',
+            help='Motor de post-procesamiento')
+    parser.add_argument('--profile', choices=sorted(profiles.profiles),
+            default=profiles.default_profile,
+            help='Perfil de almacenamiento de los GeoTIFF (ver profiles.py)')
+    parser.add_argument('--gap-fill', choices=gapfill.methods, default='composite',
+            help='Relleno de gaps de Landsat 7 (ver post_process_toar.py)')
+    parser.add_argument('--reference-hist', metavar='HIST_JSON',
+            help='Histograma de referencia (ver create_rgb_images.py) para ' \
+                 'aplicar especificación de histograma a los previews')
+    parser.add_argument('--hist-decimation', type=int, default=1,
+            help='Calcula los histogramas sobre 1 de cada N píxeles por lado')
+    parser.add_argument('--max-memory', type=int,
+            default=create_rgb_images.max_memory_mb,
+            help='Memoria máxima (MB) por proceso para componer las imágenes RGB')
+    parser.add_argument('--download-jobs', type=int, default=4,
+            help='Escenas a descargar en paralelo')
+    parser.add_argument('--toar-jobs', type=int, default=2,
+            help='Escenas a convertir a reflectancia ToA en paralelo')
+    parser.add_argument('--post-jobs', type=int, default=2,
+            help='Escenas a post-procesar en paralelo')
+    parser.add_argument('--rgb-jobs', type=int, default=2,
+            help='Previews RGB a generar en paralelo')
+    parser.add_argument('--threads', type=int,
+            help='Threads por banda o imagen (por defecto, según la cantidad ' \
+                 'de bandas de cada escena y de núcleos)')
+    parser.add_argument('--queue-size', type=int, default=2,
+            help='Escenas que pueden esperar entre una etapa y la siguiente')
+    parser.add_argument('--force', action='store_true',
+            help='Reprocesa todas las bandas e imágenes, aunque ya estén al día')
+    parser.add_argument('--cpus', type=int,
+            help='Presupuesto de núcleos para procesos, threads y comandos ' \
+                 'externos (por defecto, todos los disponibles; ver budget.py)')
+    parser.add_argument('--run-log', metavar='RUN_LOG',
+            help='Registra cada paso en este log JSON-lines (ver runlog.py)')
+
+    args = parser.parse_args()
+    runlog.configure(args.run_log)
+    budget.configure(args.cpus)
+
+    if args.tag_name:
+        args.output_dir = os.path.join(args.output_dir, args.tag_name)
+
+    ref_hist = None
+    if args.reference_hist:
+        ref_hist = create_rgb_images.load_histogram(args.reference_hist)['counts']
+
+    manifest = Manifest(os.path.join(args.output_dir, manifest_fname))
+    products = [(row['id'], row) for row in csv.DictReader(args.csvfile)]
+
+    start = time.time()
+    finished = []
+
+    def on_done(item):
+        finished.append(item)
+        print('{} done ({:.1f}s)'.format(item, time.time() - start))
+
+    with budget.pool() as pool:
+        runner = SceneRunner(pool, manifest, args.data_dir, args.output_dir,
+                args.shape_file, tag_name=args.tag_name,
+                transport=args.transport, retries=args.retries,
+                select=tuple(args.select),
+                method=args.method, engine=args.engine, profile=args.profile,
+                ref_hist=ref_hist,
+                ref_hist_path=args.reference_hist,
+                hist_decimation=args.hist_decimation,
+                max_memory=args.max_memory, threads=args.threads,
+                gap_fill=args.gap_fill, force=args.force)
+        stages = [
+            Stage('download', runner.download, args.download_jobs, args.queue_size),
+            Stage('toar', runner.toar, args.toar_jobs, args.queue_size,
+                pooled=True),
+            Stage('post_process', runner.post_process, args.post_jobs,
+                args.queue_size, pooled=True),
+            Stage('rgb', runner.rgb, args.rgb_jobs, args.queue_size,
+                pooled=True),
+        ]
+        failed = run_pipeline(stages, products, on_done=on_done)
+
+    print('pipeline: {} scenes done, {} failed ({:.1f}s)'.format(
+        len(finished), len(failed), time.time() - start))
+    for item, stage, error in failed:
+        print('  {} ({}): {}'.format(item, stage, error.strip().splitlines()[-1]))
+    runlog.print_summary()
+
+    if failed:
+        raise SystemExit(1)
@@ -0,0 +1,84 @@
+# -*- coding: utf-8 -*-
+"""
+Escritura de imágenes PNG RGB de 8 bits por franjas de filas.
+
+El driver PNG de GDAL necesita tener la imagen completa antes de escribirla
+(sólo soporta CreateCopy).  Este escritor comprime las filas a medida que
+llegan, así que el uso de memoria no depende del tamaño de la imagen.
+
+"""
+import struct
+import zlib
+
+import numpy as np
+
+class PNGWriter:
+    """
+    Escribe un PNG RGB de +width+ x +height+ píxeles, de arriba a abajo.
+
+    Con +alpha+ se escribe además un canal alfa, a partir de la máscara de
+    píxeles válidos que se pasa a `write`.  Con +transparent+ (sin +alpha+)
+    el color (v, v, v) se declara transparente, aunque sea un píxel válido.
+
+    """
+    def __init__(self, path, width, height, transparent=None, alpha=False):
+        self.width, self.height = width, height
+        self.alpha = alpha
+        self.channels = 4 if alpha else 3
+        self.rows_written = 0
+        self._file = open(path, 'wb')
+        self._compressor = zlib.compressobj()
+
+        self._file.write(b'\x89PNG\r\n\x1a\n')
+        # 8 bits por canal, RGB (o RGBA), sin entrelazado
+        color_type = 6 if alpha else 2
+        self._chunk(b'IHDR', struct.pack('>IIBBBBB', width, height, 8,
+            color_type, 0, 0, 0))
+        if transparent is not None and not alpha:
+            value = int(transparent)
+            self._chunk(b'tRNS', struct.pack('>HHH', value, value, value))
+
+    def write(self, rgb, mask=None):
+        """
+        Escribe un bloque de filas, con forma (3, filas, columnas).  Con
+        +alpha+, los píxeles donde +mask+ es falso quedan transparentes (si no
+        se pasa +mask+, todos son opacos).
+
+        """
+        if self.alpha:
+            if mask is None:
+                mask = np.ones(rgb.shape[1:], dtype=bool)
+            alpha = np.where(mask, 255, 0).astype(np.uint8)[np.newaxis]
+            rgb = np.concatenate([np.asarray(rgb, dtype=np.uint8), alpha])
+        rows = np.ascontiguousarray(np.moveaxis(rgb, 0, -1), dtype=np.uint8)
+        rows = rows.reshape(rows.shape[0], self.width * self.channels)
+        # Cada fila empieza con el tipo de filtro (0: ninguno)
+        filtered = np.zeros((rows.shape[0], rows.shape[1] + 1), dtype=np.uint8)
+        filtered[:, 1:] = rows
+        data = self._compressor.compress(filtered.tobytes())
+        if data:
+            self._chunk(b'IDAT', data)
+        self.rows_written += rows.shape[0]
+
+    def close(self):
+        if self.rows_written != self.height:
+            self._file.close()
+            raise ValueError('Se escribieron {} filas de {}'.format(
+                self.rows_written, self.height))
+        self._chunk(b'IDAT', self._compressor.flush())
+        self._chunk(b'IEND', b'')
+        self._file.close()
+
+    def _chunk(self, tag, data):
+        self._file.write(struct.pack('>I', len(data)))
+        self._file.write(tag + data)
+        self._file.write(struct.pack('>I', zlib.crc32(tag + data) & 0xffffffff))
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.close()
+        else:
+            self._file.close()
@@ -33,16 +33,41 @@ En cada directorio se escribe un archivo `metadata.json` que contiene
 información sobre la escena utilizada.
 
 """
-import glob
 import os
 import shutil
-import subprocess
 import json
 from datetime import datetime
+from functools import partial
+
+import numpy as np
+import rasterio
+from rasterio.fill import fillnodata
+from rasterio.windows import Window
+
+import aoi
+import budget
+import gapfill
+import profiles
+import runlog
+from aoi import cutline_mask
+from blocks import ThreadDatasets, map_windows, row_windows
+from inventory import open_inventory
+from manifest import Manifest, run_units, unit
 
 metadata_fname = 'metadata.json'
+manifest_fname = '.post_process_toar.manifest.json'
 
-def process(out_dir, shp_path, in_path, tag_name=None, dry_run=False):
+# Distancia máxima (en píxeles) para rellenar gaps.  Es la misma que usa por
+# default gdal_fillnodata.py, y el margen que dejan las etapas anteriores
+# alrededor del AOI (ver `aoi`)
+fill_max_distance = aoi.margin
+
+# Cantidad de filas que se procesan por vez en el motor `fused`
+chunk_rows = 512
+
+def process(out_dir, shp_path, in_path, tag_name=None, engine='fused',
+        profile=profiles.default_profile, threads=1, gap_fill='composite',
+        dry_run=False):
     out_path = get_output_path(in_path, out_dir, tag_name=tag_name)
 
     # Crea directorio (si no existe)
@@ -51,9 +76,19 @@ def process(out_dir, shp_path, in_path, tag_name=None, dry_run=False):
         os.makedirs(out_dirname, exist_ok=True)
 
     # Procesa imagen
-    translate(in_path, out_path, dry_run=dry_run)
-    fill_gaps(out_path, dry_run=dry_run)
-    cut_image(out_path, shp_path, dry_run=dry_run)
+    scene = os.path.basename(os.path.dirname(in_path))
+    with runlog.step('post_process', scene=scene,
+            band=os.path.basename(out_path), engine=engine):
+        if engine == 'fused':
+            if dry_run:
+                print('process_band {} {} {}'.format(in_path, out_path, shp_path))
+            else:
+                process_band(in_path, out_path, shp_path, profile=profile,
+                        threads=threads, gap_fill=gap_fill)
+        else:
+            translate(in_path, out_path, dry_run=dry_run)
+            fill_gaps(out_path, dry_run=dry_run)
+            cut_image(out_path, shp_path, dry_run=dry_run)
 
     if not dry_run:
         print('{} written'.format(out_path))
@@ -64,10 +99,141 @@ def is_thermal_band(path):
     return ('LANDSAT_8' in path and any(b in path for b in ('B10', 'B11'))) or \
            (('LANDSAT_5' in path or 'LANDSAT_7' in path) and 'B6' in path)
 
+def needs_gap_fill(path):
+    """Sólo las imágenes del Landsat 7 tienen gaps por la falla del SLC"""
+    return 'LANDSAT_7-ETM' in path
+
+def process_band(in_path, out_path, shp_path, profile=profiles.default_profile,
+        threads=1, gap_fill='composite'):
+    """
+    Reescala, rellena gaps y recorta una banda ToA en una sola pasada
+
+    Equivale a `translate`, `fill_gaps` y `cut_image`, pero lee la banda
+    original por ventanas y escribe el resultado una única vez, sin archivos
+    intermedios.  El recorte se alinea a la grilla de la imagen original, así
+    que no hay remuestreo.  Los gaps se rellenan con el método +gap_fill+
+    (ver `gapfill`).  Las ventanas se reparten entre +threads+ threads.  La
+    banda se guarda con el perfil de almacenamiento +profile+ (ver
+    `profiles`).
+
+    """
+    thermal = is_thermal_band(in_path)
+    halo = fill_max_distance if needs_gap_fill(in_path) else 0
+    donor_paths = []
+    if halo and gap_fill == 'composite':
+        donor_paths = gapfill.donor_paths(in_path)
+
+    with rasterio.open(in_path) as src, ThreadDatasets(in_path) as datasets, \
+            gapfill.Donors(src, donor_paths) as donors:
+        mask = cutline_mask(shp_path, src)
+        crop = mask.crop
+        if donor_paths:
+            fit_window, _ = halo_window(src, crop,
+                    Window(0, 0, crop.width, crop.height), halo)
+            donors.fit(src, fit_window)
+
+        out_profile = profiles.raster_profile(src.profile, profile,
+                'uint16' if thermal else 'uint8',
+                nodata=0,
+                width=crop.width,
+                height=crop.height,
+                transform=src.window_transform(crop))
+
+        # Al menos una ventana por thread
+        rows = min(chunk_rows, -(-crop.height // threads))
+        windows = row_windows(crop.width, crop.height, rows)
+        func = partial(process_window, datasets, donors, mask, thermal, halo,
+                gap_fill)
+        with rasterio.open(out_path, 'w', **out_profile) as dst:
+            for window, out in map_windows(func, windows, threads):
+                dst.write(out, 1, window=window)
+
+    profiles.finalize(out_path, profile)
+    return out_path
+
+def process_window(datasets, donors, mask, thermal, halo, gap_fill, window):
+    """
+    Reescala, rellena gaps y recorta la ventana +window+ (relativa al recorte
+    de +mask+, ver `aoi.CutlineMask`) de la banda abierta en +datasets+.  Los
+    gaps se rellenan con las escenas de +donors+ (ver `gapfill.Donors`) y con
+    el método +gap_fill+.
+
+    """
+    src, = datasets.get()
+    # Ventana a leer en la imagen original, con un margen alrededor para que
+    # el relleno de gaps tenga contexto
+    src_window, inner = halo_window(src, mask.crop, window, halo)
+    data = profiles.read_float(src, window=src_window)
+    if halo and gap_fill != 'fillnodata':
+        gapfill.composite(data, donors.read(src_window))
+        gapfill.interpolate_gaps(data, fill_max_distance)
+
+    out = rescale(data, valid_mask(data, None), thermal)
+    if halo and gap_fill == 'fillnodata':
+        out = fillnodata(out, mask=out != 0,
+                max_search_distance=fill_max_distance,
+                smoothing_iterations=0)
+    out = out[inner]
+    out[~mask.window(window)] = 0
+    return window, out
+
+def fill_inputs(in_path, engine, gap_fill):
+    """
+    Escenas donantes que usa el relleno de gaps de +in_path+ (ver
+    `gapfill.donor_paths`), para que la banda se vuelva a procesar si cambian
+
+    """
+    if engine == 'fused' and gap_fill == 'composite' and needs_gap_fill(in_path):
+        return gapfill.donor_paths(in_path)
+    return []
+
+def halo_window(src, crop, window, halo):
+    """
+    Devuelve la ventana de +src+ que corresponde a +window+ (relativa a
+    +crop+) extendida +halo+ píxeles en cada dirección, y los slices para
+    recuperar la parte interior de lo leído.
+
+    """
+    row_start = max(crop.row_off + window.row_off - halo, 0)
+    col_start = max(crop.col_off + window.col_off - halo, 0)
+    row_stop = min(crop.row_off + window.row_off + window.height + halo,
+            src.height)
+    col_stop = min(crop.col_off + window.col_off + window.width + halo,
+            src.width)
+    src_window = Window(col_start, row_start,
+            col_stop - col_start, row_stop - row_start)
+
+    top = crop.row_off + window.row_off - row_start
+    left = crop.col_off + window.col_off - col_start
+    inner = (slice(top, top + window.height), slice(left, left + window.width))
+    return src_window, inner
+
+def valid_mask(data, nodata):
+    """Máscara de píxeles con datos válidos"""
+    valid = np.isfinite(data)
+    if nodata is not None and not np.isnan(nodata):
+        valid &= data != nodata
+    return valid
+
+def rescale(data, valid, thermal):
+    """
+    Reescala reflectancias de 0..1 a 1..255 (UInt8), como
+    `gdal_translate -scale 0 1 1 255`.  Las bandas térmicas se pasan a UInt16
+    sin reescalar.  Los píxeles no válidos quedan en 0 (nodata).
+
+    """
+    if thermal:
+        dtype, values, low, high = np.uint16, data, 0, 65535
+    else:
+        dtype, values, low, high = np.uint8, data * 254 + 1, 1, 255
+    out = np.zeros(data.shape, dtype=dtype)
+    out[valid] = np.clip(np.rint(values[valid]), low, high)
+    return out
+
 def translate(in_path, out_path, dry_run=False):
     """Convierte el raster a un GeoTIFF comprimido de UInt16"""
 
-    cmd = 'gdal_translate -q -of GTiff ' \
+    cmd = 'gdal_translate -q -of GTiff -unscale ' \
           '-a_nodata 0 {extra_opts} {src} -co compress=lzw {dst}'
 
     # Sólo reescala de 0..1 a 1..255 si no es banda térmica.
@@ -81,14 +247,24 @@ def translate(in_path, out_path, dry_run=False):
     if dry_run:
         print(cmd)
     else:
-        subprocess.run(cmd, shell=True)
+        with runlog.step('translate'):
+            runlog.run(cmd)
 
     return out_path
 
+def product_satsensor_year(product_dir):
+    """
+    Satélite-sensor y año del directorio de un producto
+    (`SAT-SENSOR/AÑO/escena/producto`), contando desde el final de la ruta
+
+    """
+    satsensor, year = os.path.normpath(product_dir).split(os.sep)[-4:-2]
+    return satsensor, year
+
 def get_output_path(in_path, out_dir, tag_name=None):
     """Construye la ruta destino de cada banda"""
     dirname, in_fname = os.path.split(in_path)
-    satsensor, year = dirname.split('/')[1:3]
+    satsensor, year = product_satsensor_year(dirname)
     _, band_num = in_fname.split('_B')
     out_fname = '{year}_{sat}_B{num}'.format(
             year=year, sat=satsensor, num=band_num)
@@ -105,58 +281,68 @@ def fill_gaps(in_path, dry_run=False):
     if dry_run:
         print(cmd)
     else:
-        subprocess.run(cmd, shell=True)
+        with runlog.step('fill_gaps'):
+            runlog.run(cmd)
     return in_path
 
 def cut_image(in_path, shp_path, dry_run=False):
-    """Corta la imagen usando el shapefile como máscara"""
+    """
+    Corta la imagen usando el shapefile como máscara.  gdalwarp usa los
+    núcleos libres del presupuesto (ver `budget`).
+
+    """
     tmp_path = in_path + '.tmp'
-    cmd = 'gdalwarp -q -cutline {shp} -co compress=lzw -overwrite -crop_to_cutline ' \
-          '{src} {dst}'.format(shp=shp_path, src=in_path, dst=tmp_path)
-    if dry_run:
-        print(cmd)
-        print('mv {} {}'.format(tmp_path, in_path))
-    else:
-        subprocess.run(cmd, shell=True)
-        shutil.move(tmp_path, in_path)
+    with budget.reserve(budget.cpus()) as threads:
+        cmd = 'gdalwarp -q -cutline {shp} -co compress=lzw -overwrite -crop_to_cutline ' \
+              '-wo NUM_THREADS={threads} {src} {dst}'.format(
+                      shp=shp_path, threads=threads, src=in_path, dst=tmp_path)
+        if dry_run:
+            print(cmd)
+            print('mv {} {}'.format(tmp_path, in_path))
+        else:
+            with runlog.step('cut_image'):
+                runlog.run(cmd, env=budget.thread_env(threads))
+            shutil.move(tmp_path, in_path)
     return in_path
 
-def all_scene_files(input_dir, pattern):
-    pat = os.path.join(input_dir, '**', pattern)
-    for root, _, files in os.walk(input_dir):
-        if files:
-            for path in glob.glob(os.path.join(root, pattern)):
-                yield path
+def all_scene_files(input_dir, pattern, dry_run=False):
+    """
+    Archivos inventariados de +input_dir+ cuyo nombre coincide con +pattern+.
+    En modo dry-run no se crea el inventario en +input_dir+.
+
+    """
+    return open_inventory(input_dir, create=not dry_run).match(pattern)
 
 def copy_metadata_files(input_dir, output_dir, tag_name=None, dry_run=False):
-    for root, _, files in os.walk(input_dir):
-        if metadata_fname in files:
-            src = os.path.join(root, metadata_fname)
+    for f in open_inventory(input_dir, create=not dry_run).files('product_metadata'):
+        copy_metadata_file(f['path'], output_dir, f['satsensor'], str(f['year']),
+                tag_name=tag_name, dry_run=dry_run)
 
-            satsensor, year = root.split('/')[1:3]
-            dst_dirname = os.path.join(output_dir, year, satsensor)
+def copy_metadata_file(src, output_dir, satsensor, year, tag_name=None,
+        dry_run=False):
+    """Copia el `metadata.json` de una escena al directorio de su año y sensor"""
+    dst_dirname = os.path.join(output_dir, year, satsensor)
 
-            if dry_run:
-                print('mkdir -p {}'.format(dst_dirname))
-            else:
-                os.makedirs(dst_dirname, exist_ok=True)
+    if dry_run:
+        print('mkdir -p {}'.format(dst_dirname))
+    else:
+        os.makedirs(dst_dirname, exist_ok=True)
 
-            dst_fname = '{year}_{sat}_{fname}'.format(
-                year=year, sat=satsensor, fname=metadata_fname)
-            if tag_name:
-                dst_fname = '{}_{}'.format(tag_name, dst_fname)
-            dst = os.path.join(dst_dirname, dst_fname)
+    dst_fname = '{year}_{sat}_{fname}'.format(
+        year=year, sat=satsensor, fname=metadata_fname)
+    if tag_name:
+        dst_fname = '{}_{}'.format(tag_name, dst_fname)
+    dst = os.path.join(dst_dirname, dst_fname)
 
-            if dry_run:
-                print('cp {} {}'.format(src, dst))
-            else:
-                shutil.copyfile(src, dst)
+    if dry_run:
+        print('cp {} {}'.format(src, dst))
+    else:
+        shutil.copyfile(src, dst)
 
 
 if __name__ == '__main__':
     import argparse
-    import multiprocessing
-    from functools import partial
+    from blocks import threads_per_task
 
     parser = argparse.ArgumentParser(
             description='Post-procesa imágenes ToA de Landsat',
@@ -171,23 +357,69 @@ if __name__ == '__main__':
             help='Ruta donde se guardarán las imágenes procesadas')
     parser.add_argument('--pattern', nargs='?', default='*_TOAR_*.TIF',
             help='Patrón de los archivos a ser procesados')
+    parser.add_argument('--engine', choices=('fused', 'gdal'), default='fused',
+            help='Motor de procesamiento: "fused" procesa cada banda en una ' \
+                 'sola pasada; "gdal" usa gdal_translate, gdal_fillnodata.py ' \
+                 'y gdalwarp')
+    parser.add_argument('--profile', choices=sorted(profiles.profiles),
+            default=profiles.default_profile,
+            help='Perfil de almacenamiento de las bandas (ver profiles.py, ' \
+                 'sólo motor "fused")')
+    parser.add_argument('--force', action='store_true',
+            help='Reprocesa todas las bandas, aunque ya estén al día')
+    parser.add_argument('--threads', type=int,
+            help='Threads por banda (por defecto, según la cantidad de ' \
+                 'bandas y de núcleos; sólo motor "fused")')
+    parser.add_argument('--gap-fill', choices=gapfill.methods, default='composite',
+            help='Relleno de gaps de Landsat 7: "composite" usa escenas de ' \
+                 'otras fechas e interpola el resto, "interpolate" sólo ' \
+                 'interpola, "fillnodata" usa el algoritmo de ' \
+                 'gdal_fillnodata.py (sólo motor "fused")')
     parser.add_argument('--dry-run', action='store_true',
             help='Imprime en pantalla los comandos, pero no los ejecuta')
+    parser.add_argument('--cpus', type=int,
+            help='Presupuesto de núcleos para procesos, threads y comandos ' \
+                 'externos (por defecto, todos los disponibles; ver budget.py)')
+    parser.add_argument('--run-log', metavar='RUN_LOG',
+            help='Registra cada paso en este log JSON-lines (ver runlog.py)')
 
     args = parser.parse_args()
+    runlog.configure(args.run_log)
+    budget.configure(args.cpus)
 
     if args.tag_name:
         args.output_dir = os.path.join(args.output_dir, args.tag_name)
 
-    count = multiprocessing.cpu_count()
-    with multiprocessing.Pool(count) as pool:
-        files = list(all_scene_files(args.input_dir, args.pattern))
+    failed = []
+    with budget.pool() as pool:
+        files = list(all_scene_files(args.input_dir, args.pattern,
+            dry_run=args.dry_run))
         worker = partial(process,
                 args.output_dir,
                 args.shape_file,
                 tag_name=args.tag_name,
+                engine=args.engine,
+                profile=args.profile,
+                threads=args.threads or threads_per_task(len(files)),
+                gap_fill=args.gap_fill,
                 dry_run=args.dry_run)
-        pool.map(worker, files)
+        if args.dry_run:
+            pool.map(worker, files)
+        else:
+            # Sólo procesa las bandas que no están al día
+            manifest = Manifest(os.path.join(args.output_dir, manifest_fname))
+            params = dict(engine=args.engine, profile=args.profile,
+                    gap_fill=args.gap_fill)
+            units = [unit(get_output_path(f, args.output_dir, tag_name=args.tag_name),
+                          [f, args.shape_file] + fill_inputs(f, args.engine, args.gap_fill),
+                          params, f)
+                     for f in files]
+            failed = run_units(worker, units, manifest, pool=pool,
+                    force=args.force, name='post_process_toar')
 
     copy_metadata_files(args.input_dir, args.output_dir,
         tag_name=args.tag_name, dry_run=args.dry_run)
+
+    runlog.print_summary()
+    if failed:
+        raise SystemExit(1)
@@ -0,0 +1,144 @@
+# -*- coding: utf-8 -*-
+"""
+Perfiles de almacenamiento de los GeoTIFF que escriben `dn2toar.py`,
+`post_process_toar.py` y `create_rgb_images.py`.
+
+Cada perfil define:
+
+  * `float_dtype`: tipo de dato de las bandas ToA.  Con `uint16` se guarda
+    el valor escalado, y la escala y offset quedan en los metadatos del
+    GeoTIFF (valor = DN * escala + offset; DN 0 es nodata).
+  * `tiled` y `blocksize`: organización interna en tiles de
+    `blocksize` x `blocksize` píxeles, o en franjas de filas.
+  * `compress` y `predictor`: compresión, con o sin predictor (horizontal
+    para enteros, de punto flotante para floats).
+  * `overviews`: si se agregan overviews internas y se reordena el archivo
+    como Cloud-Optimized GeoTIFF (COG), ver `finalize`.
+
+El perfil `legacy` reproduce el formato original (Float64, franjas, LZW sin
+predictor).  `zstd` requiere un GDAL compilado con soporte ZSTD.  Para
+comparar los perfiles, ver `benchmark.py --stage storage`.
+
+"""
+import os
+
+import numpy as np
+
+profiles = {
+    'legacy': dict(float_dtype='float64', tiled=False, blocksize=None,
+                   compress='lzw', predictor=False),
+    'float32': dict(float_dtype='float32', tiled=True, blocksize=512,
+                    compress='deflate', predictor=True),
+    'uint16': dict(float_dtype='uint16', tiled=True, blocksize=512,
+                   compress='deflate', predictor=True),
+    'zstd': dict(float_dtype='float32', tiled=True, blocksize=512,
+                 compress='zstd', predictor=True),
+    'cog': dict(float_dtype='float32', tiled=True, blocksize=512,
+                compress='deflate', predictor=True, overviews=True),
+}
+default_profile = 'float32'
+
+# Escala y offset de las bandas ToA guardadas como UInt16: reflectancia de
+# -0.1 a 1.21, y temperatura (K) de 0 a 655
+reflectance_scale = (2e-5, -0.1)
+temperature_scale = (0.01, 0.)
+
+def float_dtype(name):
+    """Tipo de dato con el que el perfil +name+ guarda valores reales"""
+    return profiles[name]['float_dtype']
+
+def creation_options(name, dtype):
+    """Opciones de creación (de rasterio) del perfil +name+ para +dtype+"""
+    profile = profiles[name]
+    opts = dict(driver='GTiff', compress=profile['compress'],
+            tiled=profile['tiled'])
+    if profile['tiled']:
+        opts.update(blockxsize=profile['blocksize'],
+                blockysize=profile['blocksize'])
+    if profile['predictor']:
+        opts['predictor'] = 3 if np.dtype(dtype).kind == 'f' else 2
+    return opts
+
+def raster_profile(src_profile, name, dtype, **kwargs):
+    """
+    Copia el perfil de rasterio de una imagen de entrada, reemplazando el
+    tipo de dato y las opciones de creación por las de +name+
+
+    """
+    profile = dict(src_profile)
+    for key in ('tiled', 'blockxsize', 'blockysize', 'compress', 'predictor'):
+        profile.pop(key, None)
+    profile.update(creation_options(name, dtype), dtype=dtype, **kwargs)
+    return profile
+
+def gdal_options(name, dtype):
+    """Las mismas opciones de creación, como `KEY=VALUE` para GDAL"""
+    opts = creation_options(name, dtype)
+    del opts['driver']
+    return ['{}={}'.format(k.upper(), 'YES' if v is True else 'NO' if v is False else v)
+            for k, v in sorted(opts.items())]
+
+def overview_factors(width, height, blocksize):
+    """Factores de overviews (2, 4, 8, ...) hasta que la imagen entre en un bloque"""
+    factors = []
+    factor = 2
+    while max(width, height) / (factor // 2) > blocksize:
+        factors.append(factor)
+        factor *= 2
+    return factors
+
+def finalize(path, name):
+    """
+    Si el perfil +name+ lo pide, agrega overviews internas al GeoTIFF de
+    +path+ y lo reescribe como Cloud-Optimized GeoTIFF: tiles, overviews y
+    metadatos ordenados para que un cliente pueda leer sólo las partes que
+    necesita con pedidos HTTP por rangos.
+
+    """
+    if not profiles[name].get('overviews'):
+        return path
+
+    import rasterio
+    import rasterio.shutil
+    from rasterio.enums import Resampling
+
+    with rasterio.open(path, 'r+') as dst:
+        factors = overview_factors(dst.width, dst.height,
+                profiles[name]['blocksize'])
+        if factors:
+            dst.build_overviews(factors, Resampling.average)
+        dtype = dst.dtypes[0]
+
+    tmp_path = path + '.cog'
+    rasterio.shutil.copy(path, tmp_path, copy_src_overviews=True,
+            **creation_options(name, dtype))
+    os.replace(tmp_path, path)
+    return path
+
+def encode(data, dtype, scale_offset):
+    """
+    Convierte valores reales (NaN como nodata) a +dtype+.  Para tipos
+    enteros aplica +scale_offset+, y usa 0 como nodata.
+
+    """
+    if np.dtype(dtype).kind == 'f':
+        return data.astype(dtype)
+    scale, offset = scale_offset
+    info = np.iinfo(dtype)
+    valid = np.isfinite(data)
+    out = np.zeros(data.shape, dtype=dtype)
+    out[valid] = np.clip(np.rint((data[valid] - offset) / scale), 1, info.max)
+    return out
+
+def read_float(src, band=1, window=None):
+    """
+    Lee una banda como float64, aplicando la escala y offset de los
+    metadatos, con NaN en los píxeles nodata
+
+    """
+    data = src.read(band, window=window, masked=True)
+    scale, offset = src.scales[band - 1], src.offsets[band - 1]
+    data = data.astype(np.float64)
+    if (scale, offset) != (1, 0):
+        data = data * scale + offset
+    return data.filled(np.nan)
@@ -5,8 +5,60 @@ Busca una imagen anual de Landsat o Sentinel-2 que recubra las figuras de un
 Shapefile determinado.  La salida del script es un CSV, con una imagen por
 fila, y su URL para descargar desde Google Cloud Storage.
 
+Por default (`--selection bbox`) se usa la consulta original: una escena por
+path/row (o tile) cuyo bounding box contiene el de las figuras.  Con
+`--selection cover` se buscan todas las escenas cuyo footprint intersecta las
+figuras, y para cada año y sensor se elige el menor conjunto de escenas que
+las cubre, prefiriendo las de menor nubosidad.  Con `--selection all` se
+devuelven todas las escenas cuyo footprint intersecta las figuras.
+
+`cover` y `all` pueden devolver varias escenas del mismo año y sensor, que
+sólo se pueden combinar con `composite.py`: `post_process_toar.py` y
+`pipeline.py` generan una banda por año y sensor, y fallan si hay más de una
+escena para la misma banda.
+
+Con `--catalog` la consulta se hace sobre un catálogo local (ver
+`catalog.py`) en lugar de BigQuery.
+
 """
 import sys
+from collections import OrderedDict
+
+selections = ('bbox', 'cover', 'all')
+
+# Columnas de las consultas de candidatos que no van en el CSV de salida
+footprint_fields = ('cloud_cover', 'west_lon', 'south_lat', 'east_lon', 'north_lat')
+
+# Columnas que definen cada grupo de escenas a cubrir, y las que identifican
+# escenas con el mismo footprint
+group_fields = {
+    'landsat': ('year', 'spacecraft_id', 'sensor_id'),
+    'sentinel2': ('year', 'spacecraft_id', 'sensor_id'),
+}
+tile_fields = {
+    'landsat': ('wrs_path', 'wrs_row'),
+    'sentinel2': ('mgrs_tile',),
+}
+
+# Área relativa que puede quedar sin cubrir (por errores de redondeo)
+cover_tolerance = 1e-6
+
+def feature_geometry_from(shape_file):
+    """
+    Devuelve la unión de las figuras del +shape_file+, reproyectada a WGS84
+
+    Se reproyectan todos los vértices, no sólo las esquinas del bounding box,
+    así que el área resultante no queda subestimada.
+
+    """
+    from fiona.transform import transform_geom
+    from shapely.geometry import shape
+    from shapely.ops import unary_union
+    import fiona
+
+    with fiona.open(shape_file, 'r') as source:
+        return unary_union([shape(transform_geom(source.crs_wkt, 'EPSG:4326',
+            f['geometry'])) for f in source])
 
 def feature_bounds_from(shape_file):
     """
@@ -16,24 +68,16 @@ def feature_bounds_from(shape_file):
     datasets de BigQuery.
 
     """
-    from pyproj import Proj, transform
-    import fiona
+    return feature_geometry_from(shape_file).bounds
 
-    with fiona.open(shape_file, 'r') as source:
-        orig_proj = Proj(source.crs)
-        dest_proj = Proj(init='EPSG:4326')
-        minx, miny, maxx, maxy = source.bounds
-        min_lon, min_lat = transform(orig_proj, dest_proj, minx, miny)
-        max_lon, max_lat = transform(orig_proj, dest_proj, maxx, maxy)
-        return (min_lon, min_lat, max_lon, max_lat)
-
-def query_images(shp_path, query_method, print_query=False):
+def query_images(shp_path, query_method, print_query=False, bounds=None):
     """Consulta el dataset de BigQuery y retorna los resultados."""
     from google.cloud import bigquery
 
     client = bigquery.Client()
 
-    bounds = feature_bounds_from(shp_path)
+    if bounds is None:
+        bounds = feature_bounds_from(shp_path)
 
     query_string = query_method(bounds)
     if print_query:
@@ -48,6 +92,88 @@ def query_images(shp_path, query_method, print_query=False):
 
     return results, fieldnames
 
+def query_catalog(shp_path, db_path, dataset, candidates=False, bounds=None):
+    """Consulta el catálogo local y retorna los resultados."""
+    import catalog
+
+    if bounds is None:
+        bounds = feature_bounds_from(shp_path)
+    if candidates:
+        return catalog.candidate_scenes(db_path, dataset, bounds)
+    return catalog.query_scenes(db_path, dataset, bounds)
+
+def footprint(scene):
+    """
+    Footprint de una escena.  Las tablas del índice sólo tienen el bounding
+    box (en WGS84) de cada escena, así que se usa ese rectángulo.
+
+    """
+    from shapely.geometry import box
+    return box(float(scene['west_lon']), float(scene['south_lat']),
+            float(scene['east_lon']), float(scene['north_lat']))
+
+def scene_rank(scene):
+    """Orden de preferencia entre escenas: menor nubosidad, más antigua"""
+    return float(scene['cloud_cover']), scene['sensing_time']
+
+def covering_scenes(scenes, aoi, dataset):
+    """
+    De las escenas candidatas, elige para cada año y sensor el menor conjunto
+    cuyos footprints cubren +aoi+, prefiriendo las de menor nubosidad.
+    Devuelve las escenas ordenadas como la consulta original (año y satélite
+    en orden descendente), sin las columnas de `footprint_fields`.
+
+    """
+    groups = OrderedDict()
+    for scene in scenes:
+        if not footprint(scene).intersects(aoi):
+            continue
+        key = tuple(scene[f] for f in group_fields[dataset])
+        tile = tuple(scene[f] for f in tile_fields[dataset])
+        tiles = groups.setdefault(key, {})
+        if tile not in tiles or scene_rank(scene) < scene_rank(tiles[tile]):
+            tiles[tile] = scene
+
+    for key in sorted(groups, reverse=True):
+        for scene in greedy_cover(list(groups[key].values()), aoi):
+            yield dict((k, v) for k, v in scene.items() if k not in footprint_fields)
+
+def intersecting_scenes(scenes, aoi, dataset):
+    """
+    Todas las escenas candidatas cuyo footprint intersecta +aoi+, ordenadas
+    como la consulta original (año y satélite en orden descendente) y por
+    fecha, sin las columnas de `footprint_fields`
+
+    """
+    selected = [s for s in scenes if footprint(s).intersects(aoi)]
+    selected.sort(key=lambda s: s['sensing_time'])
+    selected.sort(key=lambda s: tuple(s[f] for f in group_fields[dataset]),
+            reverse=True)
+    for scene in selected:
+        yield dict((k, v) for k, v in scene.items() if k not in footprint_fields)
+
+def greedy_cover(scenes, aoi):
+    """
+    Elige escenas de a una, cada vez la que más área sin cubrir de +aoi+
+    agrega (y entre las que agregan lo mismo, la de menor nubosidad), hasta
+    cubrir +aoi+ o hasta que ninguna agregue área.
+
+    """
+    candidates = sorted(scenes, key=scene_rank)
+    remaining = aoi
+    selected = []
+    while candidates and remaining.area > aoi.area * cover_tolerance:
+        gains = [remaining.intersection(footprint(s)).area for s in candidates]
+        best = max(gains)
+        if best <= 0:
+            break
+        idx = next(i for i, gain in enumerate(gains)
+                if gain >= best * (1 - cover_tolerance))
+        scene = candidates.pop(idx)
+        selected.append(scene)
+        remaining = remaining.difference(footprint(scene))
+    return selected
+
 def build_landsat_query(bounding_box):
     """Genera la consulta para el dataset de Landsat."""
     west_lon, south_lat, east_lon, north_lat = bounding_box
@@ -83,6 +209,37 @@ def build_landsat_query(bounding_box):
           'spacecraft_id DESC')
     return qs.format(west_lon, south_lat, east_lon, north_lat)
 
+def build_landsat_candidates_query(bounding_box):
+    """Genera la consulta de escenas de Landsat que intersectan el bounding box."""
+    west_lon, south_lat, east_lon, north_lat = bounding_box
+    qs = ('SELECT '
+          'scene_id AS id, '
+          'YEAR(sensing_time) AS year, '
+          'sensing_time, '
+          'spacecraft_id, '
+          'sensor_id, '
+          'wrs_path, '
+          'wrs_row, '
+          'total_size, '
+          'base_url, '
+          'FLOAT(cloud_cover) AS cloud_cover, '
+          'west_lon, '
+          'south_lat, '
+          'east_lon, '
+          'north_lat '
+        'FROM '
+          '[bigquery-public-data:cloud_storage_geo_index.landsat_index] '
+        'WHERE '
+          'west_lon < {2} '
+          'AND south_lat < {3} '
+          'AND east_lon > {0} '
+          'AND north_lat > {1} '
+          'AND FLOAT(cloud_cover) < 1 '
+          'AND collection_number = "01" '
+          'AND data_type = "L1TP" '
+          'AND sensor_id IN ("TM", "ETM", "OLI_TIRS")')
+    return qs.format(west_lon, south_lat, east_lon, north_lat)
+
 def build_sentinel2_query(bounding_box):
     """Genera la consulta para el dataset de Sentinel-2."""
     west_lon, south_lat, east_lon, north_lat = bounding_box
@@ -112,6 +269,35 @@ def build_sentinel2_query(bounding_box):
           'year DESC')
     return qs.format(west_lon, south_lat, east_lon, north_lat)
 
+def build_sentinel2_candidates_query(bounding_box):
+    """Genera la consulta de granules de Sentinel-2 que intersectan el bounding box."""
+    west_lon, south_lat, east_lon, north_lat = bounding_box
+    qs = ('SELECT '
+          'product_id AS id, '
+          'YEAR(sensing_time) AS year, '
+          'sensing_time, '
+          '"SENTINEL_2" AS spacecraft_id, '
+          '"MSI" AS sensor_id, '
+          'granule_id, '
+          'mgrs_tile, '
+          'total_size, '
+          'base_url, '
+          'FLOAT(cloud_cover) AS cloud_cover, '
+          'west_lon, '
+          'south_lat, '
+          'east_lon, '
+          'north_lat '
+        'FROM '
+          '[bigquery-public-data:cloud_storage_geo_index.sentinel_2_index] '
+        'WHERE '
+          'west_lon < {2} '
+          'AND south_lat < {3} '
+          'AND east_lon > {0} '
+          'AND north_lat > {1} '
+          'AND FLOAT(cloud_cover) < 1 '
+          'AND geometric_quality_flag = "PASSED"')
+    return qs.format(west_lon, south_lat, east_lon, north_lat)
+
 def writecsv(results, fieldnames):
     """Escribe a stdout un CSV con los resultados."""
     import csv
@@ -129,11 +315,36 @@ if __name__ == '__main__':
     parser.add_argument('shape_file', metavar='SHAPE_FILE')
     parser.add_argument('--dataset', '-d', default='landsat', help='Dataset de imágenes. Opciones: landsat, sentinel2')
     parser.add_argument('--print-query', default=False, action='store_true', help='Imprime la consulta BigQuery')
+    parser.add_argument('--catalog', help='Catálogo local (ver catalog.py) a usar en lugar de BigQuery')
+    parser.add_argument('--selection', choices=selections, default='bbox',
+            help='"bbox": una escena por path/row que contiene su bounding box; ' \
+                 '"cover": menor conjunto de escenas que cubre las figuras; ' \
+                 '"all": todas las escenas que las intersectan (cover y all ' \
+                 'son para composite.py)')
     args = parser.parse_args()
 
     # Hace la consulta al dataset pedido
-    query_method = build_landsat_query if args.dataset == 'landsat' else build_sentinel2_query
-    results, fieldnames = query_images(args.shape_file, query_method, args.print_query)
+    cover = args.selection in ('cover', 'all')
+    aoi = feature_geometry_from(args.shape_file)
+    if args.catalog:
+        results, fieldnames = query_catalog(args.shape_file, args.catalog,
+                args.dataset, candidates=cover, bounds=aoi.bounds)
+    else:
+        if args.dataset == 'landsat':
+            query_method = build_landsat_candidates_query if cover else build_landsat_query
+        else:
+            query_method = build_sentinel2_candidates_query if cover else build_sentinel2_query
+        results, fieldnames = query_images(args.shape_file, query_method,
+                args.print_query, bounds=aoi.bounds)
+
+    # Elige el menor conjunto de escenas que cubre las figuras, o todas las
+    # que las intersectan
+    if cover:
+        if args.selection == 'all':
+            results = intersecting_scenes(results, aoi, args.dataset)
+        else:
+            results = covering_scenes(results, aoi, args.dataset)
+        fieldnames = [f for f in fieldnames if f not in footprint_fields]
 
     # Escribe a stdout un CSV con los resultados
     writecsv(results, fieldnames)
@@ -0,0 +1,377 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Registro de cada paso del procesamiento en un log JSON-lines, y resumen de
+una corrida.
+
+Los scripts marcan cada paso con `step`, y ejecutan los comandos externos
+(gdalwarp, rio color, etc.) con `run`.  Por cada paso se escribe una línea
+con:
+
+  * `step`, `scene` y demás campos propios del paso (p.ej. `band`)
+  * `seconds`: tiempo transcurrido
+  * `cpu_seconds`: tiempo de CPU del proceso (o thread) y de los
+    subprocesos que terminaron durante el paso
+  * `bytes_read` y `bytes_written`: bytes leídos y escritos (incluye los
+    subprocesos), según /proc
+  * `subprocesses`: comando, tiempo, CPU y pico de memoria de cada comando
+    externo del paso, y `subprocess_peak_rss_mb`, el mayor de esos picos
+  * `worker_peak_rss_mb`: el pico de memoria del proceso
+  * `worker`: nombre del proceso y thread, y `pid`
+  * `cpu_budget`: presupuesto de núcleos de la corrida (ver `budget`)
+  * `error`, si el paso falló
+
+Un paso que sólo espera las tareas de un pool (`step(..., pooled=True)`) no
+registra CPU ni bytes (quedan en null): el trabajo lo hacen otros procesos,
+que registran sus propios pasos.
+
+El log se activa con `--run-log PATH` en cada script, o con la variable de
+entorno `RUN_LOG`, que heredan los procesos de los pools y los scripts
+lanzados desde un mismo shell.  Varios procesos pueden escribir a la vez en
+el mismo log.  Sin log, `step` no mide nada.
+
+Para resumir un log (pasos más lentos, rezagados y utilización del
+presupuesto de núcleos):
+
+```
+script/runlog.py run.jsonl
+```
+
+"""
+import json
+import multiprocessing
+import os
+import resource
+import subprocess
+import sys
+import threading
+import time
+from contextlib import contextmanager
+from datetime import datetime
+
+import budget
+
+env_var = 'RUN_LOG'
+run_env_var = 'RUN_LOG_ID'
+
+# Un paso es rezagado si tarda más que este múltiplo de la mediana de su
+# tipo de paso (con al menos `straggler_min_count` pasos de ese tipo)
+straggler_factor = 2.
+straggler_min_count = 3
+
+_local = threading.local()
+
+def configure(path=None):
+    """
+    Activa el log en +path+ (o en la ruta de la variable de entorno
+    `RUN_LOG`).  La ruta y el identificador de la corrida se guardan en el
+    entorno, así que los procesos hijos escriben en el mismo log.  Devuelve
+    la ruta del log, o None si no hay log.
+
+    """
+    path = path or os.environ.get(env_var)
+    if not path:
+        return None
+    os.environ[env_var] = os.path.abspath(path)
+    os.environ.setdefault(run_env_var,
+            '{}-{}'.format(datetime.now().strftime('%Y%m%dT%H%M%S'), os.getpid()))
+    return os.environ[env_var]
+
+def log_path():
+    return os.environ.get(env_var)
+
+def write(record):
+    """Agrega un registro al log, con una única escritura en modo append"""
+    path = log_path()
+    if not path:
+        return
+    record = dict(record, run=os.environ.get(run_env_var),
+            script=os.path.basename(sys.argv[0]), time=time.time())
+    line = (json.dumps(record, sort_keys=True) + '\n').encode()
+    fd = os.open(path, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+    try:
+        os.write(fd, line)
+    finally:
+        os.close(fd)
+
+def in_main_thread():
+    return threading.current_thread() is threading.main_thread()
+
+def io_counters():
+    """
+    Bytes leídos y escritos por el proceso (incluye los subprocesos ya
+    terminados), o por el thread actual si no es el principal
+
+    """
+    path = '/proc/self/io' if in_main_thread() else '/proc/thread-self/io'
+    counters = {}
+    try:
+        with open(path) as f:
+            for line in f:
+                key, value = line.split(':')
+                counters[key] = int(value)
+    except (IOError, ValueError):
+        return 0, 0
+    return counters.get('rchar', 0), counters.get('wchar', 0)
+
+def cpu_seconds():
+    """
+    Tiempo de CPU del proceso y de los subprocesos terminados, o sólo del
+    thread actual si no es el principal (los subprocesos de cada thread se
+    suman aparte, ver `run`)
+
+    """
+    if not in_main_thread() and hasattr(resource, 'RUSAGE_THREAD'):
+        usage = resource.getrusage(resource.RUSAGE_THREAD)
+        return usage.ru_utime + usage.ru_stime
+    usage = resource.getrusage(resource.RUSAGE_SELF)
+    children = resource.getrusage(resource.RUSAGE_CHILDREN)
+    return usage.ru_utime + usage.ru_stime + children.ru_utime + children.ru_stime
+
+def peak_rss_mb():
+    """Pico de memoria residente del proceso actual"""
+    try:
+        with open('/proc/self/status') as f:
+            for line in f:
+                if line.startswith('VmHWM:'):
+                    return int(line.split()[1]) / 1024.
+    except IOError:
+        pass
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.
+
+def worker_name():
+    name = multiprocessing.current_process().name
+    if not in_main_thread():
+        name = '{}/{}'.format(name, threading.current_thread().name)
+    return name
+
+@contextmanager
+def step(name, scene=None, pooled=False, **fields):
+    """
+    Mide un paso del procesamiento y lo registra en el log.  Los pasos se
+    pueden anidar; un paso anidado hereda la escena del que lo contiene.  Si
+    +pooled+, el paso sólo espera tareas de un pool y no se miden CPU ni
+    bytes.
+
+    """
+    if not log_path():
+        yield
+        return
+
+    stack = getattr(_local, 'stack', None)
+    if stack is None:
+        stack = _local.stack = []
+    parent = stack[-1] if stack else None
+    if scene is None and parent is not None:
+        scene = parent['scene']
+    current = dict(step=name, scene=scene, subprocesses=[])
+    stack.append(current)
+
+    read0, written0 = io_counters()
+    cpu0 = cpu_seconds()
+    start = time.time()
+    error = None
+    try:
+        yield
+    except BaseException as e:
+        error = '{}: {}'.format(type(e).__name__, e)
+        raise
+    finally:
+        elapsed = time.time() - start
+        read1, written1 = io_counters()
+        stack.pop()
+        subs = current['subprocesses']
+        cpu = cpu_seconds() - cpu0
+        if not in_main_thread():
+            cpu += sum(s['cpu_seconds'] for s in subs)
+        if pooled:
+            cpu, read1, written1 = None, None, None
+        record = dict(fields,
+                step=name,
+                scene=scene,
+                parent=parent['step'] if parent else None,
+                seconds=elapsed,
+                cpu_seconds=cpu,
+                bytes_read=read1 - read0 if read1 is not None else None,
+                bytes_written=written1 - written0 if written1 is not None else None,
+                subprocesses=subs,
+                subprocess_peak_rss_mb=max([s['peak_rss_mb'] for s in subs] or [None]),
+                worker_peak_rss_mb=peak_rss_mb(),
+                worker=worker_name(),
+                pid=os.getpid(),
+                cpu_budget=budget.cpus(),
+                error=error)
+        if parent is not None:
+            parent['subprocesses'].extend(subs)
+        write(record)
+
+def exit_code(status):
+    if os.WIFSIGNALED(status):
+        return -os.WTERMSIG(status)
+    return os.WEXITSTATUS(status)
+
+def run(cmd, shell=True, check=True, env=None):
+    """
+    Ejecuta un comando externo, como `subprocess.run(cmd, shell=shell,
+    check=check, env=env)`, y registra su tiempo, CPU y pico de memoria en el
+    paso actual
+
+    """
+    start = time.time()
+    proc = subprocess.Popen(cmd, shell=shell, env=env)
+    _, status, usage = os.wait4(proc.pid, 0)
+    proc.returncode = exit_code(status)
+
+    stack = getattr(_local, 'stack', None)
+    if stack:
+        stack[-1]['subprocesses'].append(dict(
+            command=(cmd if shell else ' '.join(cmd)).split()[0],
+            seconds=time.time() - start,
+            cpu_seconds=usage.ru_utime + usage.ru_stime,
+            peak_rss_mb=usage.ru_maxrss / 1024.))
+
+    if check and proc.returncode != 0:
+        raise subprocess.CalledProcessError(proc.returncode, cmd)
+    return proc
+
+def read_log(path, run_id=None):
+    """Registros del log de +path+, sólo los de la corrida +run_id+ si se pasa"""
+    records = []
+    with open(path) as f:
+        for line in f:
+            line = line.strip()
+            if not line:
+                continue
+            record = json.loads(line)
+            if run_id is None or record.get('run') == run_id:
+                records.append(record)
+    return records
+
+def median(values):
+    values = sorted(values)
+    n = len(values)
+    return (values[n // 2] + values[(n - 1) // 2]) / 2.
+
+def summarize(records):
+    """
+    Resume los registros de un log.  Devuelve un diccionario con los totales
+    de cada tipo de paso (`steps`, ordenados por tiempo total), los pasos
+    rezagados (`stragglers`) y los que fallaron (`failed`).
+
+    `utilization` es la fracción del presupuesto de núcleos que se usó: el
+    tiempo de CPU de los pasos de primer nivel (los anidados ya están
+    incluidos) sobre el tiempo total por la cantidad de núcleos.  En cada
+    tipo de paso, `cores` es la cantidad media de núcleos que usó.  Los pasos
+    que sólo esperan un pool no tienen CPU ni bytes, y sus totales quedan en
+    None.
+
+    """
+    by_step = {}
+    for r in records:
+        by_step.setdefault(r['step'], []).append(r)
+
+    steps, stragglers = [], []
+    for name, rs in by_step.items():
+        seconds = [r['seconds'] for r in rs]
+        med = median(seconds)
+        subs = [r['subprocess_peak_rss_mb'] for r in rs
+                if r.get('subprocess_peak_rss_mb') is not None]
+        measured = [r for r in rs if r['cpu_seconds'] is not None]
+        cpu = sum(r['cpu_seconds'] for r in measured) if measured else None
+        steps.append(dict(step=name,
+            count=len(rs),
+            total_seconds=sum(seconds),
+            median_seconds=med,
+            max_seconds=max(seconds),
+            cpu_seconds=cpu,
+            cores=cpu / max(sum(r['seconds'] for r in measured), 1e-9)
+                if measured else None,
+            bytes_read=sum(r['bytes_read'] for r in measured) if measured else None,
+            bytes_written=sum(r['bytes_written'] for r in measured) if measured else None,
+            subprocess_peak_rss_mb=max(subs) if subs else None,
+            worker_peak_rss_mb=max(r['worker_peak_rss_mb'] for r in rs)))
+        if len(rs) >= straggler_min_count:
+            for r in rs:
+                if r['seconds'] > straggler_factor * med:
+                    stragglers.append(dict(r, median_seconds=med))
+
+    steps.sort(key=lambda s: s['total_seconds'], reverse=True)
+    stragglers.sort(key=lambda r: r['seconds'] / max(r['median_seconds'], 1e-9),
+            reverse=True)
+    times = [r['time'] for r in records]
+    wall = max(times) - min(r['time'] - r['seconds'] for r in records) if records else 0.
+    cpus = max([r.get('cpu_budget') or 0 for r in records] or [0]) or None
+    cpu = sum(r['cpu_seconds'] or 0 for r in records if r.get('parent') is None)
+    return dict(records=len(records),
+            wall_seconds=wall,
+            cpu_budget=cpus,
+            cpu_seconds=cpu,
+            utilization=cpu / (wall * cpus) if cpus and wall else None,
+            steps=steps,
+            stragglers=stragglers,
+            failed=[r for r in records if r.get('error')])
+
+def format_bytes(n):
+    for unit in ('B', 'KB', 'MB', 'GB'):
+        if abs(n) < 1024 or unit == 'GB':
+            return '{:.1f} {}'.format(n, unit) if unit != 'B' else '{} B'.format(n)
+        n /= 1024.
+
+def format_summary(summary, top=10):
+    lines = ['{} steps logged, {:.1f} s wall'.format(summary['records'],
+        summary['wall_seconds'])]
+    if summary['utilization'] is not None:
+        lines.append('CPU: {:.1f} s on a budget of {} cores, {:.0%} utilization'.format(
+            summary['cpu_seconds'], summary['cpu_budget'], summary['utilization']))
+    lines.append('Slowest steps (total time):')
+    for s in summary['steps'][:top]:
+        line = ('  {step}: {count} runs, total {total_seconds:.1f} s, '
+                'median {median_seconds:.2f} s, max {max_seconds:.2f} s').format(**s)
+        if s['cpu_seconds'] is None:
+            line += ', waiting on a pool'
+        else:
+            line += ', cpu {cpu_seconds:.1f} s ({cores:.1f} cores)'.format(**s)
+            line += ', read {}, written {}'.format(format_bytes(s['bytes_read']),
+                    format_bytes(s['bytes_written']))
+        if s['subprocess_peak_rss_mb'] is not None:
+            line += ', subprocess peak {:.0f} MB'.format(s['subprocess_peak_rss_mb'])
+        lines.append(line)
+    if summary['stragglers']:
+        lines.append('Stragglers (more than {:.0f}x the median of their step):'.format(
+            straggler_factor))
+        for r in summary['stragglers'][:top]:
+            lines.append('  {step} {scene} on {worker}: {seconds:.2f} s '
+                    '(median {median_seconds:.2f} s)'.format(**r))
+    for r in summary['failed']:
+        lines.append('Failed: {step} {scene} on {worker}: {error}'.format(**r))
+    return '\n'.join(lines)
+
+def print_summary():
+    """Imprime el resumen de la corrida actual, si hay log"""
+    path = log_path()
+    if path and os.path.exists(path):
+        records = read_log(path, run_id=os.environ.get(run_env_var))
+        print(format_summary(summarize(records)))
+
+
+if __name__ == '__main__':
+    import argparse
+
+    parser = argparse.ArgumentParser(
+            description='Resume un log de pasos del procesamiento',
+            formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    parser.add_argument('log', metavar='RUN_LOG',
+            help='Log JSON-lines (ver --run-log de cada script)')
+    parser.add_argument('--run',
+            help='Resume sólo esta corrida (campo "run" del log)')
+    parser.add_argument('--top', type=int, default=10,
+            help='Cantidad de pasos y rezagados a mostrar')
+    parser.add_argument('--json', action='store_true',
+            help='Imprime el resumen como JSON')
+    args = parser.parse_args()
+
+    summary = summarize(read_log(args.log, run_id=args.run))
+    if args.json:
+        print(json.dumps(summary, indent=2, sort_keys=True))
+    else:
+        print(format_summary(summary, top=args.top))
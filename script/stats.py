@@ -0,0 +1,241 @@
+# -*- coding: utf-8 -*-
+"""
+Estadísticas aproximadas de rasters: histogramas por banda, percentiles y
+funciones de distribución acumulada (CDF).
+
+Los histogramas se calculan por ventanas, así que no hace falta cargar la
+imagen completa.  Con `decimation` > 1 se lee una muestra regular de la
+imagen (1 de cada `decimation` píxeles en cada dirección); si el GeoTIFF tiene
+overviews, GDAL las usa automáticamente para esa lectura.
+
+Los percentiles se devuelven junto con una cota del error:
+
+  * `rank_error`: error en el cuantil.  Es 0 si se leyó la imagen completa;
+    con una muestra de n píxeles se usa la desigualdad de
+    Dvoretzky-Kiefer-Wolfowitz, sqrt(ln(2 / alpha) / 2n), con confianza
+    1 - alpha = 99%.
+  * `value_error`: error en el valor, por el ancho de los bins.  Es 0 para
+    imágenes enteras de 8 y 16 bits, donde hay un bin por valor.
+
+Los resultados se guardan en un archivo `<raster>.stats.json` junto a cada
+imagen, y se reutilizan mientras la imagen no cambie.
+
+"""
+import json
+import math
+import os
+from collections import namedtuple
+
+import numpy as np
+import rasterio
+
+from blocks import row_windows, rows_for_memory
+
+# Cantidad de bins para imágenes de punto flotante
+float_bins = 1024
+
+# Confianza de la cota de error de los percentiles
+confidence = 0.99
+
+Percentile = namedtuple('Percentile', ['value', 'rank_error', 'value_error'])
+
+class Histogram:
+    """
+    Histograma por banda de un raster.
+
+    Para tipos enteros de hasta 16 bits hay un bin por valor.  Para otros
+    tipos se usan `bins` bins entre `value_range`.
+
+    """
+
+    def __init__(self, count, dtype, bins=float_bins, value_range=None,
+            decimation=1):
+        dtype = np.dtype(dtype)
+        if dtype.kind in 'ui' and dtype.itemsize <= 2:
+            info = np.iinfo(dtype)
+            self.integer = True
+            self.offset = int(info.min)
+            self.bins = int(info.max) - int(info.min) + 1
+            self.value_range = (info.min, info.max)
+        else:
+            if value_range is None:
+                raise ValueError('value_range es necesario para {}'.format(dtype))
+            self.integer = False
+            self.offset = 0
+            self.bins = bins
+            self.value_range = tuple(float(v) for v in value_range)
+        self.decimation = decimation
+        self.counts = np.zeros((count, self.bins), dtype=np.int64)
+
+    def update(self, data, valid):
+        """
+        Suma un bloque +data+ (bandas, filas, columnas).  +valid+ es una
+        máscara de píxeles válidos por bloque (filas, columnas) o por banda.
+
+        """
+        for i, band in enumerate(data):
+            mask = valid[i] if valid.ndim == 3 else valid
+            values = band[mask]
+            if self.integer:
+                self.counts[i] += np.bincount(values.astype(np.int64) - self.offset,
+                        minlength=self.bins)
+            else:
+                counts, _ = np.histogram(values, bins=self.bins,
+                        range=self.value_range)
+                self.counts[i] += counts
+
+    @property
+    def bin_width(self):
+        if self.integer:
+            return 1
+        low, high = self.value_range
+        return (high - low) / self.bins
+
+    def bin_values(self):
+        """Valor representativo (borde inferior) de cada bin"""
+        if self.integer:
+            return np.arange(self.bins) + self.offset
+        low, _ = self.value_range
+        return low + np.arange(self.bins) * self.bin_width
+
+    def cdf(self, band=None):
+        """CDF de una banda, o de todas juntas si +band+ es None"""
+        counts = self.counts.sum(axis=0) if band is None else self.counts[band]
+        total = counts.sum()
+        if not total:
+            return np.zeros(self.bins)
+        return np.cumsum(counts).astype(np.float64) / total
+
+    def rank_error(self, band=None):
+        """Cota del error en cuantil de la CDF de la muestra"""
+        if self.decimation == 1:
+            return 0.
+        counts = self.counts.sum() if band is None else self.counts[band].sum()
+        if not counts:
+            return 1.
+        return math.sqrt(math.log(2 / (1 - confidence)) / (2 * counts))
+
+    def percentile(self, q, band=None):
+        """Percentil +q+ (0..100) de una banda, o de todas si +band+ es None"""
+        cdf = self.cdf(band)
+        idx = min(int(np.searchsorted(cdf, q / 100., side='left')), self.bins - 1)
+        value = self.bin_values()[idx]
+        value_error = 0 if self.integer else self.bin_width
+        return Percentile(value, self.rank_error(band), value_error)
+
+    def to_dict(self):
+        return dict(integer=self.integer, offset=self.offset, bins=self.bins,
+                value_range=list(self.value_range), decimation=self.decimation,
+                counts=self.counts.tolist())
+
+    @classmethod
+    def from_dict(cls, d):
+        hist = cls.__new__(cls)
+        hist.integer = d['integer']
+        hist.offset = d['offset']
+        hist.bins = d['bins']
+        hist.value_range = tuple(d['value_range'])
+        hist.decimation = d['decimation']
+        hist.counts = np.array(d['counts'], dtype=np.int64)
+        return hist
+
+def valid_mask(data, nodata, mask='band'):
+    """
+    Máscara de píxeles válidos.  Con +mask+ 'band' cada banda tiene su propia
+    máscara; con 'dataset' un píxel es válido si alguna banda no es nodata
+    (como la máscara de dataset de GDAL).
+
+    """
+    if nodata is None:
+        valid = np.ones(data.shape, dtype=bool)
+    elif np.isnan(nodata):
+        valid = ~np.isnan(data)
+    else:
+        valid = data != nodata
+    if data.dtype.kind == 'f':
+        valid &= np.isfinite(data)
+    if mask == 'dataset':
+        return valid.any(axis=0)
+    return valid
+
+def sampled_windows(src, bands, decimation, max_memory=64):
+    """
+    Lee +bands+ de +src+ por franjas, tomando 1 de cada +decimation+ píxeles
+    en cada dirección.  Devuelve bloques de (bandas, filas, columnas).
+
+    """
+    rows = rows_for_memory(src, len(bands), max_memory)
+    # Las franjas tienen que ser múltiplo de la decimación, para que la
+    # muestra sea regular en toda la imagen
+    rows = max(rows - rows % decimation, decimation)
+    out_width = max(src.width // decimation, 1)
+    for window in row_windows(src.width, src.height, rows):
+        if decimation == 1:
+            yield src.read(bands, window=window)
+            continue
+        out_height = window.height // decimation
+        if not out_height:
+            continue
+        yield src.read(bands, window=window,
+                out_shape=(len(bands), out_height, out_width))
+
+def raster_histogram(path, bands=None, decimation=1, bins=float_bins,
+        value_range=None, mask='band', max_memory=64):
+    """Calcula el histograma de +bands+ de un raster, por ventanas"""
+    with rasterio.open(path) as src:
+        bands = list(bands or src.indexes)
+        dtype = src.dtypes[bands[0] - 1]
+        if value_range is None and np.dtype(dtype).kind == 'f':
+            value_range = data_range(src, bands, decimation, max_memory)
+        hist = Histogram(len(bands), dtype, bins=bins, value_range=value_range,
+                decimation=decimation)
+        for data in sampled_windows(src, bands, decimation, max_memory):
+            hist.update(data, valid_mask(data, src.nodata, mask=mask))
+    return hist
+
+def data_range(src, bands, decimation, max_memory=64):
+    """Mínimo y máximo de los píxeles válidos, sobre la misma muestra"""
+    low, high = np.inf, -np.inf
+    for data in sampled_windows(src, bands, decimation, max_memory):
+        values = data[valid_mask(data, src.nodata)]
+        if values.size:
+            low, high = min(low, values.min()), max(high, values.max())
+    if low > high:
+        return (0., 1.)
+    if low == high:
+        high = low + 1
+    return (float(low), float(high))
+
+def cache_path(path):
+    return '{}.stats.json'.format(path)
+
+def cached_histogram(path, bands=None, decimation=1, bins=float_bins,
+        value_range=None, mask='band', max_memory=64):
+    """
+    Igual que `raster_histogram`, pero guarda el resultado en
+    `<path>.stats.json` y lo reutiliza mientras el raster no cambie.
+
+    """
+    stat = os.stat(path)
+    source = dict(size=stat.st_size, mtime=stat.st_mtime)
+    key = json.dumps(dict(bands=bands, decimation=decimation, bins=bins,
+        value_range=value_range, mask=mask), sort_keys=True)
+
+    cache = {}
+    if os.path.exists(cache_path(path)):
+        with open(cache_path(path)) as f:
+            cache = json.load(f)
+        if cache.get('source') != source:
+            cache = {}
+        elif key in cache.get('histograms', {}):
+            return Histogram.from_dict(cache['histograms'][key])
+
+    hist = raster_histogram(path, bands=bands, decimation=decimation,
+            bins=bins, value_range=value_range, mask=mask,
+            max_memory=max_memory)
+
+    cache['source'] = source
+    cache.setdefault('histograms', {})[key] = hist.to_dict()
+    with open(cache_path(path), 'w') as f:
+        json.dump(cache, f)
+    return hist
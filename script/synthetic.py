@@ -0,0 +1,370 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Genera productos Landsat 5, 7 y 8 sintéticos, con la misma estructura que
+deja `download.py`, para probar y medir el procesamiento sin conexión:
+
+```
+data/
+    LANDSAT_7-ETM/
+        2009/
+            LE72290822009005LGN00/
+                metadata.json
+                LE07_L1TP_229082_20090105_20100101_01_T1/
+                    LE07_L1TP_229082_20090105_20100101_01_T1_B1.TIF
+                    ...
+                    LE07_L1TP_229082_20090105_20100101_01_T1_MTL.txt
+```
+
+Cada producto tiene:
+
+  * Todas las bandas del sensor, como GeoTIFF sin comprimir y por franjas,
+    igual que los productos L1 de USGS (UInt8 para TM y ETM+, UInt16 para
+    OLI/TIRS; la pancromática con el doble de resolución).
+  * Un `_MTL.txt` con las constantes de calibración reales de cada sensor,
+    de forma que los DNs se convierten en reflectancias y temperaturas
+    plausibles con `toar.py`.
+  * El borde sin datos de una escena rotada, y en Landsat 7 los gaps en
+    franjas de la falla del SLC, más anchos hacia los bordes.
+
+También puede escribir un Shapefile con un área de interés en el centro de
+las escenas, para `post_process_toar.py`:
+
+```
+script/synthetic.py data/ --size 2000 --years 2003 2009 2017 --shape-file aoi.shp
+```
+
+"""
+import json
+import math
+import os
+from datetime import date
+
+import numpy as np
+import rasterio
+from rasterio.transform import from_origin
+from rasterio.windows import Window
+
+import toar
+
+# Escenas en la zona UTM 20S, centradas en Córdoba
+crs = 'EPSG:32720'
+center = (437000., 6525000.)
+pixel_size = 30.
+
+wrs_path, wrs_row = 229, 82
+
+# Constantes de calibración por sensor: radiancia máxima y mínima por banda,
+# y rango de DNs.  Son las de los MTL de USGS (Chander et al. 2009 para TM y
+# ETM+, en ganancia baja).
+sensors = {
+    'LANDSAT_5': dict(sensor_id='TM', prefix='LT05', scene_prefix='LT5',
+        dtype='uint8', qcal=(1, 255),
+        radiance={'1': (193.0, -1.52), '2': (365.0, -2.84), '3': (264.0, -1.17),
+                  '4': (221.0, -1.51), '5': (30.2, -0.37), '6': (15.303, 1.238),
+                  '7': (16.5, -0.15)}),
+    'LANDSAT_7': dict(sensor_id='ETM', prefix='LE07', scene_prefix='LE7',
+        dtype='uint8', qcal=(1, 255),
+        radiance={'1': (293.7, -6.2), '2': (300.9, -6.4), '3': (234.4, -5.0),
+                  '4': (241.1, -5.1), '5': (47.57, -1.0),
+                  '6_VCID_1': (17.04, 0.0), '6_VCID_2': (12.65, 3.2),
+                  '7': (16.54, -0.35), '8': (243.1, -4.7)}),
+    'LANDSAT_8': dict(sensor_id='OLI_TIRS', prefix='LC08', scene_prefix='LC8',
+        dtype='uint16', qcal=(1, 65535),
+        radiance={'1': (748.0, -61.8), '2': (766.0, -63.3), '3': (706.0, -58.3),
+                  '4': (595.0, -49.2), '5': (364.0, -30.1), '6': (90.6, -7.5),
+                  '7': (30.5, -2.5), '8': (674.0, -55.7), '9': (141.0, -11.6),
+                  '10': (22.0, 0.10033), '11': (22.0, 0.10033)},
+        reflectance=(1.2107, -0.09998),
+        thermal={'10': (774.8853, 1321.0789), '11': (480.8883, 1201.1442)}),
+}
+
+# Bandas pancromáticas, con el doble de resolución
+pan_bands = {'LANDSAT_7': '8', 'LANDSAT_8': '8'}
+
+# Reflectancia media de cada banda según su longitud de onda (vegetación
+# y suelo urbano mezclados), y temperatura media (K) y variación de las
+# térmicas
+reflectance_by_wavelength = ((.5, .07), (.6, .09), (.7, .11), (.9, .28),
+                             (1.4, .05), (1.8, .25), (2.4, .18))
+mean_temperature = 300.
+thermal_range = 20.
+
+# Ángulo (grados) de la traza del satélite respecto al norte
+scene_rotation = 12.
+
+# Geometría de los gaps del SLC-off: período (filas) y ancho máximo en los
+# bordes de la escena
+slc_period = 32
+slc_max_gap = 14
+
+rows_per_chunk = 256
+
+# Días entre dos pasadas de un mismo satélite sobre un path/row
+revisit_days = 16
+
+def scene_identifiers(spacecraft, year, doy=5):
+    """Devuelve (scene_id, product_id, fecha) con el formato de USGS"""
+    sensor = sensors[spacecraft]
+    acquired = date.fromordinal(date(year, 1, 1).toordinal() + doy - 1)
+    scene_id = '{}{:03d}{:03d}{}{:03d}LGN00'.format(sensor['scene_prefix'],
+            wrs_path, wrs_row, year, doy)
+    product_id = '{}_L1TP_{:03d}{:03d}_{}_{}_01_T1'.format(sensor['prefix'],
+            wrs_path, wrs_row, acquired.strftime('%Y%m%d'),
+            '{}0101'.format(year + 1))
+    return scene_id, product_id, acquired
+
+def band_size(spacecraft, band, size):
+    return size * 2 if pan_bands.get(spacecraft) == band else size
+
+def mtl_metadata(spacecraft, product_id, scene_id, acquired, size):
+    """Metadatos del `_MTL.txt`, como diccionario plano (ver `toar.parse_mtl`)"""
+    sensor = sensors[spacecraft]
+    qmin, qmax = sensor['qcal']
+    west = center[0] - size * pixel_size / 2.
+    north = center[1] + size * pixel_size / 2.
+    md = [
+        ('LANDSAT_SCENE_ID', scene_id),
+        ('LANDSAT_PRODUCT_ID', product_id),
+        ('DATA_TYPE', 'L1TP'),
+        ('COLLECTION_CATEGORY', 'T1'),
+        ('SPACECRAFT_ID', spacecraft),
+        ('SENSOR_ID', sensor['sensor_id']),
+        ('WRS_PATH', str(wrs_path)),
+        ('WRS_ROW', str(wrs_row)),
+        ('DATE_ACQUIRED', acquired.isoformat()),
+        ('SCENE_CENTER_TIME', '13:58:19.0000000Z'),
+        ('CORNER_UL_PROJECTION_X_PRODUCT', '{:.3f}'.format(west)),
+        ('CORNER_UL_PROJECTION_Y_PRODUCT', '{:.3f}'.format(north)),
+        ('CLOUD_COVER', '0.00'),
+        ('SUN_AZIMUTH', '85.0'),
+        ('SUN_ELEVATION', '60.0'),
+        ('EARTH_SUN_DISTANCE', '0.9833'),
+        ('MAP_PROJECTION', 'UTM'),
+        ('DATUM', 'WGS84'),
+        ('UTM_ZONE', '20'),
+        ('GRID_CELL_SIZE_REFLECTIVE', '{:.2f}'.format(pixel_size)),
+    ]
+    for band in sorted(sensor['radiance'], key=lambda b: (len(b.split('_')[0]), b)):
+        lmax, lmin = sensor['radiance'][band]
+        md += [
+            ('FILE_NAME_BAND_{}'.format(band),
+                '{}_B{}.TIF'.format(product_id, band)),
+            ('RADIANCE_MAXIMUM_BAND_{}'.format(band), '{:.5f}'.format(lmax)),
+            ('RADIANCE_MINIMUM_BAND_{}'.format(band), '{:.5f}'.format(lmin)),
+            ('QUANTIZE_CAL_MAX_BAND_{}'.format(band), str(qmax)),
+            ('QUANTIZE_CAL_MIN_BAND_{}'.format(band), str(qmin)),
+        ]
+        if band in sensor.get('thermal', {}):
+            k1, k2 = sensor['thermal'][band]
+            md += [('K1_CONSTANT_BAND_{}'.format(band), '{:.4f}'.format(k1)),
+                   ('K2_CONSTANT_BAND_{}'.format(band), '{:.4f}'.format(k2))]
+        elif 'reflectance' in sensor:
+            rmax, rmin = sensor['reflectance']
+            md += [('REFLECTANCE_MAXIMUM_BAND_{}'.format(band), '{:.6f}'.format(rmax)),
+                   ('REFLECTANCE_MINIMUM_BAND_{}'.format(band), '{:.6f}'.format(rmin))]
+    return md
+
+def write_mtl(path, metadata):
+    with open(path, 'w') as f:
+        f.write('GROUP = L1_METADATA_FILE\n')
+        for key, value in metadata:
+            quoted = not value.replace('.', '').replace('-', '').isdigit()
+            f.write('    {} = {}\n'.format(key, '"{}"'.format(value) if quoted else value))
+        f.write('END_GROUP = L1_METADATA_FILE\nEND\n')
+
+def band_mean(spacecraft, band):
+    """Reflectancia (o temperatura) media de la banda"""
+    low, high = toar.wavelengths_by_spacecraft[spacecraft][band]
+    if low > 10.:
+        return mean_temperature
+    wavelength = (low + high) / 2.
+    for limit, value in reflectance_by_wavelength:
+        if wavelength <= limit:
+            return value
+    return reflectance_by_wavelength[-1][1]
+
+def texture(rows, cols, size, seed):
+    """
+    Campo de valores alrededor de 1: parcelas suaves, una mancha urbana en
+    el centro y ruido, con las mismas formas en todas las bandas
+
+    """
+    y, x = rows / float(size), cols / float(size)
+    field = 1. + 0.25 * np.sin(x * 37.) * np.cos(y * 29.)
+    field += 0.3 * np.exp(-((x - .5) ** 2 + (y - .5) ** 2) / 0.01)
+    rng = np.random.RandomState(seed)
+    return field + rng.normal(0, 0.03, field.shape)
+
+def footprint_mask(rows, cols, size):
+    """Píxeles dentro de la escena rotada (el resto es el borde sin datos)"""
+    angle = math.radians(scene_rotation)
+    y, x = rows - size / 2., cols - size / 2.
+    u = x * math.cos(angle) - y * math.sin(angle)
+    v = x * math.sin(angle) + y * math.cos(angle)
+    half = size / 2. / (math.cos(angle) + math.sin(angle))
+    return (np.abs(u) < half) & (np.abs(v) < half)
+
+def slc_gaps(rows, cols, size, shift=0.):
+    """
+    Gaps de la falla del SLC de Landsat 7: franjas casi horizontales, sin
+    gap en el centro de la escena y de hasta `slc_max_gap` filas en los
+    bordes.  Las franjas se desplazan una fracción +shift+ del período (cambian
+    de una fecha a otra).
+
+    """
+    dist = np.abs(cols - size / 2.) / (size / 2.)
+    width = slc_max_gap * dist * size / 6000.
+    period = max(slc_period * size / 6000., 2)
+    phase = (rows + shift * period + cols * 0.05) % period
+    return phase < width
+
+def dn_chunk(calib, mean, rows, cols, size, seed, dtype, thermal):
+    """DNs de un bloque de filas, invirtiendo la calibración de `toar`"""
+    field = texture(rows, cols, size, seed)
+    if thermal:
+        values = mean + thermal_range * (field - 1.)
+        rad = calib['k1'] / (np.exp(calib['k2'] / values) - 1.)
+    else:
+        rad = mean * field * calib['rad_sun']
+    dn = (rad - calib['bias']) / calib['gain']
+    info = np.iinfo(dtype)
+    return np.clip(np.rint(dn), calib['qcalmin'], info.max).astype(dtype)
+
+def write_band(path, spacecraft, band, metadata, size, seed, gap_shift=0.):
+    sensor = sensors[spacecraft]
+    n = band_size(spacecraft, band, size)
+    res = pixel_size * size / n
+    profile = dict(driver='GTiff', width=n, height=n, count=1,
+            dtype=sensor['dtype'], crs=crs,
+            transform=from_origin(center[0] - n * res / 2.,
+                center[1] + n * res / 2., res, res))
+    thermal = toar.is_thermal(metadata, band)
+    calib = toar.band_calibration(metadata, band, method='uncorrected')
+    mean = band_mean(spacecraft, band)
+
+    with rasterio.open(path, 'w', **profile) as dst:
+        for row_off in range(0, n, rows_per_chunk):
+            height = min(rows_per_chunk, n - row_off)
+            rows, cols = np.mgrid[row_off:row_off + height, 0:n].astype(np.float64)
+            dn = dn_chunk(calib, mean, rows, cols, n, seed + row_off,
+                    sensor['dtype'], thermal)
+            valid = footprint_mask(rows, cols, n)
+            if spacecraft == 'LANDSAT_7':
+                valid &= ~slc_gaps(rows, cols, n, shift=gap_shift)
+            dn[~valid] = 0
+            dst.write(dn, 1, window=Window(0, row_off, n, height))
+    return path
+
+def create_product(output_dir, spacecraft, year, size, bands=None, seed=0,
+        doy=5):
+    """
+    Crea un producto sintético de +spacecraft+ (p.ej. 'LANDSAT_7') para el
+    día +doy+ de +year+, de +size+ x +size+ píxeles de 30 m, en
+    +output_dir+.  Con +bands+ sólo escribe esas bandas (el MTL siempre las
+    lista todas).  Devuelve el directorio del producto.
+
+    """
+    sensor = sensors[spacecraft]
+    scene_id, product_id, acquired = scene_identifiers(spacecraft, year, doy=doy)
+    satsensor = '{}-{}'.format(spacecraft, sensor['sensor_id'])
+    scene_dir = os.path.join(output_dir, satsensor, str(year), scene_id)
+    root = os.path.join(scene_dir, product_id)
+    os.makedirs(root, exist_ok=True)
+
+    md = mtl_metadata(spacecraft, product_id, scene_id, acquired, size)
+    mtl_path = os.path.join(root, '{}_MTL.txt'.format(product_id))
+    write_mtl(mtl_path, md)
+    metadata = toar.parse_mtl(mtl_path)
+
+    for i, band in enumerate(toar.mtl_bands(metadata)):
+        if bands and band not in bands:
+            continue
+        write_band(toar.band_path(root, metadata, band), spacecraft, band,
+                metadata, size, seed + 1000 * i, gap_shift=gap_shift(doy))
+
+    # Lo mismo que escribe download.py a partir de la consulta
+    product = dict(id=scene_id, year=str(year),
+            sensing_time='{}T13:58:19Z'.format(acquired.isoformat()),
+            spacecraft_id=spacecraft, sensor_id=sensor['sensor_id'],
+            wrs_path=str(wrs_path), wrs_row=str(wrs_row), cloud_cover='0.0',
+            total_size=str(sum(os.path.getsize(os.path.join(root, f))
+                for f in os.listdir(root))),
+            base_url='gs://gcp-public-data-landsat/{}/01/{:03d}/{:03d}/{}'.format(
+                sensor['prefix'], wrs_path, wrs_row, product_id))
+    with open(os.path.join(scene_dir, 'metadata.json'), 'w') as f:
+        f.write(json.dumps(product))
+
+    print('{} written'.format(root))
+    return root
+
+def gap_shift(doy):
+    """
+    Desplazamiento de los gaps del SLC (ver `slc_gaps`) de una escena del
+    día +doy+: 0 para el día 5, y distinto para cada pasada siguiente
+
+    """
+    return ((doy - 5) / revisit_days * 0.618) % 1.
+
+def spacecraft_for_year(year):
+    """El satélite que usa el procesamiento para cada año"""
+    if year >= 2013:
+        return 'LANDSAT_8'
+    if year >= 2003 and year % 2:
+        return 'LANDSAT_7'
+    return 'LANDSAT_5'
+
+def write_aoi(path, size, fraction=0.3):
+    """
+    Escribe un Shapefile con un polígono en el centro de las escenas, que
+    ocupa +fraction+ de su lado
+
+    """
+    import fiona
+    from fiona.crs import from_epsg
+
+    half = size * pixel_size * fraction / 2.
+    x, y = center
+    ring = [(x - half, y - half * .8), (x + half * .7, y - half),
+            (x + half, y + half * .6), (x - half * .4, y + half),
+            (x - half, y - half * .8)]
+    schema = dict(geometry='Polygon', properties=dict(name='str'))
+    with fiona.open(path, 'w', driver='ESRI Shapefile', schema=schema,
+            crs=from_epsg(int(crs.split(':')[1]))) as dst:
+        dst.write(dict(geometry=dict(type='Polygon', coordinates=[ring]),
+            properties=dict(name='aoi')))
+    return path
+
+
+if __name__ == '__main__':
+    import argparse
+
+    parser = argparse.ArgumentParser(
+            description='Genera productos Landsat sintéticos',
+            formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    parser.add_argument('output_dir', metavar='OUTPUT_DIR', nargs='?',
+            default='data/',
+            help='Directorio donde se crean los productos')
+    parser.add_argument('--size', type=int, default=2000,
+            help='Tamaño de las escenas (píxeles de 30 m por lado)')
+    parser.add_argument('--years', type=int, nargs='+', default=[2003, 2009, 2017],
+            help='Años de los productos; el satélite se elige según el año')
+    parser.add_argument('--spacecraft', choices=sorted(sensors),
+            help='Usa este satélite para todos los años')
+    parser.add_argument('--bands', nargs='+',
+            help='Escribe sólo estas bandas (p.ej. 2 3 4)')
+    parser.add_argument('--scenes-per-year', type=int, default=1,
+            help='Escenas por año, cada 16 días (para `composite.py`)')
+    parser.add_argument('--shape-file',
+            help='Escribe también un Shapefile con un área de interés')
+    args = parser.parse_args()
+
+    for year in args.years:
+        for i in range(args.scenes_per_year):
+            create_product(args.output_dir,
+                    args.spacecraft or spacecraft_for_year(year), year,
+                    args.size, bands=args.bands, seed=year + 10000 * i,
+                    doy=5 + revisit_days * i)
+    if args.shape_file:
+        write_aoi(args.shape_file, args.size)
+        print('{} written'.format(args.shape_file))
@@ -0,0 +1,271 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Genera una pirámide de tiles XYZ (Web Mercator, el esquema de
+OpenStreetMap/Leaflet y de los `TileMatrixSet` de WMTS `GoogleMapsCompatible`)
+a partir de los previews RGB, en PNG o WebP con transparencia.
+
+```
+processed_data/
+    2009/
+        LANDSAT_5-TM/
+            rgb_preview.tif
+            tiles/
+                tiles.json
+                13/
+                    2789/
+                        4870.png
+                        ...
+```
+
+  * El nivel de zoom más detallado se corta directamente del preview,
+    reproyectando cada tile con un `WarpedVRT`.  Los niveles de menor
+    zoom se arman a partir de los 4 tiles hijos ya generados, así que el
+    preview se lee una sola vez.
+  * Los tiles de cada nivel se generan en paralelo, con un pool de procesos
+    (`--jobs`), de a una columna de tiles por tarea.
+  * Los tiles vacíos (fuera de la máscara del Shapefile, es decir todo
+    nodata) no se escriben.
+
+`tiles.json` describe la pirámide en formato TileJSON, para usarla desde un
+visor web.
+
+```
+script/tiles.py processed_data/ --format webp
+```
+
+"""
+import json
+import math
+import os
+import shutil
+
+import numpy as np
+import rasterio
+from rasterio.enums import Resampling
+from rasterio.transform import from_bounds
+from rasterio.vrt import WarpedVRT
+from rasterio.warp import transform_bounds
+
+import budget
+import runlog
+
+formats = ('png', 'webp')
+
+tile_size = 256
+
+# Mitad del lado del mundo en Web Mercator (metros)
+origin_shift = 2 * math.pi * 6378137 / 2.
+
+# Cantidad de niveles de zoom por defecto, contando desde el más detallado
+default_levels = 6
+
+webp_quality = 85
+
+def tile_bounds(z, x, y):
+    """Extensión (oeste, sur, este, norte) del tile z/x/y en EPSG:3857"""
+    size = 2 * origin_shift / 2 ** z
+    west = -origin_shift + x * size
+    north = origin_shift - y * size
+    return west, north - size, west + size, north
+
+def tile_range(bounds, z):
+    """
+    Rango de tiles (x_min, y_min, x_max, y_max), inclusive, que cubre
+    +bounds+ (en EPSG:3857) en el zoom +z+
+
+    """
+    west, south, east, north = bounds
+    count = 2 ** z
+    size = 2 * origin_shift / count
+    eps = 1e-9
+
+    def clamp(v):
+        return min(max(int(math.floor(v)), 0), count - 1)
+
+    return (clamp((west + origin_shift) / size),
+            clamp((origin_shift - north) / size),
+            clamp((east + origin_shift) / size - eps),
+            clamp((origin_shift - south) / size - eps))
+
+def native_zoom(path):
+    """
+    Zoom cuya resolución es igual o más fina que la del GeoTIFF de +path+
+
+    """
+    with rasterio.open(path) as src:
+        west, _, east, _ = transform_bounds(src.crs, 'EPSG:3857', *src.bounds)
+        # Resolución en metros de Web Mercator
+        res = (east - west) / src.width
+    return int(math.ceil(math.log(2 * origin_shift / (tile_size * res), 2)))
+
+def tile_path(tiles_dir, z, x, y, fmt):
+    return os.path.join(tiles_dir, str(z), str(x), '{}.{}'.format(y, fmt))
+
+def write_tile(rgba, path, fmt):
+    """Guarda un tile RGBA (filas, columnas, 4), salvo que esté vacío"""
+    from PIL import Image
+    if not rgba[..., 3].any():
+        return False
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    img = Image.fromarray(rgba, 'RGBA')
+    if fmt == 'webp':
+        img.save(path, 'WEBP', quality=webp_quality)
+    else:
+        img.save(path, 'PNG')
+    return True
+
+def render_tile(src, z, x, y):
+    """
+    Corta el tile z/x/y del preview +src+ (abierto con rasterio), como un
+    arreglo RGBA de (filas, columnas, 4).  El canal alfa es 0 donde el
+    preview es nodata.
+
+    """
+    from create_rgb_images import png_scale
+
+    transform = from_bounds(*tile_bounds(z, x, y), tile_size, tile_size)
+    with WarpedVRT(src, crs='EPSG:3857', transform=transform, width=tile_size,
+            height=tile_size, resampling=Resampling.bilinear) as vrt:
+        rgb = vrt.read([1, 2, 3])
+    rgba = np.zeros((tile_size, tile_size, 4), dtype=np.uint8)
+    valid = rgb.any(axis=0)
+    rgba[..., :3] = np.moveaxis(png_scale(rgb), 0, -1)
+    rgba[..., 3] = valid * 255
+    return rgba
+
+def downsample_tile(tiles_dir, z, x, y, fmt):
+    """
+    Arma el tile z/x/y a partir de sus 4 hijos en el zoom z + 1, promediando
+    cada bloque de 2x2 píxeles pesado por la transparencia.  Devuelve None
+    si no existe ningún hijo.
+
+    """
+    from PIL import Image
+
+    mosaic = np.zeros((2 * tile_size, 2 * tile_size, 4), dtype=np.float64)
+    found = False
+    for dx in (0, 1):
+        for dy in (0, 1):
+            path = tile_path(tiles_dir, z + 1, 2 * x + dx, 2 * y + dy, fmt)
+            if not os.path.exists(path):
+                continue
+            with Image.open(path) as img:
+                child = np.asarray(img.convert('RGBA'), dtype=np.float64)
+            mosaic[dy * tile_size:(dy + 1) * tile_size,
+                   dx * tile_size:(dx + 1) * tile_size] = child
+            found = True
+    if not found:
+        return None
+
+    blocks = mosaic.reshape(tile_size, 2, tile_size, 2, 4)
+    alpha = blocks[..., 3].sum(axis=(1, 3))
+    rgb = (blocks[..., :3] * blocks[..., 3:]).sum(axis=(1, 3))
+    rgba = np.zeros((tile_size, tile_size, 4), dtype=np.uint8)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        rgba[..., :3] = np.nan_to_num(np.rint(rgb / alpha[..., None]))
+    rgba[..., 3] = np.rint(alpha / 4)
+    return rgba
+
+def render_column(args):
+    """
+    Tarea del pool: los tiles de la columna +x+ del zoom +z+.  Cada columna
+    se registra como un paso en el proceso que la genera.
+
+    """
+    path, tiles_dir, z, x, ys, fmt, max_zoom = args
+    scene = '/'.join(os.path.dirname(path).split(os.path.sep)[-2:])
+    written = 0
+    with runlog.step('tiles', scene=scene, zoom=z, x=x, format=fmt):
+        if z == max_zoom:
+            with rasterio.open(path) as src:
+                for y in ys:
+                    written += write_tile(render_tile(src, z, x, y),
+                            tile_path(tiles_dir, z, x, y, fmt), fmt)
+        else:
+            for y in ys:
+                rgba = downsample_tile(tiles_dir, z, x, y, fmt)
+                if rgba is not None:
+                    written += write_tile(rgba, tile_path(tiles_dir, z, x, y, fmt), fmt)
+    return written
+
+def tilejson(path, min_zoom, max_zoom, fmt):
+    with rasterio.open(path) as src:
+        bounds = transform_bounds(src.crs, 'EPSG:4326', *src.bounds)
+    return dict(tilejson='2.2.0',
+            name=os.path.basename(os.path.dirname(path)),
+            scheme='xyz',
+            tiles=['{z}/{x}/{y}.' + fmt],
+            minzoom=min_zoom,
+            maxzoom=max_zoom,
+            bounds=list(bounds),
+            center=[(bounds[0] + bounds[2]) / 2., (bounds[1] + bounds[3]) / 2., min_zoom])
+
+def create_tiles(pool, path, min_zoom=None, max_zoom=None, fmt='png'):
+    """
+    Genera la pirámide de tiles del preview +path+ entre los zooms
+    +min_zoom+ y +max_zoom+ (por defecto, el zoom nativo de la imagen y
+    `default_levels` niveles), en el directorio `tiles/` junto al preview.
+    Devuelve la cantidad de tiles escritos.
+
+    """
+    if max_zoom is None:
+        max_zoom = native_zoom(path)
+    if min_zoom is None:
+        min_zoom = max(max_zoom - default_levels + 1, 0)
+    tiles_dir = os.path.join(os.path.dirname(path), 'tiles')
+    # Los niveles de menor zoom se arman con los tiles que haya en disco, así
+    # que no pueden quedar tiles de una corrida anterior
+    shutil.rmtree(tiles_dir, ignore_errors=True)
+
+    with rasterio.open(path) as src:
+        bounds = transform_bounds(src.crs, 'EPSG:3857', *src.bounds)
+
+    written = 0
+    for z in range(max_zoom, min_zoom - 1, -1):
+        x_min, y_min, x_max, y_max = tile_range(bounds, z)
+        ys = list(range(y_min, y_max + 1))
+        tasks = [(path, tiles_dir, z, x, ys, fmt, max_zoom)
+                 for x in range(x_min, x_max + 1)]
+        count = sum(pool.imap_unordered(render_column, tasks))
+        print('{} zoom {}: {} tiles written'.format(path, z, count))
+        written += count
+
+    with open(os.path.join(tiles_dir, 'tiles.json'), 'w') as f:
+        json.dump(tilejson(path, min_zoom, max_zoom, fmt), f, indent=2)
+    return written
+
+
+if __name__ == '__main__':
+    import argparse
+    import create_rgb_images
+
+    parser = argparse.ArgumentParser(
+            description='Genera tiles XYZ de los previews RGB',
+            formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    parser.add_argument('input_dir', metavar='INPUT_DIR', nargs='?',
+            default='processed_data/',
+            help='Ruta donde están almacenadas las imágenes')
+    parser.add_argument('--format', choices=formats, default='png',
+            help='Formato de los tiles')
+    parser.add_argument('--min-zoom', type=int,
+            help='Zoom mínimo (por defecto, {} niveles por debajo del máximo)'.format(
+                default_levels - 1))
+    parser.add_argument('--max-zoom', type=int,
+            help='Zoom máximo (por defecto, el de la resolución de la imagen)')
+    parser.add_argument('--jobs', '-j', type=int,
+            help='Cantidad de procesos (por defecto, el presupuesto de núcleos)')
+    parser.add_argument('--cpus', type=int,
+            help='Presupuesto de núcleos para procesos, threads y comandos ' \
+                 'externos (por defecto, todos los disponibles; ver budget.py)')
+    parser.add_argument('--run-log', metavar='RUN_LOG',
+            help='Registra cada paso en este log JSON-lines (ver runlog.py)')
+    args = parser.parse_args()
+    runlog.configure(args.run_log)
+    budget.configure(args.cpus)
+
+    with budget.pool(args.jobs) as pool:
+        for path in sorted(create_rgb_images.rgb_preview_files(args.input_dir)):
+            create_tiles(pool, path, min_zoom=args.min_zoom,
+                    max_zoom=args.max_zoom, fmt=args.format)
+    runlog.print_summary()
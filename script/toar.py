@@ -0,0 +1,356 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Conversión de DNs de Landsat a reflectancia ToA con NumPy, sin GRASS.
+
+Implementa el mismo modelo que `i.landsat.toar` de GRASS 7 para los métodos
+`uncorrected`, `dos1`, `dos2`, `dos2b` y `dos3` (Dark Object Subtraction).
+Los parámetros de calibración se leen directamente del archivo `_MTL.txt` del
+producto, y cada banda se procesa por bloques, en dos pasadas: la primera
+calcula el histograma de DNs para encontrar el *dark object*, y la segunda
+escribe la reflectancia (o temperatura, para bandas térmicas).
+
+Ejecutado como script, compara las bandas ToA de dos directorios (por ejemplo
+la salida de GRASS contra la de este módulo):
+
+```
+script/toar.py grass_output/ numpy_output/
+```
+
+"""
+import math
+import os
+from datetime import datetime
+from functools import partial
+
+import numpy as np
+import rasterio
+
+import profiles
+import runlog
+from aoi import aoi_window
+from blocks import (ThreadDatasets, map_windows, memory_windows, offset_window,
+        row_windows, rows_for_memory, thread_memory)
+
+methods = ('uncorrected', 'dos1', 'dos2', 'dos2b', 'dos3')
+
+# Irradiancia solar exoatmosférica (W/(m² sr µm)) de Chander et al. (2009),
+# la misma tabla que usa i.landsat.toar.  Para Landsat 8 se calcula a partir
+# de la radiancia y reflectancia máxima del MTL.
+esun_by_spacecraft = {
+    'LANDSAT_5': {'1': 1983., '2': 1796., '3': 1536., '4': 1031.,
+                  '5': 220., '7': 83.44},
+    'LANDSAT_7': {'1': 1997., '2': 1812., '3': 1533., '4': 1039.,
+                  '5': 230.8, '7': 84.9, '8': 1362.},
+}
+
+# Rango espectral de cada banda (µm), usado por DOS3 y para detectar bandas
+# térmicas
+wavelengths_by_spacecraft = {
+    'LANDSAT_5': {'1': (.45, .52), '2': (.52, .60), '3': (.63, .69),
+                  '4': (.76, .90), '5': (1.55, 1.75), '6': (10.40, 12.50),
+                  '7': (2.08, 2.35)},
+    'LANDSAT_7': {'1': (.45, .515), '2': (.525, .605), '3': (.63, .69),
+                  '4': (.75, .90), '5': (1.55, 1.75),
+                  '6_VCID_1': (10.40, 12.50), '6_VCID_2': (10.40, 12.50),
+                  '7': (2.09, 2.35), '8': (.52, .90)},
+    'LANDSAT_8': {'1': (.433, .453), '2': (.450, .515), '3': (.525, .600),
+                  '4': (.630, .680), '5': (.845, .885), '6': (1.560, 1.660),
+                  '7': (2.100, 2.300), '8': (.500, .680), '9': (1.360, 1.390),
+                  '10': (10.60, 11.19), '11': (11.50, 12.51)},
+}
+
+# Constantes térmicas (K1, K2) para MTLs que no las incluyen
+thermal_constants = {
+    'LANDSAT_5': (607.76, 1260.56),
+    'LANDSAT_7': (666.09, 1282.71),
+}
+
+# Porcentaje de la radiancia solar que se asume reflejada por el dark object,
+# y cantidad mínima de píxeles de un DN para considerarlo dark object.  Son
+# los mismos defaults que i.landsat.toar.
+dos_percent = 0.01
+dos_pixel_count = 1000
+
+# Memoria máxima (MB) de las ventanas que se convierten a la vez en cada
+# banda.  `convert` trabaja en float64 y hace copias intermedias: se reservan
+# 5 copias de 8 bytes por píxel.
+max_memory_mb = 256
+convert_bands = 5 * 8
+
+def parse_mtl(path):
+    """Lee un archivo _MTL.txt y devuelve un diccionario plano de valores"""
+    metadata = {}
+    with open(path) as f:
+        for line in f:
+            if '=' not in line:
+                continue
+            key, value = (s.strip() for s in line.split('=', 1))
+            if key in ('GROUP', 'END_GROUP'):
+                continue
+            metadata[key] = value.strip('"')
+    return metadata
+
+def mtl_bands(metadata):
+    """Devuelve los identificadores de banda (p.ej. '1', '6_VCID_1', '10')"""
+    prefix = 'FILE_NAME_BAND_'
+    return [k[len(prefix):] for k in metadata
+            if k.startswith(prefix) and k[len(prefix)].isdigit()]
+
+def toar_band_name(band):
+    """Nombre de banda de salida, como lo hace dn2toar: B6_VCID_1 -> B61"""
+    return band.replace('_VCID_', '')
+
+def is_thermal(metadata, band):
+    low, _ = wavelengths_by_spacecraft[metadata['SPACECRAFT_ID']][band]
+    return low > 10.
+
+def earth_sun_distance(metadata):
+    """Distancia Tierra-Sol (UA) del MTL, o estimada a partir de la fecha"""
+    if 'EARTH_SUN_DISTANCE' in metadata:
+        return float(metadata['EARTH_SUN_DISTANCE'])
+    date = datetime.strptime(metadata['DATE_ACQUIRED'], '%Y-%m-%d')
+    doy = date.timetuple().tm_yday
+    return 1 - 0.016729 * math.cos(math.radians(0.9856 * (doy - 4)))
+
+def band_calibration(metadata, band, method='dos3', dark=None,
+        percent=dos_percent, rayleigh=0.):
+    """
+    Calcula las constantes de conversión de una banda, siguiendo
+    `lsat_bandctes()` de i.landsat.toar.
+
+    Devuelve un diccionario con `gain` y `bias` (DN a radiancia), `qcalmin`, y
+    `rad_sun` (radiancia a reflectancia) para bandas reflectivas, o `k1` y
+    `k2` para bandas térmicas.
+
+    """
+    spacecraft = metadata['SPACECRAFT_ID']
+    lmax = float(metadata['RADIANCE_MAXIMUM_BAND_{}'.format(band)])
+    lmin = float(metadata['RADIANCE_MINIMUM_BAND_{}'.format(band)])
+    qcalmax = float(metadata['QUANTIZE_CAL_MAX_BAND_{}'.format(band)])
+    qcalmin = float(metadata['QUANTIZE_CAL_MIN_BAND_{}'.format(band)])
+
+    gain = (lmax - lmin) / (qcalmax - qcalmin)
+    calib = dict(gain=gain, bias=lmin - gain * qcalmin, qcalmin=qcalmin)
+
+    if is_thermal(metadata, band):
+        k1_key = 'K1_CONSTANT_BAND_{}'.format(band)
+        if k1_key in metadata:
+            k1 = float(metadata[k1_key])
+            k2 = float(metadata['K2_CONSTANT_BAND_{}'.format(band)])
+        else:
+            k1, k2 = thermal_constants[spacecraft]
+        calib.update(k1=k1, k2=k2)
+        return calib
+
+    dist_es = earth_sun_distance(metadata)
+    pi_d2 = math.pi * dist_es * dist_es
+    sin_e = math.sin(math.radians(float(metadata['SUN_ELEVATION'])))
+    cos_v = math.cos(math.radians(8.2))
+
+    if spacecraft == 'LANDSAT_8':
+        rmax = float(metadata['REFLECTANCE_MAXIMUM_BAND_{}'.format(band)])
+        esun = pi_d2 * lmax / rmax
+    else:
+        esun = esun_by_spacecraft[spacecraft][band]
+
+    wavemin, wavemax = wavelengths_by_spacecraft[spacecraft][band]
+    tau_v, tau_z, edown = 1., 1., 0.
+    if method == 'dos2':
+        tau_z = sin_e if wavemax < 1. else 1.
+    elif method == 'dos2b':
+        tau_v = cos_v if wavemax < 1. else 1.
+        tau_z = sin_e if wavemax < 1. else 1.
+    elif method == 'dos3':
+        t = 2. / (wavemax + wavemin)
+        t = 0.008569 * t ** 4 * (1 + 0.0113 * t ** 2 + 0.000013 * t ** 4)
+        tau_v = math.exp(-t / cos_v)
+        tau_z = math.exp(-t / sin_e)
+        edown = rayleigh
+
+    rad_sun = tau_v * (esun * sin_e * tau_z + math.pi * edown) / pi_d2
+    calib['rad_sun'] = rad_sun
+
+    if method != 'uncorrected':
+        if dark is None:
+            raise ValueError('DOS requiere el DN del dark object')
+        # L = G * (DN - dark) + p * rad_sun
+        calib['bias'] = percent * rad_sun - gain * dark
+        calib['dos'] = True
+
+    return calib
+
+def dark_object(hist, qcalmin, pixel_count=dos_pixel_count):
+    """Menor DN válido con al menos +pixel_count+ píxeles"""
+    dns = np.nonzero(hist >= pixel_count)[0]
+    dns = dns[dns >= qcalmin]
+    if not len(dns):
+        return int(qcalmin)
+    return int(dns[0])
+
+def dn_histogram(src, threads=1, max_memory=max_memory_mb):
+    """
+    Histograma de DNs de la banda 1 de +src+, calculado por ventanas en
+    +threads+ threads
+
+    """
+    length = np.iinfo(src.dtypes[0]).max + 1
+    windows = memory_windows(src, 1, thread_memory(max_memory, threads))
+    with ThreadDatasets(src.name) as datasets:
+        def window_histogram(window):
+            band, = datasets.get()
+            data = band.read(1, window=window)
+            return np.bincount(data.ravel(), minlength=length)
+
+        hist = np.zeros(length, dtype=np.int64)
+        for counts in map_windows(window_histogram, windows, threads):
+            hist += counts
+    return hist
+
+def convert(dn, calib):
+    """Convierte un bloque de DNs a reflectancia (o temperatura en Kelvin)"""
+    valid = dn >= calib['qcalmin']
+    rad = dn.astype(np.float64) * calib['gain'] + calib['bias']
+    out = np.full(dn.shape, np.nan)
+    if 'k1' in calib:
+        with np.errstate(invalid='ignore', divide='ignore'):
+            temp = calib['k2'] / np.log(calib['k1'] / rad + 1.)
+        out[valid] = temp[valid]
+    else:
+        ref = rad / calib['rad_sun']
+        if calib.get('dos'):
+            ref[ref < 0] = 0.
+        out[valid] = ref[valid]
+    return out
+
+def convert_window(datasets, crop, calib, dtype, scale_offset, window):
+    """
+    Convierte y codifica la ventana +window+ (relativa a +crop+) de la banda
+    abierta en +datasets+
+
+    """
+    src, = datasets.get()
+    out = convert(src.read(1, window=offset_window(window, crop)), calib)
+    return window, profiles.encode(out, dtype, scale_offset)
+
+def band_path(root, metadata, band):
+    return os.path.join(root, metadata['FILE_NAME_BAND_{}'.format(band)])
+
+def output_path(root, product_id, band):
+    fname = '{}_TOAR_B{}.TIF'.format(product_id, toar_band_name(band))
+    return os.path.join(root, fname)
+
+def convert_band(root, product_id, band, method='dos3',
+        profile=profiles.default_profile, threads=1, max_memory=max_memory_mb,
+        shp_path=None):
+    """
+    Convierte una banda de un producto a reflectancia ToA, y la guarda con el
+    perfil de almacenamiento +profile+ (ver `profiles`).
+
+    Si se pasa el Shapefile +shp_path+, sólo se convierte y se guarda la
+    ventana del área de interés (ver `aoi`).  El *dark object* de los métodos
+    DOS se busca igual en toda la escena, para que la corrección no dependa
+    del recorte.
+
+    La banda se procesa por ventanas, repartidas entre +threads+ threads, sin
+    superar +max_memory+ MB entre todas las ventanas en proceso.
+
+    """
+    with runlog.step('toar', scene=product_id, band=band):
+        metadata = parse_mtl(os.path.join(root, '{}_MTL.txt'.format(product_id)))
+        in_path = band_path(root, metadata, band)
+        out_path = output_path(root, product_id, band)
+
+        with rasterio.open(in_path) as src, ThreadDatasets(in_path) as datasets:
+            thermal = is_thermal(metadata, band)
+            dark = None
+            if method != 'uncorrected' and not thermal:
+                qcalmin = float(metadata['QUANTIZE_CAL_MIN_BAND_{}'.format(band)])
+                dark = dark_object(dn_histogram(src, threads=threads,
+                    max_memory=max_memory), qcalmin)
+            calib = band_calibration(metadata, band, method=method, dark=dark)
+
+            dtype = profiles.float_dtype(profile)
+            scale_offset = profiles.temperature_scale if thermal \
+                    else profiles.reflectance_scale
+            scaled = np.dtype(dtype).kind != 'f'
+            crop = aoi_window(src, shp_path)
+            out_profile = profiles.raster_profile(src.profile, profile, dtype,
+                    nodata=0 if scaled else np.nan,
+                    width=crop.width,
+                    height=crop.height,
+                    transform=src.window_transform(crop))
+            # Se escribe en un archivo temporal, para que las etapas que corren
+            # en paralelo (ver `gapfill`) nunca lean una banda a medio escribir
+            tmp_path = out_path + '.tmp'
+            with rasterio.open(tmp_path, 'w', **out_profile) as dst:
+                if scaled:
+                    dst.scales = (scale_offset[0],)
+                    dst.offsets = (scale_offset[1],)
+                rows = rows_for_memory(src, convert_bands,
+                        thread_memory(max_memory, threads))
+                windows = row_windows(crop.width, crop.height, rows)
+                func = partial(convert_window, datasets, crop, calib, dtype,
+                        scale_offset)
+                for window, out in map_windows(func, windows, threads):
+                    dst.write(out, 1, window=window)
+        profiles.finalize(tmp_path, profile)
+        os.replace(tmp_path, out_path)
+
+    print('{} written'.format(out_path))
+    return out_path
+
+def compare(path_a, path_b):
+    """
+    Compara dos rasters ToA por bloques.  Devuelve la diferencia absoluta
+    máxima y media entre píxeles válidos en ambos, y la cantidad de píxeles
+    que son válidos en uno sólo.
+
+    """
+    max_diff, sum_diff, count, mismatch = 0., 0., 0, 0
+    with rasterio.open(path_a) as a, rasterio.open(path_b) as b:
+        for _, window in a.block_windows(1):
+            va = profiles.read_float(a, window=window)
+            vb = profiles.read_float(b, window=window)
+            valid_a, valid_b = np.isfinite(va), np.isfinite(vb)
+            both = valid_a & valid_b
+            mismatch += int(np.count_nonzero(valid_a ^ valid_b))
+            if both.any():
+                diff = np.abs(va[both] - vb[both])
+                max_diff = max(max_diff, float(diff.max()))
+                sum_diff += float(diff.sum())
+                count += int(both.sum())
+    mean_diff = sum_diff / count if count else 0.
+    return max_diff, mean_diff, mismatch
+
+
+if __name__ == '__main__':
+    import argparse
+    import glob
+
+    parser = argparse.ArgumentParser(
+            description='Compara las bandas ToA de dos directorios',
+            formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    parser.add_argument('reference_dir', metavar='REFERENCE_DIR',
+            help='Directorio con bandas ToA de referencia (p.ej. de GRASS)')
+    parser.add_argument('other_dir', metavar='OTHER_DIR',
+            help='Directorio con bandas ToA a comparar')
+    parser.add_argument('--tolerance', type=float, default=1e-6,
+            help='Diferencia máxima aceptada')
+    args = parser.parse_args()
+
+    failed = False
+    for ref_path in sorted(glob.glob(os.path.join(args.reference_dir, '*_TOAR_*.TIF'))):
+        other_path = os.path.join(args.other_dir, os.path.basename(ref_path))
+        if not os.path.exists(other_path):
+            print('{} missing'.format(other_path))
+            failed = True
+            continue
+        max_diff, mean_diff, mismatch = compare(ref_path, other_path)
+        ok = max_diff <= args.tolerance and not mismatch
+        failed = failed or not ok
+        print('{} max={:.3g} mean={:.3g} nodata_mismatch={} {}'.format(
+            os.path.basename(ref_path), max_diff, mean_diff, mismatch,
+            'OK' if ok else 'FAIL'))
+
+    raise SystemExit(1 if failed else 0)
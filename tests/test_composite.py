@@ -0,0 +1,26 @@
+# -*- coding: utf-8 -*-
+import warnings
+
+import numpy as np
+
+from composite import nan_median
+
+def test_nan_median_matches_numpy():
+    rng = np.random.RandomState(0)
+    stack = rng.rand(7, 20, 30).astype(np.float32)
+    stack[rng.rand(*stack.shape) < 0.4] = np.nan
+    # Píxeles sin ningún valor, y con uno solo
+    stack[:, 0, 0] = np.nan
+    stack[0, 0, 1] = 0.5
+    stack[1:, 0, 1] = np.nan
+    with warnings.catch_warnings():
+        warnings.simplefilter('ignore', RuntimeWarning)
+        expected = np.nanmedian(stack, axis=0)
+    result = nan_median(stack.copy())
+    np.testing.assert_allclose(result, expected, rtol=1e-6)
+    assert np.isnan(result[0, 0])
+    assert result[0, 1] == 0.5
+
+def test_nan_median_even_count():
+    stack = np.array([[[1.]], [[4.]], [[np.nan]], [[2.]], [[10.]]])
+    assert nan_median(stack)[0, 0] == 3.
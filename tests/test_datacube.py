@@ -0,0 +1,55 @@
+# -*- coding: utf-8 -*-
+import json
+import os
+
+import numpy as np
+import pytest
+from rasterio.crs import CRS
+from rasterio.windows import Window
+
+import datacube
+
+@pytest.fixture
+def cube(tmp_path):
+    """Cubo de 2 años y 2 bandas, de 10 x 7 píxeles, en bloques de 4 filas"""
+    height, width, block_rows = 10, 7, 4
+    full = np.arange(2 * 2 * height * width, dtype=np.uint8).reshape(
+            2, 2, height, width)
+    n_blocks = -(-height // block_rows)
+    data = np.zeros((n_blocks, 2, 2, block_rows, width), dtype=np.uint8)
+    for block in range(n_blocks):
+        rows = full[..., block * block_rows:(block + 1) * block_rows, :]
+        data[block, ..., :rows.shape[-2], :] = rows
+    np.save(os.path.join(str(tmp_path), datacube.cube_fname), data)
+    info = dict(crs=CRS.from_epsg(32720).to_wkt(), transform=[30., 0., 0., 0., -30., 0.],
+            width=width, height=height, block_rows=block_rows,
+            bands=['4', '5'], indices=[], nodata=0,
+            times=[dict(year=2009, satsensor='LANDSAT_7-ETM', dates=[], metadata=None),
+                   dict(year=2017, satsensor='LANDSAT_8-OLI_TIRS', dates=[], metadata=None)])
+    with open(os.path.join(str(tmp_path), datacube.index_fname), 'w') as f:
+        json.dump(info, f)
+    return datacube.Datacube(str(tmp_path)), full
+
+def test_window_across_blocks(cube):
+    cube, full = cube
+    np.testing.assert_array_equal(cube.window(Window(2, 3, 4, 6)),
+            full[..., 3:9, 2:6])
+    np.testing.assert_array_equal(cube.window(Window(0, 0, 7, 10), '5'),
+            full[:, 1])
+
+def test_window_clipped_to_cube(cube):
+    cube, full = cube
+    np.testing.assert_array_equal(cube.window(Window(5, 8, 10, 10)),
+            full[..., 8:, 5:])
+
+def test_window_outside_cube_is_empty(cube):
+    cube, _ = cube
+    assert cube.window(Window(0, 10, 3, 3)).shape == (2, 2, 0, 3)
+    assert cube.window(Window(20, 0, 3, 3)).shape[-1] == 0
+
+def test_window_negative_offset(cube):
+    cube, _ = cube
+    with pytest.raises(IndexError):
+        cube.window(Window(-5, -5, 10, 10))
+    with pytest.raises(IndexError):
+        cube.pixel(10, 0)
@@ -0,0 +1,33 @@
+# -*- coding: utf-8 -*-
+import os
+
+import download
+
+def make_product(tmp_path):
+    src = tmp_path / 'src' / 'LC08_X'
+    src.mkdir(parents=True)
+    for band, size in (('4', 100), ('3', 100), ('2', 100), ('5', 50)):
+        (src / 'LC08_X_B{}.TIF'.format(band)).write_bytes(b'x' * size)
+    (src / 'LC08_X_MTL.txt').write_bytes(b'mtl')
+    return dict(id='LC08_X', year='2017', spacecraft_id='LANDSAT_8',
+            sensor_id='OLI_TIRS', total_size='353', base_url=str(src))
+
+def test_dry_run_plans_selection_without_writing(tmp_path, capsys):
+    product = make_product(tmp_path)
+    out_dir = str(tmp_path / 'out')
+    result = download.download_product(product, out_dir,
+            transport=download.LocalTransport(), select=('rgb',), dry_run=True)
+    assert result == (0, 303, 353)
+    assert not os.path.exists(out_dir)
+    printed = capsys.readouterr().out
+    assert 'LC08_X_B4.TIF' in printed and 'LC08_X_B5.TIF' not in printed
+
+def test_download_selection(tmp_path):
+    product = make_product(tmp_path)
+    out_dir = str(tmp_path / 'out')
+    result = download.download_product(product, out_dir,
+            transport=download.LocalTransport(), select=('rgb',), bands=('5',))
+    assert result == (353, 353, 353)
+    root = os.path.join(download.product_dir(product, out_dir), 'LC08_X')
+    assert sorted(os.listdir(root)) == ['LC08_X_B2.TIF', 'LC08_X_B3.TIF',
+            'LC08_X_B4.TIF', 'LC08_X_B5.TIF', 'LC08_X_MTL.txt']
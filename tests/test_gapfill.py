@@ -0,0 +1,68 @@
+# -*- coding: utf-8 -*-
+import os
+
+import numpy as np
+import pytest
+
+import gapfill
+import manifest
+
+def test_interpolate_gaps_linear():
+    data = np.tile(np.arange(10, dtype=np.float64), (5, 1))
+    data[:, 3:6] = np.nan
+    gapfill.interpolate_gaps(data, max_distance=10)
+    np.testing.assert_allclose(data, np.tile(np.arange(10.), (5, 1)))
+
+def test_interpolate_gaps_max_distance_and_edges():
+    data = np.array([[1., np.nan, np.nan, np.nan, np.nan, 6., np.nan]])
+    gapfill.interpolate_gaps(data, max_distance=2)
+    # El gap es más largo que la distancia máxima, y el último píxel no
+    # tiene vecino siguiente
+    assert np.isnan(data[0, 1:5]).all()
+    assert np.isnan(data[0, 6])
+
+def test_linear_fit_matches_mean_and_std():
+    rng = np.random.RandomState(0)
+    donor = rng.rand(5000)
+    target = donor * 2.5 + 0.3
+    gain, offset = gapfill.linear_fit(donor.size, donor.sum(), (donor ** 2).sum(),
+            target.sum(), (target ** 2).sum())
+    assert gain == pytest.approx(2.5)
+    assert offset == pytest.approx(0.3)
+
+def test_linear_fit_needs_enough_pixels():
+    assert gapfill.linear_fit(gapfill.min_common_pixels - 1, 1., 1., 1., 1.) is None
+
+def make_scene(data_dir, scene_id, product_id, date, wrs_row=82):
+    root = os.path.join(data_dir, 'LANDSAT_7-ETM', date[:4], scene_id, product_id)
+    os.makedirs(root)
+    with open(os.path.join(root, product_id + '_MTL.txt'), 'w') as f:
+        f.write('SPACECRAFT_ID = "LANDSAT_7"\n'
+                'WRS_PATH = 229\n'
+                'WRS_ROW = {}\n'
+                'DATE_ACQUIRED = {}\n'
+                'FILE_NAME_BAND_3 = "{}_B3.TIF"\n'.format(wrs_row, date, product_id))
+    path = os.path.join(root, product_id + '_TOAR_B3.TIF')
+    open(path, 'w').close()
+    return path
+
+@pytest.fixture
+def archive(tmp_path):
+    data_dir = str(tmp_path / 'data')
+    target = make_scene(data_dir, 'S1', 'P1', '2009-01-05')
+    near = make_scene(data_dir, 'S2', 'P2', '2009-02-06')
+    far = make_scene(data_dir, 'S3', 'P3', '2011-01-05')
+    make_scene(data_dir, 'S4', 'P4', '2009-01-21', wrs_row=83)
+    return data_dir, target, near, far
+
+def test_donor_paths_by_date(archive):
+    data_dir, target, near, far = archive
+    assert gapfill.donor_paths(target) == [near, far]
+
+def test_donor_paths_only_completed(archive):
+    data_dir, target, near, far = archive
+    m = manifest.Manifest(os.path.join(data_dir, '.dn2toar.manifest.json'))
+    m.record(far, [], {})
+    m.record(near, [], {}, error='Traceback: interrumpido')
+    m.save()
+    assert gapfill.donor_paths(target) == [far]
@@ -0,0 +1,58 @@
+# -*- coding: utf-8 -*-
+import os
+
+import inventory
+
+def make_tree(root):
+    product = os.path.join(root, 'LANDSAT_8-OLI_TIRS', '2017', 'S1', 'P1')
+    os.makedirs(product)
+    for fname in ('P1_MTL.txt', 'P1_B4.TIF', 'P1_TOAR_B4.TIF', 'notes.txt'):
+        open(os.path.join(product, fname), 'w').close()
+    return product
+
+def test_classify():
+    assert inventory.classify(os.path.join('LANDSAT_8-OLI_TIRS', '2017', 'S1',
+        'P1', 'P1_TOAR_B10.TIF')) == dict(stage='toar', band='10',
+            satsensor='LANDSAT_8-OLI_TIRS', year=2017, scene_id='S1', product_id='P1')
+    assert inventory.classify(os.path.join('2017', 'LANDSAT_8-OLI_TIRS',
+        'tag_2017_LANDSAT_8-OLI_TIRS_B4.TIF'))['stage'] == 'band'
+    assert inventory.classify(os.path.join('2017', 'x.TIF')) is None
+
+def test_stages_and_match(tmp_path):
+    root = str(tmp_path)
+    product = make_tree(root)
+    inv = inventory.open_inventory(root)
+    assert inv.paths('toar') == [os.path.join(product, 'P1_TOAR_B4.TIF')]
+    assert inv.match('notes.*') == [os.path.join(product, 'notes.txt')]
+    assert os.path.exists(os.path.join(root, inventory.db_fname))
+
+def test_dry_run_does_not_create_db(tmp_path):
+    root = str(tmp_path)
+    make_tree(root)
+    inv = inventory.open_inventory(root, create=False)
+    assert inv.in_memory and len(inv.paths('dn')) == 1
+    assert not os.path.exists(os.path.join(root, inventory.db_fname))
+
+def test_unwritable_db_falls_back_to_memory(tmp_path):
+    root = str(tmp_path)
+    make_tree(root)
+    # Una ruta que SQLite no puede abrir, como en un árbol de sólo lectura
+    os.mkdir(os.path.join(root, inventory.db_fname))
+    inv = inventory.open_inventory(root)
+    assert inv.in_memory and len(inv.paths('mtl')) == 1
+
+def test_refresh_max_age_and_check(tmp_path):
+    root = str(tmp_path)
+    product = make_tree(root)
+    inv = inventory.open_inventory(root)
+    open(os.path.join(product, 'P1_B5.TIF'), 'w').close()
+    # Revisado hace menos de max_age segundos: todavía no ve la banda nueva
+    assert len(inventory.open_inventory(root, max_age=3600).paths('dn')) == 1
+    assert len(inventory.open_inventory(root).paths('dn')) == 2
+
+    # Un archivo reescrito en el lugar sólo se actualiza con check
+    with open(os.path.join(product, 'P1_MTL.txt'), 'w') as f:
+        f.write('GROUP = L1_METADATA_FILE\n')
+    assert inv.files('mtl')[0]['size'] == 0
+    assert inv.files('mtl', check=True)[0]['size'] > 0
+    assert inv.files('mtl')[0]['size'] > 0
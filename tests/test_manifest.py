@@ -0,0 +1,58 @@
+# -*- coding: utf-8 -*-
+import pytest
+
+from manifest import Manifest, check_outputs, run_units, unit
+
+def test_check_outputs_rejects_shared_output():
+    units = [unit('out/2017/L8/B4.TIF', [], {}, 'scene_a_B4.TIF'),
+             unit('out/2017/L8/B4.TIF', [], {}, 'scene_b_B4.TIF'),
+             unit('out/2017/L8/B5.TIF', [], {}, 'scene_a_B5.TIF')]
+    with pytest.raises(ValueError, match='scene_b_B4.TIF'):
+        check_outputs(units)
+    check_outputs(units[1:])
+
+def test_is_fresh(tmp_path):
+    src = tmp_path / 'in.TIF'
+    out = tmp_path / 'out.TIF'
+    src.write_bytes(b'abc')
+    out.write_bytes(b'x')
+    m = Manifest(str(tmp_path / '.test.manifest.json'))
+    params = dict(engine='fused', bands=(4, 3, 2))
+    assert not m.is_fresh(str(out), [str(src)], params)
+
+    m.record(str(out), [str(src)], params)
+    m.save()
+    # Los parámetros se comparan tal como quedan en el JSON (tuplas como listas)
+    m = Manifest(m.path)
+    assert m.is_fresh(str(out), [str(src)], params)
+    assert not m.is_fresh(str(out), [str(src)], dict(params, engine='gdal'))
+
+    # Cambia una entrada
+    src.write_bytes(b'abcd')
+    assert not m.is_fresh(str(out), [str(src)], params)
+
+def test_is_fresh_failed_or_missing_output(tmp_path):
+    src = tmp_path / 'in.TIF'
+    out = tmp_path / 'out.TIF'
+    src.write_bytes(b'abc')
+    m = Manifest(str(tmp_path / '.test.manifest.json'))
+    m.record(str(out), [str(src)], {})
+    assert not m.is_fresh(str(out), [str(src)], {})
+    out.write_bytes(b'x')
+    m.record(str(out), [str(src)], {}, error='Traceback')
+    assert not m.is_fresh(str(out), [str(src)], {})
+
+def test_run_units_skips_fresh_units(tmp_path):
+    calls = []
+
+    def write(path):
+        calls.append(path)
+        with open(path, 'w') as f:
+            f.write('x')
+
+    m = Manifest(str(tmp_path / '.test.manifest.json'))
+    units = [unit(str(tmp_path / name), [], {}, str(tmp_path / name))
+             for name in ('a', 'b')]
+    assert run_units(write, units, m) == []
+    assert run_units(write, units, m) == []
+    assert len(calls) == 2
@@ -0,0 +1,18 @@
+# -*- coding: utf-8 -*-
+import numpy as np
+from PIL import Image
+
+from pngstream import PNGWriter
+
+def test_alpha_from_mask(tmp_path):
+    path = str(tmp_path / 'out.png')
+    rgb = np.arange(3 * 4 * 5, dtype=np.uint8).reshape(3, 4, 5)
+    mask = np.ones((4, 5), dtype=bool)
+    mask[1, 2] = False
+    with PNGWriter(path, 5, 4, alpha=True) as png:
+        png.write(rgb[:, :2], mask=mask[:2])
+        png.write(rgb[:, 2:], mask=mask[2:])
+    img = np.asarray(Image.open(path))
+    assert img.shape == (4, 5, 4)
+    np.testing.assert_array_equal(img[..., :3], np.moveaxis(rgb, 0, -1))
+    np.testing.assert_array_equal(img[..., 3], np.where(mask, 255, 0))
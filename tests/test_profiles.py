@@ -0,0 +1,17 @@
+# -*- coding: utf-8 -*-
+import numpy as np
+
+import profiles
+
+def test_encode_float():
+    data = np.array([0.25, np.nan])
+    out = profiles.encode(data, 'float32', profiles.reflectance_scale)
+    assert out.dtype == np.float32
+    assert out[0] == 0.25 and np.isnan(out[1])
+
+def test_encode_integer_scale_and_nodata():
+    scale, offset = profiles.reflectance_scale
+    data = np.array([offset + 100 * scale, np.nan, offset - 5 * scale, 1e9])
+    out = profiles.encode(data, 'uint16', (scale, offset))
+    # NaN es nodata (0); los valores válidos quedan entre 1 y el máximo
+    assert out.tolist() == [100, 0, 1, np.iinfo(np.uint16).max]
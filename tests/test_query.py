@@ -0,0 +1,40 @@
+# -*- coding: utf-8 -*-
+from shapely.geometry import box
+
+import query
+
+def scene(scene_id, bounds, cloud_cover=0., year='2017', path='229', row='82'):
+    west, south, east, north = bounds
+    return dict(scene_id=scene_id, year=year, spacecraft_id='LANDSAT_8',
+            sensor_id='OLI_TIRS', wrs_path=path, wrs_row=row,
+            sensing_time='{}-01-05'.format(year), cloud_cover=str(cloud_cover),
+            west_lon=west, south_lat=south, east_lon=east, north_lat=north)
+
+def ids(scenes):
+    return [s['scene_id'] for s in scenes]
+
+def test_greedy_cover_two_overlapping_footprints():
+    aoi = box(0, 0, 10, 2)
+    west = scene('W', (-1, -1, 6, 3), path='229')
+    east = scene('E', (4, -1, 11, 3), path='230')
+    # Una escena que no agrega nada una vez elegidas las otras dos
+    middle = scene('M', (3, -1, 7, 3), path='231')
+    assert sorted(ids(query.greedy_cover([middle, west, east], aoi))) == ['E', 'W']
+
+def test_greedy_cover_single_scene_prefers_clear_sky():
+    aoi = box(0, 0, 1, 1)
+    cloudy = scene('C', (-1, -1, 2, 2), cloud_cover=40., path='229')
+    clear = scene('K', (-1, -1, 2, 2), cloud_cover=5., path='230')
+    assert ids(query.greedy_cover([cloudy, clear], aoi)) == ['K']
+
+def test_covering_scenes_groups_by_year_and_drops_footprints():
+    aoi = box(0, 0, 1, 1)
+    scenes = [scene('A', (-1, -1, 2, 2), year='2016'),
+              scene('B', (-1, -1, 2, 2), year='2017', cloud_cover=30.),
+              # Mismo path/row y año, menos nubes: reemplaza a B
+              scene('C', (-1, -1, 2, 2), year='2017', cloud_cover=10.),
+              # No intersecta el área
+              scene('D', (5, 5, 6, 6), year='2017', path='231')]
+    result = list(query.covering_scenes(scenes, aoi, 'landsat'))
+    assert ids(result) == ['C', 'A']
+    assert not set(query.footprint_fields) & set(result[0])
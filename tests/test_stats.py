@@ -0,0 +1,44 @@
+# -*- coding: utf-8 -*-
+import math
+
+import numpy as np
+import pytest
+
+from stats import Histogram
+
+def histogram(data, decimation=1):
+    hist = Histogram(1, data.dtype, decimation=decimation)
+    hist.update(data[np.newaxis, np.newaxis], np.ones((1, len(data)), bool))
+    return hist
+
+def test_full_read_is_exact():
+    data = np.arange(100, dtype=np.uint8)
+    hist = histogram(data)
+    p = hist.percentile(50)
+    assert p.value == 49
+    assert p.rank_error == 0.
+    assert p.value_error == 0
+
+def test_dkw_bound():
+    rng = np.random.default_rng(0)
+    population = rng.integers(0, 1000, 10 ** 6).astype(np.uint16)
+    sample = population[::100]
+    hist = histogram(sample, decimation=10)
+    n = len(sample)
+    # sqrt(ln(2 / alpha) / 2n) con alpha = 1%
+    assert hist.rank_error() == pytest.approx(math.sqrt(math.log(200) / (2 * n)))
+    # La CDF de la muestra queda dentro de la cota respecto de la población
+    true_cdf = histogram(population).cdf()
+    assert np.abs(hist.cdf() - true_cdf).max() <= hist.rank_error()
+
+def test_empty_histogram():
+    hist = Histogram(1, np.uint8, decimation=4)
+    assert hist.rank_error() == 1.
+
+def test_float_bins():
+    data = np.linspace(0., 1., 1001, dtype=np.float32)
+    hist = Histogram(1, data.dtype, bins=100, value_range=(0., 1.))
+    hist.update(data[np.newaxis, np.newaxis], np.ones((1, len(data)), bool))
+    p = hist.percentile(50)
+    assert p.value_error == pytest.approx(0.01)
+    assert abs(p.value - 0.5) <= p.value_error
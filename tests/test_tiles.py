@@ -0,0 +1,15 @@
+# -*- coding: utf-8 -*-
+import tiles
+
+def test_tile_range_world():
+    world = (-tiles.origin_shift, -tiles.origin_shift,
+             tiles.origin_shift, tiles.origin_shift)
+    assert tiles.tile_range(world, 0) == (0, 0, 0, 0)
+    assert tiles.tile_range(world, 3) == (0, 0, 7, 7)
+
+def test_tile_range_matches_tile_bounds():
+    bounds = tiles.tile_bounds(12, 1400, 2500)
+    assert tiles.tile_range(bounds, 12) == (1400, 2500, 1400, 2500)
+    # Un tile del zoom 13 dentro del anterior
+    assert tiles.tile_range(tiles.tile_bounds(13, 2801, 5000), 12) == \
+            (1400, 2500, 1400, 2500)
@@ -0,0 +1,67 @@
+# -*- coding: utf-8 -*-
+import math
+
+import numpy as np
+import pytest
+
+from toar import band_calibration, convert, dark_object
+
+# MTL mínimo de Landsat 7: banda 3 (ESUN 1533) y banda térmica 6
+metadata = {
+    'SPACECRAFT_ID': 'LANDSAT_7',
+    'SUN_ELEVATION': '30.0',
+    'EARTH_SUN_DISTANCE': '1.0',
+    'RADIANCE_MAXIMUM_BAND_3': '234.4',
+    'RADIANCE_MINIMUM_BAND_3': '-5.0',
+    'QUANTIZE_CAL_MAX_BAND_3': '255',
+    'QUANTIZE_CAL_MIN_BAND_3': '1',
+    'RADIANCE_MAXIMUM_BAND_6_VCID_1': '234.4',
+    'RADIANCE_MINIMUM_BAND_6_VCID_1': '-5.0',
+    'QUANTIZE_CAL_MAX_BAND_6_VCID_1': '255',
+    'QUANTIZE_CAL_MIN_BAND_6_VCID_1': '1',
+}
+
+# L = 239.4 / 254 * (DN - 1) - 5;  ESUN * sin(30°) / (pi * d²) = 243.98
+dn = np.array([0, 5, 100], dtype=np.uint8)
+
+def test_uncorrected_reflectance():
+    calib = band_calibration(metadata, '3', method='uncorrected')
+    ref = convert(dn, calib)
+    assert np.isnan(ref[0])
+    # Sin DOS no se recortan los valores negativos
+    assert ref[1] == pytest.approx((239.4 / 254 * 4 - 5) / 243.98453)
+    assert ref[2] == pytest.approx(0.361947, abs=1e-6)
+
+def test_dos1_reflectance():
+    calib = band_calibration(metadata, '3', method='dos1', dark=10)
+    # rho = pi * (L - Lhaze) * d² / (ESUN * cos(tz)), con
+    # Lhaze = L(dark) - 1% de la radiancia solar
+    rad_sun = 1533 * math.sin(math.radians(30)) / math.pi
+    haze = 239.4 / 254 * 9 - 5 - 0.01 * rad_sun
+    expected = (239.4 / 254 * 99 - 5 - haze) / rad_sun
+    ref = convert(dn, calib)
+    assert expected == pytest.approx(0.357673, abs=1e-6)
+    assert ref[2] == pytest.approx(expected)
+    # Más oscuro que el dark object: 0, no negativo
+    assert ref[1] == 0.
+    assert np.isnan(ref[0])
+
+def test_dos_requires_dark_object():
+    with pytest.raises(ValueError):
+        band_calibration(metadata, '3', method='dos1')
+
+def test_thermal_band():
+    calib = band_calibration(metadata, '6_VCID_1', method='dos1')
+    temp = convert(dn, calib)
+    assert temp[2] == pytest.approx(597.979, abs=1e-3)
+    assert np.isnan(temp[0])
+
+def test_dark_object():
+    hist = np.zeros(256, dtype=np.int64)
+    hist[0] = 10 ** 6
+    hist[3] = 10
+    hist[7] = 2000
+    assert dark_object(hist, 1) == 7
+    assert dark_object(hist, 1, pixel_count=5) == 3
+    # Ningún DN alcanza la cantidad mínima
+    assert dark_object(hist, 8) == 8